@@ -1,13 +1,52 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
-from .models import CustomUser, Profile
+from django.core.exceptions import ValidationError
+from .models import CustomUser, Profile, AuthEvent
 from .forms import CustomUserCreationForm
+from .bulk import apply_bulk_action
+from .sharding import is_sharded, shard_for_id, user_databases
+
+
+def bulk_admin_action(action, description, **params):
+    def run(modeladmin, request, queryset):
+        result = apply_bulk_action(queryset, action, **params)
+        modeladmin.message_user(request, f"{result['updated']} of {result['matched']} users updated.", messages.SUCCESS)
+    run.__name__ = f"bulk_{action}_{params.get('role', '')}".rstrip("_")
+    run.short_description = description
+    return run
+
+
+class DatabaseListFilter(admin.SimpleListFilter):
+    """With sharding on, picks the database the user list (and its actions) read from."""
+    title = "database"
+    parameter_name = "database"
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in user_databases()]
+
+    def queryset(self, request, queryset):
+        if self.value() in user_databases():
+            return queryset.using(self.value())
+        return queryset
+
+
+# Group and Permission rows only exist on "default", where staff are kept
+DEFAULT_ONLY_FIELDS = {'is_staff', 'is_superuser', 'groups', 'user_permissions'}
+
 
 class CustomUserAdmin(UserAdmin):
     add_form = CustomUserCreationForm
     model = CustomUser
-    list_display = ('email', 'first_name', 'last_name', 'is_staff', 'is_active',)
-    list_filter = ('is_staff', 'is_active',)
+    list_display = ('email', 'first_name', 'last_name', 'role', 'is_verified', 'is_staff', 'is_active',)
+    list_filter = ('is_staff', 'is_active', 'is_verified', 'role',)
+    actions = [
+        bulk_admin_action("verify", "Mark selected users as verified"),
+        bulk_admin_action("unverify", "Mark selected users as unverified"),
+        bulk_admin_action("activate", "Activate selected users"),
+        bulk_admin_action("deactivate", "Deactivate selected users"),
+        bulk_admin_action("set_role", "Make selected users managers", role="manager"),
+        bulk_admin_action("set_role", "Make selected users cashiers", role="cashier"),
+    ]
     fieldsets = (
         (None, {'fields': ('email', 'password')}),
         ('Personal Info', {'fields': ('first_name', 'last_name', 'code')}),
@@ -22,9 +61,53 @@ class CustomUserAdmin(UserAdmin):
     )
     search_fields = ('email',)
     ordering = ('email',)
+    # The total would only count "default"
+    show_full_result_count = False
+
+    def get_list_filter(self, request):
+        if is_sharded():
+            return (DatabaseListFilter, *self.list_filter)
+        return self.list_filter
+
+    def get_object(self, request, object_id, from_field=None):
+        # The change, password, history and delete pages find the user on its own shard
+        if from_field is not None or not is_sharded():
+            return super().get_object(request, object_id, from_field)
+        try:
+            user_id = self.model._meta.pk.to_python(object_id)
+            return self.get_queryset(request).using(shard_for_id(user_id)).get(pk=user_id)
+        except (self.model.DoesNotExist, ValidationError, ValueError):
+            return None
+
+    def get_fieldsets(self, request, obj=None):
+        fieldsets = super().get_fieldsets(request, obj)
+        if obj is None or obj._state.db == "default":
+            return fieldsets
+        return [
+            (name, {**options, 'fields': tuple(field for field in options['fields'] if field not in DEFAULT_ONLY_FIELDS)})
+            for name, options in fieldsets
+        ]
 
 
 admin.site.register(CustomUser, CustomUserAdmin)
 admin.site.register(Profile)
 
 
+class AuthEventAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'email', 'user_id', 'ip_address', 'created',)
+    list_filter = ('kind',)
+    search_fields = ('email',)
+    ordering = ('-id',)
+
+    # The log is append-only
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+admin.site.register(AuthEvent, AuthEventAdmin)
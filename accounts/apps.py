@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'accounts'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+
+        # Connects the token revocation signal receivers
+        from . import tokens
+        from .sharding import seed_shard_sequence
+
+        post_migrate.connect(seed_shard_sequence, sender=self)
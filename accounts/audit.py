@@ -0,0 +1,127 @@
+"""
+Batched auth event log.
+
+record_event() only appends to an in-memory buffer, so views pay no database
+cost. A background thread per worker writes the buffer to the append-only
+AuthEvent table with one bulk_create every AUDIT_FLUSH_INTERVAL seconds, or
+sooner once AUDIT_BATCH_SIZE events are waiting. Gunicorn's worker_exit hook
+and interpreter exit flush whatever is left.
+"""
+
+import atexit
+import ipaddress
+import logging
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from rest_framework.throttling import BaseThrottle
+
+from .models import AuthEvent
+
+
+logger = logging.getLogger(__name__)
+
+_buffer = deque()
+_lock = threading.Lock()
+_wake = threading.Event()
+_flusher = {"pid": None, "thread": None}
+
+
+def client_ip(request):
+    # The throttles' rules: X-Forwarded-For is only read behind NUM_PROXIES trusted proxies
+    if request is None:
+        return None
+    ident = BaseThrottle().get_ident(request)
+    try:
+        return str(ipaddress.ip_address(ident))
+    except ValueError:
+        return None
+
+
+def record_event(kind, request=None, user=None, email="", **data):
+    """Queue an auth event. Never touches the database."""
+    if not getattr(settings, "AUDIT_LOG_ENABLED", True):
+        return
+
+    event = AuthEvent(
+        kind=kind,
+        user_id=getattr(user, "pk", None),
+        email=email or getattr(user, "email", "") or "",
+        ip_address=client_ip(request),
+        created=timezone.now(),
+        data=data,
+    )
+
+    max_buffer = getattr(settings, "AUDIT_MAX_BUFFER", 10000)
+    with _lock:
+        if len(_buffer) >= max_buffer:
+            _buffer.popleft()
+            logger.warning("Auth event buffer full, dropped the oldest event")
+        _buffer.append(event)
+        waiting = len(_buffer)
+
+    _ensure_flusher()
+    if waiting >= getattr(settings, "AUDIT_BATCH_SIZE", 100):
+        _wake.set()
+
+
+def flush_events():
+    """Write every buffered event in one statement. Returns how many were written."""
+    with _lock:
+        events = list(_buffer)
+        _buffer.clear()
+    if not events:
+        return 0
+    try:
+        AuthEvent.objects.bulk_create(events)
+    except Exception:
+        logger.exception("Could not write %s auth events, requeueing them", len(events))
+        with _lock:
+            _buffer.extendleft(reversed(events))
+        return 0
+    return len(events)
+
+
+def _run_flusher():
+    while True:
+        _wake.wait(getattr(settings, "AUDIT_FLUSH_INTERVAL", 2.0))
+        _wake.clear()
+        close_old_connections()
+        flush_events()
+
+
+def _ensure_flusher():
+    # A forked worker inherits the master's state but not its threads
+    pid = os.getpid()
+    if _flusher["pid"] == pid and _flusher["thread"].is_alive():
+        return
+    with _lock:
+        if _flusher["pid"] == pid and _flusher["thread"].is_alive():
+            return
+        thread = threading.Thread(target=_run_flusher, name="auth-event-flusher", daemon=True)
+        thread.start()
+        _flusher.update(pid=pid, thread=thread)
+
+
+atexit.register(flush_events)
+
+
+def query_events(kind=None, user_id=None, email=None, after_id=None, limit=100):
+    """
+    Latest events first, or with ``after_id`` the events that came after it in
+    insertion order, which is how a client tails the log.
+    """
+    queryset = AuthEvent.objects.all()
+    if kind:
+        queryset = queryset.filter(kind=kind)
+    if user_id:
+        queryset = queryset.filter(user_id=user_id)
+    if email:
+        queryset = queryset.filter(email=email)
+    if after_id is not None:
+        return list(queryset.filter(id__gt=after_id).order_by("id")[:limit])
+    return list(queryset.order_by("-id")[:limit])
@@ -0,0 +1,148 @@
+import hashlib
+import hmac
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from .sharding import shard_for_id, shard_for_token
+from .tokens import (
+    InvalidToken,
+    access_lifetime,
+    is_revoked,
+    is_signed_token,
+    read_access_token,
+    redeem_stream_ticket,
+    user_from_claims,
+)
+
+
+class SignedTokenAuthentication(TokenAuthentication):
+    """
+    Authenticates signed access tokens without a database query.
+    Accepts "Token <token>" like TokenAuthentication, and "Bearer <token>".
+    Anything that isn't a signed token is left to TokenAuthentication.
+    """
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if len(auth) != 2 or auth[0].lower() not in (b"token", b"bearer"):
+            return None
+
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            return None
+
+        if not is_signed_token(token):
+            return None
+
+        try:
+            claims = read_access_token(token)
+        except InvalidToken as e:
+            raise AuthenticationFailed(str(e))
+
+        return (user_from_claims(claims), token)
+
+
+class ShardedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that reads the token from the shard named in its key."""
+    related = ("user",)
+
+    def authenticate_credentials(self, key):
+        model = self.get_model()
+        try:
+            token = model.objects.using(shard_for_token(key)).select_related(*self.related).get(key=key)
+        except model.DoesNotExist:
+            raise AuthenticationFailed("Invalid token.")
+
+        if not token.user.is_active:
+            raise AuthenticationFailed("User inactive or deleted.")
+
+        return (token.user, token)
+
+
+class ProfileTokenAuthentication(ShardedTokenAuthentication):
+    """Loads the token, user and profile in one joined query, for views that show the profile."""
+    related = ("user__profile",)
+
+
+class ShardedModelBackend(ModelBackend):
+    """Session lookups (admin) by user id go to the user's shard."""
+
+    def get_user(self, user_id):
+        UserModel = get_user_model()
+        try:
+            user = UserModel._default_manager.for_id(user_id).get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
+
+
+# Used by every authenticated view
+AUTHENTICATION_CLASSES = [SignedTokenAuthentication, ShardedTokenAuthentication]
+PROFILE_AUTHENTICATION_CLASSES = [SignedTokenAuthentication, ProfileTokenAuthentication]
+
+
+# Event streams
+
+def token_digest(key):
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def stream_grant(user, auth):
+    """
+    What an event stream re-checks while it is open, for the token it was
+    opened with (``request.auth``): the id and issue time of a signed access
+    token, or a digest of a DRF token. Never the token itself, stream tickets
+    carry the grant.
+    """
+    if isinstance(auth, Token):
+        return {"u": user.pk, "k": token_digest(auth.key)}
+    claims = read_access_token(auth)
+    return {"u": user.pk, "i": claims["i"], "j": claims["j"]}
+
+
+def grant_expires(grant):
+    """When the token behind ``grant`` expires, None for DRF tokens (they don't)."""
+    return grant["i"] + access_lifetime() if "j" in grant else None
+
+
+def grant_is_valid(grant):
+    """Whether the token behind ``grant`` still authenticates its user."""
+    if "j" in grant:
+        return grant_expires(grant) > time.time() and not is_revoked(grant)
+    # Logging out or deactivating the user deletes or orphans the token
+    key = (
+        Token.objects.using(shard_for_id(grant["u"]))
+        .filter(user_id=grant["u"], user__is_active=True)
+        .values_list("key", flat=True)
+        .first()
+    )
+    return key is not None and hmac.compare_digest(token_digest(key), grant["k"])
+
+
+def authenticate_stream(request):
+    """
+    The grant of an event stream request, from the Authorization header or a
+    ?ticket= (EventSource can't set headers). Raises AuthenticationFailed.
+    """
+    for authentication in AUTHENTICATION_CLASSES:
+        result = authentication().authenticate(request)
+        if result is not None:
+            return stream_grant(*result)
+
+    ticket = request.GET.get("ticket")
+    if not ticket:
+        raise AuthenticationFailed("Authentication credentials were not provided.")
+    try:
+        grant = redeem_stream_ticket(ticket)
+    except InvalidToken as e:
+        raise AuthenticationFailed(str(e))
+    if not grant_is_valid(grant):
+        raise AuthenticationFailed("Token has been revoked.")
+    return grant
@@ -0,0 +1,114 @@
+"""
+Everything the frontend needs on app start, in one response.
+
+A bootstrap response has four sections:
+
+    token        the auth token(s), as login_view returns them
+    user         id, email and role
+    profile      the profile fields and image_url
+    permissions  the same snapshot login_view and user_profile return
+
+``?fields=profile,permissions`` keeps whole sections and
+``?fields=profile.first_name,profile.image_url`` keeps single fields of one.
+The ETag covers everything but the token, so a client that kept its token can
+revalidate the rest with If-None-Match and get a 304.
+"""
+
+import hashlib
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.http import parse_etags
+
+
+SECTIONS = ("token", "user", "profile", "permissions")
+
+PROFILE_FIELDS = ("first_name", "last_name", "phone_number", "address", "gender", "birth_date", "bio", "image_url")
+
+SECTION_FIELDS = {
+    # The token section depends on the auth mode, it can only be selected whole
+    "token": (),
+    "user": ("id", "email", "role"),
+    "profile": PROFILE_FIELDS,
+    "permissions": ("is_superuser", "is_manager", "is_cashier", "is_verified"),
+}
+
+
+class InvalidFields(ValueError):
+    pass
+
+
+def permission_snapshot(user):
+    return {
+        "is_superuser": user.is_superuser,
+        "is_manager": user.role == "manager",
+        "is_cashier": user.role == "cashier",
+        "is_verified": user.is_verified,
+    }
+
+
+def profile_snapshot(profile):
+    return {field: getattr(profile, field) for field in PROFILE_FIELDS}
+
+
+def build_bootstrap(user, profile):
+    """The user, profile and permissions sections. ``profile`` must come from the same joined query."""
+    return {
+        "user": {"id": user.pk, "email": user.email, "role": user.role},
+        "profile": profile_snapshot(profile),
+        "permissions": permission_snapshot(user),
+    }
+
+
+def parse_fields(value):
+    """
+    Turn ``?fields=`` into {section: None (all) | set of fields}.
+    An empty value means every section.
+    """
+    if not value:
+        return {section: None for section in SECTIONS}
+
+    selected = {}
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        section, _, field = item.partition(".")
+        if section not in SECTIONS:
+            raise InvalidFields(f"Unknown field '{item}'. Choose from: {', '.join(SECTIONS)}.")
+        if not field:
+            selected[section] = None
+            continue
+        if field not in SECTION_FIELDS[section]:
+            raise InvalidFields(f"Unknown field '{item}'.")
+        if section in selected and selected[section] is None:
+            continue
+        selected.setdefault(section, set()).add(field)
+    return selected
+
+
+def select_fields(data, selected):
+    result = {}
+    for section, fields in selected.items():
+        if section not in data:
+            continue
+        if fields is None:
+            result[section] = data[section]
+        else:
+            result[section] = {field: value for field, value in data[section].items() if field in fields}
+    return result
+
+
+def compute_etag(data):
+    body = json.dumps({key: value for key, value in data.items() if key != "token"}, sort_keys=True, cls=DjangoJSONEncoder)
+    return '"%s"' % hashlib.blake2b(body.encode(), digest_size=16).hexdigest()
+
+
+def etag_matches(if_none_match, etag):
+    # The compression middleware turns our strong ETag into a weak one, compare weakly
+    if not if_none_match:
+        return False
+    tags = parse_etags(if_none_match)
+    if "*" in tags:
+        return True
+    return any(tag.removeprefix("W/") == etag for tag in tags)
@@ -0,0 +1,96 @@
+"""
+Set based account operations.
+
+Every update action runs as a single UPDATE over a queryset inside a
+transaction, so no model save() and no post_save profile cascade is triggered
+per user. "delete" goes through Django's collector instead, so profiles and
+tokens cascade and post_delete receivers run; it is only meant for
+maintenance commands such as purge_unverified_accounts and is not offered by
+the API (API_ACTIONS). Listeners that cache per-user state subscribe to
+``users_bulk_updated`` to drop what they hold for the affected ids.
+
+The transaction covers one database. With sharding enabled the caller runs
+the action once per shard, and a failure on one shard does not roll back the
+shards already done. The action and role are validated before anything is
+written, so a bad request fails on the first shard without changing anything.
+"""
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.dispatch import Signal
+
+from rest_framework.authtoken.models import Token
+
+
+User = get_user_model()
+
+# Sent after a bulk action commits with: action, user_ids, using
+users_bulk_updated = Signal()
+
+
+UPDATE_ACTIONS = {
+    "verify": {"is_verified": True, "code": None},
+    "unverify": {"is_verified": False},
+    "activate": {"is_active": True},
+    "deactivate": {"is_active": False},
+}
+
+# Actions after which existing auth tokens must stop working
+REVOKE_TOKEN_ACTIONS = {"deactivate", "delete"}
+
+BULK_ACTIONS = [*UPDATE_ACTIONS, "set_role", "delete"]
+
+# What bulk_user_operations accepts, hard deletes stay with the maintenance commands
+API_ACTIONS = [*UPDATE_ACTIONS, "set_role"]
+
+# Filters a client may combine to select users instead of listing ids
+ALLOWED_FILTERS = {
+    "role",
+    "is_verified",
+    "is_active",
+    "date_joined__lt",
+    "date_joined__gte",
+}
+
+ROLES = [role for role, _ in User.USER_ROLE]
+
+
+class BulkActionError(ValueError):
+    pass
+
+
+def apply_bulk_action(queryset, action, role=None):
+    """
+    Run ``action`` over every user in ``queryset``.
+    Returns a dict with the number of users matched and rows changed.
+    """
+    if action not in BULK_ACTIONS:
+        raise BulkActionError(f"Unknown action. Expected one of: {', '.join(BULK_ACTIONS)}")
+
+    if action == "set_role":
+        if role not in ROLES:
+            raise BulkActionError(f"role must be one of: {', '.join(ROLES)}")
+        values = {"role": role}
+    else:
+        values = UPDATE_ACTIONS.get(action)
+
+    with transaction.atomic(using=queryset.db):
+        # Only needed for the signal, the statements below filter with the
+        # queryset itself so they stay a single UPDATE/DELETE each.
+        user_ids = list(queryset.values_list("id", flat=True))
+
+        result = {"action": action, "matched": len(user_ids)}
+        if action in REVOKE_TOKEN_ACTIONS:
+            result["tokens_revoked"] = Token.objects.using(queryset.db).filter(user__in=queryset).delete()[0]
+
+        if action == "delete":
+            result["deleted"] = queryset.delete()[1].get(User._meta.label, 0)
+        else:
+            result["updated"] = queryset.update(**values)
+
+        transaction.on_commit(
+            lambda: users_bulk_updated.send(sender=User, action=action, user_ids=user_ids, using=queryset.db),
+            using=queryset.db,
+        )
+
+    return result
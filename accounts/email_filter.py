@@ -0,0 +1,233 @@
+"""
+Shared counting Bloom filter over registered emails.
+
+Lets the views answer "no account with this email" without a database query.
+The filter only ever gives false positives, in which case the view falls back
+to the usual lookup, so a "no" is always right.
+
+The counters live in a memory mapped file (EMAIL_FILTER_PATH, one byte per
+counter) that every worker maps, so an email added by one worker is visible to
+the others straight away. Writers serialize on a lock file. A rebuild writes a
+fresh file and swaps it in; workers notice the new inode and remap it. A
+rebuild only sees committed rows, so an email saved while one runs is added
+again to the new file when its transaction commits.
+
+The header also counts the accounts the filter holds. The first time a process
+uses the filter it compares that with the accounts in the database and
+rebuilds on a mismatch, so whatever server runs the app (gunicorn, runserver,
+uvicorn) never answers from a filter that is missing or predates a database
+restore.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+MAGIC = b"EMB2"
+HEADER = struct.Struct("<4sIIQ")  # magic, slots, hashes, accounts
+MAX_COUNT = 255
+
+
+def normalize_email(email):
+    return (email or "").strip().lower()
+
+
+class EmailFilter:
+
+    def __init__(self, path, slots, hashes):
+        self.path = str(path)
+        self.lock_path = self.path + ".lock"
+        self.slots = slots
+        self.hashes = hashes
+        self._map = None
+        self._inode = None
+
+    def _indexes(self, email):
+        digest = hashlib.blake2b(normalize_email(email).encode(), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return [HEADER.size + (h1 + i * h2) % self.slots for i in range(self.hashes)]
+
+    def _current_map(self):
+        """The mapping of the file currently at self.path, or None if there is none yet."""
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return None
+        if inode != self._inode:
+            with open(self.path, "r+b") as f:
+                new_map = mmap.mmap(f.fileno(), 0)
+            magic, slots, hashes, _ = HEADER.unpack_from(new_map, 0)
+            if magic != MAGIC or slots != self.slots or hashes != self.hashes:
+                # Built with other parameters, ignore it until it is rebuilt
+                new_map.close()
+                return None
+            if self._map is not None:
+                self._map.close()
+            self._map, self._inode = new_map, inode
+        return self._map
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _count(self, counters, delta):
+        magic, slots, hashes, accounts = HEADER.unpack_from(counters, 0)
+        HEADER.pack_into(counters, 0, magic, slots, hashes, max(0, accounts + delta))
+
+    @property
+    def ready(self):
+        return self._current_map() is not None
+
+    @property
+    def accounts(self):
+        """How many accounts the filter holds, None when there is no filter yet."""
+        counters = self._current_map()
+        return None if counters is None else HEADER.unpack_from(counters, 0)[3]
+
+    def might_contain(self, email):
+        counters = self._current_map()
+        if counters is None:
+            return True
+        return all(counters[index] for index in self._indexes(email))
+
+    def add(self, email, new_account=True):
+        """
+        ``new_account`` is False when an existing account changed its email.
+        Returns the inode of the filter that was added to, for add_if_rebuilt().
+        """
+        with self._locked():
+            counters = self._current_map()
+            if counters is not None:
+                self._add(counters, email, new_account)
+            return self._inode if counters is not None else None
+
+    def add_if_rebuilt(self, email, inode, new_account=True):
+        """
+        Add again if the filter was rebuilt since add() returned ``inode``. A
+        rebuild only reads committed rows, so one that ran while the row was
+        being written has dropped it.
+        """
+        with self._locked():
+            counters = self._current_map()
+            if counters is not None and self._inode != inode:
+                self._add(counters, email, new_account)
+
+    def _add(self, counters, email, new_account):
+        for index in self._indexes(email):
+            if counters[index] < MAX_COUNT:
+                counters[index] += 1
+        if new_account:
+            self._count(counters, 1)
+
+    def remove(self, email):
+        with self._locked():
+            counters = self._current_map()
+            if counters is None:
+                return
+            indexes = self._indexes(email)
+            if not all(counters[index] for index in indexes):
+                return
+            for index in indexes:
+                # A saturated counter no longer knows its true count
+                if counters[index] < MAX_COUNT:
+                    counters[index] -= 1
+            self._count(counters, -1)
+
+    def rebuild(self, emails):
+        """
+        Replace the filter with one built from ``emails``.
+        The lock is held throughout so no add or remove is lost.
+        """
+        with self._locked():
+            counters = bytearray(HEADER.size + self.slots)
+            count = 0
+            for email in emails:
+                for index in self._indexes(email):
+                    if counters[index] < MAX_COUNT:
+                        counters[index] += 1
+                count += 1
+            HEADER.pack_into(counters, 0, MAGIC, self.slots, self.hashes, count)
+
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(counters)
+            os.replace(tmp_path, self.path)
+        return count
+
+
+_filters = {}
+_checked = set()
+_check_lock = threading.Lock()
+
+
+def get_email_filter():
+    path = str(settings.EMAIL_FILTER_PATH)
+    if path not in _filters:
+        _filters[path] = EmailFilter(path, settings.EMAIL_FILTER_SLOTS, settings.EMAIL_FILTER_HASHES)
+    return _filters[path]
+
+
+def email_may_exist(email):
+    """False only when no account can have this email."""
+    if not settings.EMAIL_FILTER_ENABLED:
+        return True
+    check_email_filter()
+    return get_email_filter().might_contain(email)
+
+
+def check_email_filter():
+    """
+    Once per process and filter file: rebuild the filter when it is missing,
+    was built with other parameters or doesn't hold as many accounts as the
+    database has.
+    """
+    email_filter = get_email_filter()
+    if email_filter.path in _checked:
+        return
+    with _check_lock:
+        if email_filter.path in _checked:
+            return
+        if email_filter.accounts != count_accounts():
+            rebuild_email_filter()
+        else:
+            _checked.add(email_filter.path)
+
+
+def count_accounts():
+    from django.contrib.auth import get_user_model
+
+    from .sharding import user_databases
+
+    User = get_user_model()
+    return sum(User.objects.using(alias).count() for alias in user_databases())
+
+
+def rebuild_email_filter():
+    from itertools import chain
+
+    from django.contrib.auth import get_user_model
+
+    from .sharding import user_databases
+
+    User = get_user_model()
+    emails = chain.from_iterable(
+        User.objects.using(alias).values_list("email", flat=True).iterator(chunk_size=5000)
+        for alias in user_databases()
+    )
+    email_filter = get_email_filter()
+    count = email_filter.rebuild(emails)
+    _checked.add(email_filter.path)
+    return count
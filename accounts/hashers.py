@@ -0,0 +1,121 @@
+"""
+Password hashers whose cost is calibrated for the host.
+
+``manage.py calibrate_hashers`` times every available algorithm on this
+machine and writes the cost that fits PASSWORD_HASH_BUDGET_MS to
+PASSWORD_HASH_CALIBRATION_PATH. The hashers below read that file (again when
+it changes) and never go below MINIMUM_COSTS. Without a calibration file they
+behave like the Django hashers they extend.
+
+A stored hash whose cost is off the calibrated one by more than
+REHASH_TOLERANCE is rehashed by Django on the next successful
+check_password(), so logins move every account to the current cost (or
+algorithm, PASSWORD_HASHERS[0]) without anyone resetting a password.
+"""
+
+import json
+import os
+
+from django.conf import settings
+from django.contrib.auth.hashers import Argon2PasswordHasher, PBKDF2PasswordHasher, ScryptPasswordHasher, must_update_salt
+
+
+# Below these an offline attack on a leaked table gets too cheap, whatever the budget says.
+# PBKDF2 never goes below Django's own default, which rises with every release.
+MINIMUM_COSTS = {
+    "pbkdf2_sha256": {"iterations": PBKDF2PasswordHasher.iterations},
+    "scrypt": {"work_factor": 2 ** 14},
+    "argon2": {"time_cost": 2, "memory_cost": 19 * 1024},
+}
+
+# Costs within 10% of the calibrated one are left alone, hosts never calibrate to the exact same number
+REHASH_TOLERANCE = 0.1
+
+
+_calibration = {}  # path -> (mtime_ns, data)
+
+
+def load_calibration():
+    path = str(settings.PASSWORD_HASH_CALIBRATION_PATH)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    cached = _calibration.get(path)
+    if cached is None or cached[0] != mtime:
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        cached = _calibration[path] = (mtime, data)
+    return cached[1]
+
+
+def calibrated_cost(algorithm, name, default):
+    params = load_calibration().get("hashers", {}).get(algorithm, {}).get("params", {})
+    return max(params.get(name, default), MINIMUM_COSTS[algorithm].get(name, 0))
+
+
+def off_by_more_than_tolerance(stored, target, slack=0):
+    # slack: a difference that is always tolerated, for costs as small as argon2's time_cost
+    return abs(stored - target) > max(target * REHASH_TOLERANCE, slack)
+
+
+class CalibratedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+
+    @property
+    def iterations(self):
+        return calibrated_cost(self.algorithm, "iterations", PBKDF2PasswordHasher.iterations)
+
+    def must_update(self, encoded):
+        decoded = self.decode(encoded)
+        return (
+            off_by_more_than_tolerance(decoded["iterations"], self.iterations)
+            or must_update_salt(decoded["salt"], self.salt_entropy)
+        )
+
+
+class CalibratedScryptPasswordHasher(ScryptPasswordHasher):
+    # A ceiling for OpenSSL (whose default of 32MB is below 2 ** 15), nothing is allocated up front
+    maxmem = 1024 * 1024 * 1024
+
+    @property
+    def work_factor(self):
+        return calibrated_cost(self.algorithm, "work_factor", ScryptPasswordHasher.work_factor)
+
+    def must_update(self, encoded):
+        decoded = self.decode(encoded)
+        return (
+            off_by_more_than_tolerance(decoded["work_factor"], self.work_factor)
+            or decoded["block_size"] != self.block_size
+            or decoded["parallelism"] != self.parallelism
+            or must_update_salt(decoded["salt"], self.salt_entropy)
+        )
+
+
+class CalibratedArgon2PasswordHasher(Argon2PasswordHasher):
+    """Only usable with argon2-cffi installed, like the Django one."""
+
+    @property
+    def time_cost(self):
+        return calibrated_cost(self.algorithm, "time_cost", Argon2PasswordHasher.time_cost)
+
+    @property
+    def memory_cost(self):
+        return calibrated_cost(self.algorithm, "memory_cost", Argon2PasswordHasher.memory_cost)
+
+    @property
+    def parallelism(self):
+        return calibrated_cost(self.algorithm, "parallelism", Argon2PasswordHasher.parallelism)
+
+    def must_update(self, encoded):
+        decoded = self.decode(encoded)
+        stored, current = decoded["params"], self.params()
+        return (
+            off_by_more_than_tolerance(stored.time_cost, current.time_cost, slack=1)
+            or off_by_more_than_tolerance(stored.memory_cost, current.memory_cost)
+            or (stored.parallelism, stored.hash_len, stored.type, stored.version)
+            != (current.parallelism, current.hash_len, current.type, current.version)
+            or must_update_salt(decoded["salt"], self.salt_entropy)
+        )
@@ -0,0 +1,103 @@
+"""
+Idempotency-Key support for POST views.
+
+A client that retries a request sends the same ``Idempotency-Key`` header. The
+first request runs the view and, when it succeeds, its response is kept in the
+cache for IDEMPOTENCY_TTL seconds. Replays with the same key and payload get the
+stored response back without running the view again. Keys are scoped to the
+view and the authenticated user, and a key reused with a different payload
+gets a 422. A replay that arrives while the first request is still running
+gets a 409 with Retry-After, it does not hold a worker while waiting.
+"""
+
+import hashlib
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+
+from rest_framework import status
+from rest_framework.response import Response
+
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+
+def get_cache():
+    return caches[getattr(settings, "IDEMPOTENCY_CACHE", "default")]
+
+
+def request_fingerprint(request):
+    """Hash of the parsed payload, so a key cannot be reused for a different request."""
+    data = request.data
+    if hasattr(data, "lists"):
+        data = {key: values for key, values in data.lists()}
+    payload = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def replay(stored):
+    _, status_code, data = stored
+    response = Response(data, status=status_code)
+    response[REPLAYED_HEADER] = "true"
+    return response
+
+
+def mismatch():
+    return Response({"detail": f"{IDEMPOTENCY_HEADER} was already used with a different request."}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+
+def idempotent(view):
+    """
+    Make a function based view honour the Idempotency-Key header.
+    Must be applied below ``@api_view`` so it receives a DRF request.
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view(request, *args, **kwargs)
+
+        if len(key) > MAX_KEY_LENGTH:
+            return Response({"detail": f"{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters."}, status=status.HTTP_400_BAD_REQUEST)
+
+        cache = get_cache()
+        ttl = getattr(settings, "IDEMPOTENCY_TTL", 60 * 60 * 24)
+        lock_timeout = getattr(settings, "IDEMPOTENCY_LOCK_TIMEOUT", 30)
+
+        digest = hashlib.sha256(key.encode()).hexdigest()[:32]
+        owner = request.user.pk if request.user.is_authenticated else "anonymous"
+        result_key = f"idempotency:{view.__name__}:{owner}:{digest}"
+        lock_key = f"{result_key}:lock"
+        fingerprint = request_fingerprint(request)
+
+        stored = cache.get(result_key)
+        if stored is None:
+            # Only one request per key gets to run the view, the others are told to come back
+            if not cache.add(lock_key, fingerprint, timeout=lock_timeout):
+                if cache.get(lock_key, fingerprint) != fingerprint:
+                    return mismatch()
+                return Response({"detail": "A request with this Idempotency-Key is still being processed."}, status=status.HTTP_409_CONFLICT, headers={"Retry-After": "1"})
+            # The first request may have finished between the get and the add
+            stored = cache.get(result_key)
+            if stored is not None:
+                cache.delete(lock_key)
+        if stored is not None:
+            if stored[0] != fingerprint:
+                return mismatch()
+            return replay(stored)
+
+        try:
+            response = view(request, *args, **kwargs)
+            # Failures are not stored so that the client can retry them
+            if 200 <= response.status_code < 300:
+                cache.set(result_key, (fingerprint, response.status_code, response.data), timeout=ttl)
+            return response
+        finally:
+            cache.delete(lock_key)
+
+    return wrapper
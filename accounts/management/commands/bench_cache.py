@@ -0,0 +1,123 @@
+import multiprocessing
+import random
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+
+# A cached profile sized payload
+VALUE = {
+    "id": 42,
+    "email": "cashier@example.com",
+    "first_name": "Ada",
+    "last_name": "Obi",
+    "image_url": "https://res.cloudinary.com/demo/image/upload/v1/profile.jpg",
+    "permissions": {"is_superuser": False, "is_manager": False, "is_cashier": True, "is_verified": True},
+}
+
+
+def backends(directory):
+    return [
+        ("locmem", "django.core.cache.backends.locmem.LocMemCache", "bench"),
+        ("filebased", "django.core.cache.backends.filebased.FileBasedCache", f"{directory}/files"),
+        ("sqlite", "inventory_kooltech_be.sqlite_cache.SQLiteCache", f"{directory}/cache.sqlite3"),
+    ]
+
+
+def run_worker(index, backend, location, options, barrier, results):
+    cache = import_string(backend)(location, {"TIMEOUT": 300, "OPTIONS": {"MAX_ENTRIES": 100000}})
+    rng = random.Random(index)
+
+    # Worker 0 fills the cache, the others look at what they can see of it
+    if index == 0:
+        cache.set_many({f"shared:{i}": VALUE for i in range(options["shared"])})
+        cache.set("counter", 0)
+    barrier.wait()
+    visible = 0
+    if index != 0:
+        visible = len(cache.get_many([f"shared:{i}" for i in range(options["shared"])]))
+
+    # Cache aside over a key space every worker reads: get, on a miss set
+    hits = misses = increments = 0
+    started = time.perf_counter()
+    for _ in range(options["operations"]):
+        roll = rng.random()
+        if roll < 0.01:
+            try:
+                cache.incr("counter")
+                increments += 1
+            except ValueError:
+                cache.set("counter", 1)
+                increments += 1
+        else:
+            key = f"key:{rng.randrange(options['keys'])}"
+            if cache.get(key) is None:
+                misses += 1
+                cache.set(key, VALUE)
+            else:
+                hits += 1
+    elapsed = time.perf_counter() - started
+
+    barrier.wait()
+    results.put({
+        "index": index,
+        "elapsed": elapsed,
+        "hits": hits,
+        "misses": misses,
+        "increments": increments,
+        "visible": visible,
+        "counter": cache.get("counter"),
+    })
+
+
+class Command(BaseCommand):
+    help = "Throughput and cross-worker visibility of LocMem, file based and SQLite caches under several processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=4)
+        parser.add_argument("--operations", type=int, default=5000, help="Per process")
+        parser.add_argument("--keys", type=int, default=2000)
+        parser.add_argument("--shared", type=int, default=200, help="Keys written by one worker and read by the others")
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context("fork")
+        processes = options["processes"]
+        directory = tempfile.mkdtemp()
+        try:
+            self.stdout.write(
+                f"{processes} processes x {options['operations']} operations, {options['keys']} keys\n"
+                f"{'backend':<10} {'ops/s':>9} {'us/op':>7} {'hit rate':>9} {'visible':>8} {'counter':>15}"
+            )
+            for name, backend, location in backends(directory):
+                barrier = context.Barrier(processes)
+                results = context.Queue()
+                workers = [
+                    context.Process(target=run_worker, args=(i, backend, location, options, barrier, results))
+                    for i in range(processes)
+                ]
+                for worker in workers:
+                    worker.start()
+                runs = [results.get() for _ in workers]
+                for worker in workers:
+                    worker.join()
+                self.report(name, runs, options)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def report(self, name, runs, options):
+        total = options["operations"] * len(runs)
+        slowest = max(run["elapsed"] for run in runs)
+        hits = sum(run["hits"] for run in runs)
+        lookups = hits + sum(run["misses"] for run in runs)
+        readers = len(runs) - 1
+        visible = sum(run["visible"] for run in runs) / (options["shared"] * readers) if readers else 1
+        # What one worker reads back against the increments all of them made
+        increments = sum(run["increments"] for run in runs)
+        counter = max(run["counter"] or 0 for run in runs)
+        self.stdout.write(
+            f"{name:<10} {total / slowest:>9.0f} {slowest / options['operations'] * 1e6:>7.1f} "
+            f"{hits / lookups:>9.1%} {visible:>8.0%} {f'{counter}/{increments}':>15}"
+        )
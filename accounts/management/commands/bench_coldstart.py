@@ -0,0 +1,68 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+
+# Requests replayed against a fresh process. None of them write to the database.
+BENCH_REQUESTS = [
+    ("post", "/auth/login/", {"email": "nobody@example.com", "password": "not-a-real-password"}),
+    ("post", "/auth/login/", {"email": "invalid-email", "password": "x"}),
+    ("get", "/auth/profile/", None),
+]
+
+
+class Command(BaseCommand):
+    help = "Compare first-request latency of a cold process against one warmed up like a gunicorn worker"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5, help="Fresh processes to start per mode")
+        parser.add_argument("--child", choices=["cold", "warm"], help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options["child"]:
+            return self.run_child(options["child"] == "warm")
+
+        results = {"cold": [], "warm": []}
+        for _ in range(options["runs"]):
+            for mode in results:
+                output = subprocess.run(
+                    [sys.executable, str(settings.BASE_DIR / "manage.py"), "bench_coldstart", "--child", mode],
+                    capture_output=True, text=True, check=True,
+                ).stdout
+                results[mode].append(json.loads(output.strip().splitlines()[-1]))
+
+        self.stdout.write(f"{'mode':<6} {'warm-up ms':>11} {'1st req ms':>11} {'2nd req ms':>11} {'3rd req ms':>11}")
+        for mode, runs in results.items():
+            warm_up = statistics.median(run["warm_up"] for run in runs)
+            columns = [statistics.median(run["requests"][i] for run in runs) for i in range(len(BENCH_REQUESTS))]
+            self.stdout.write(f"{mode:<6} {warm_up:>11.2f} " + " ".join(f"{c:>11.2f}" for c in columns))
+
+    def run_child(self, warm):
+        client = Client()
+        # Gunicorn loads the middleware chain when the app is imported
+        client.handler.load_middleware()
+
+        started = time.perf_counter()
+        if warm:
+            from inventory_kooltech_be.warmup import warm_up
+
+            warm_up()
+        warm_up_ms = (time.perf_counter() - started) * 1000
+
+        timings = []
+        for method, path, data in BENCH_REQUESTS:
+            started = time.perf_counter()
+            if data is None:
+                getattr(client, method)(path)
+            else:
+                getattr(client, method)(path, data=data, content_type="application/json")
+            timings.append((time.perf_counter() - started) * 1000)
+
+        self.stdout.write(json.dumps({"warm_up": warm_up_ms, "requests": timings}))
@@ -0,0 +1,74 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory
+
+from inventory_kooltech_be.middleware import CompressionMiddleware, brotli
+
+
+def sample_user(index):
+    return {
+        "id": index,
+        "email": f"cashier{index}@store{index % 40}.example.com",
+        "first_name": "Cashier",
+        "last_name": f"Number {index}",
+        "birth_date": "1990-01-01",
+        "image_url": "https://res.cloudinary.com/daf9tr3lf/image/upload/v1725024497/undraw_profile_male_oovdba.svg",
+        "bio": None,
+        "role": "cashier" if index % 10 else "manager",
+        "permissions": {
+            "is_superuser": False,
+            "is_manager": index % 10 == 0,
+            "is_cashier": index % 10 != 0,
+            "is_verified": True,
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = "Report bytes saved against CPU time spent by CompressionMiddleware"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 5000], help="Users per payload")
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        factory = RequestFactory()
+        encodings = ["gzip"] + (["br"] if brotli is not None else [])
+        if brotli is None:
+            self.stdout.write("brotli is not installed, only gzip is measured")
+
+        self.stdout.write(f"{'payload':>16} {'encoding':>8} {'bytes in':>10} {'bytes out':>10} {'saved':>7} {'cpu ms':>8}")
+        for size in options["sizes"]:
+            body = json.dumps([sample_user(i) for i in range(size)]).encode()
+            for encoding in encodings:
+                request = factory.get("/", HTTP_ACCEPT_ENCODING=encoding)
+                middleware = CompressionMiddleware(lambda request: HttpResponse(body, content_type="application/json"))
+
+                started = time.process_time()
+                for _ in range(options["repeat"]):
+                    response = middleware(request)
+                cpu_ms = (time.process_time() - started) * 1000 / options["repeat"]
+
+                compressed = response.get("Content-Encoding") == encoding
+                out = len(response.content)
+                saved = 100 * (1 - out / len(body))
+                label = f"{size} users" if compressed else f"{size} users (skip)"
+                self.stdout.write(f"{label:>16} {encoding:>8} {len(body):>10} {out:>10} {saved:>6.1f}% {cpu_ms:>8.3f}")
+
+        # Streaming: each chunk is flushed as soon as it is compressed
+        chunks = [json.dumps(sample_user(i)).encode() + b"\n" for i in range(1000)]
+        for encoding in encodings:
+            request = factory.get("/", HTTP_ACCEPT_ENCODING=encoding)
+            middleware = CompressionMiddleware(
+                lambda request: StreamingHttpResponse(iter(chunks), content_type="application/json")
+            )
+            started = time.process_time()
+            response = middleware(request)
+            out = sum(len(part) for part in response.streaming_content)
+            cpu_ms = (time.process_time() - started) * 1000
+            total = sum(len(chunk) for chunk in chunks)
+            saved = 100 * (1 - out / total)
+            self.stdout.write(f"{'1000 (stream)':>16} {encoding:>8} {total:>10} {out:>10} {saved:>6.1f}% {cpu_ms:>8.3f}")
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Signup write throughput with N worker processes against 1, 2, 4... account shards. "
+        "Every run uses fresh shard files in a temporary directory, db.sqlite3 is not touched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shards", default="1,2,4", help="Comma separated shard counts to compare")
+        parser.add_argument("--processes", type=int, default=8, help="Concurrent writer processes")
+        parser.add_argument("--signups", type=int, default=300, help="Accounts created by each process")
+        parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+        parser.add_argument("--start-at", type=float, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options["child"] is not None:
+            return self.run_child(options["child"], options["signups"], options["start_at"])
+
+        manage = str(settings.BASE_DIR / "manage.py")
+        baseline = None
+        self.stdout.write(f"{'shards':>6} {'signups/s':>10} {'speed-up':>9}")
+        for shards in [int(n) for n in options["shards"].split(",")]:
+            with tempfile.TemporaryDirectory() as directory:
+                env = {
+                    **os.environ,
+                    "ACCOUNTS_SHARDS": str(shards),
+                    "ACCOUNTS_SHARD_DIR": directory,
+                    "EMAIL_FILTER_PATH": os.path.join(directory, "email_filter.bin"),
+                    "AUDIT_LOG_ENABLED": "False",
+                }
+                for i in range(shards):
+                    subprocess.run(
+                        [sys.executable, manage, "migrate", "--database", f"accounts_{i}"],
+                        env=env, check=True, capture_output=True,
+                    )
+
+                # Workers wait for a common start time so Django start up isn't measured
+                start_at = time.time() + 3
+                workers = [
+                    subprocess.Popen(
+                        [sys.executable, manage, "bench_sharding", "--child", str(i),
+                         "--signups", str(options["signups"]), "--start-at", str(start_at)],
+                        env=env, stdout=subprocess.PIPE, text=True,
+                    )
+                    for i in range(options["processes"])
+                ]
+                finished = [json.loads(worker.communicate()[0].strip().splitlines()[-1])["finished"] for worker in workers]
+
+            throughput = options["processes"] * options["signups"] / (max(finished) - start_at)
+            baseline = baseline or throughput
+            self.stdout.write(f"{shards:>6} {throughput:>10.0f} {throughput / baseline:>8.2f}x")
+
+    def run_child(self, worker, signups, start_at):
+        from django.contrib.auth import get_user_model
+
+        User = get_user_model()
+        time.sleep(max(0, start_at - time.time()))
+        # No password, hashing cost doesn't depend on the storage layout
+        for i in range(signups):
+            User.objects.create_user(f"bench-{worker}-{i}@example.com")
+        self.stdout.write(json.dumps({"finished": time.time()}))
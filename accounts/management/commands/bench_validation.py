@@ -0,0 +1,89 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.helpers import check_email, check_password
+from accounts.schemas import LoginRequest, RegistrationRequest, VerificationRequest, validate_request
+
+
+REGISTRATION = {
+    "email": "new.cashier@example.com",
+    "password": "Str0ng-Passw0rd!",
+    "password2": "Str0ng-Passw0rd!",
+    "first_name": "New",
+    "last_name": "Cashier",
+    "phone_number": "+2348000000000",
+    "gender": "female",
+    "address": "Lagos",
+    "birth_date": "1990-04-01",
+    "bio": "Hello",
+}
+LOGIN = {"email": "new.cashier@example.com", "password": "Str0ng-Passw0rd!"}
+VERIFICATION = {"user_id": "42", "code": "1234"}
+INVALID_REGISTRATION = {**REGISTRATION, "email": "not-an-email", "gender": "other"}
+
+
+# What the views did before accounts.schemas, kept here for comparison
+
+def legacy_registration(data):
+    email = data.get("email")
+    password = data.get("password", None)
+    password2 = data.get("password2", None)
+    first_name = data.get("first_name", None)
+    last_name = data.get("last_name", None)
+    gender = data.get("gender")
+    if not email or not password or not password2 or password != password2:
+        return False
+    if gender not in ["male", "female"]:
+        return False
+    if not all([first_name, last_name]):
+        return False
+    email_valid_status = check_email(email)
+    password_valid_status = check_password(password)
+    return email_valid_status.status and password_valid_status.status
+
+
+def legacy_login(data):
+    email = data.get("email")
+    password = data.get("password")
+    if not all([email, password]):
+        return False
+    return check_email(email).status and check_password(password).status
+
+
+def legacy_verification(data):
+    # The old view did no validation, user_id and code went straight to the ORM
+    return data.get("code"), data.get("user_id")
+
+
+CASES = [
+    ("registration", REGISTRATION, legacy_registration, RegistrationRequest),
+    ("registration (invalid)", INVALID_REGISTRATION, legacy_registration, RegistrationRequest),
+    ("login", LOGIN, legacy_login, LoginRequest),
+    ("verification", VERIFICATION, legacy_verification, VerificationRequest),
+]
+
+
+class Command(BaseCommand):
+    help = "Per-request cost of validating account payloads with the compiled schemas vs the old if chains"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        iterations = options["iterations"]
+        self.stdout.write(f"{'payload':<24} {'if chains us':>13} {'schema us':>10}")
+        for name, data, legacy, schema in CASES:
+            # First calls load the password validators and the common password list
+            legacy(data)
+            validate_request(schema, data)
+
+            legacy_us = self.time(lambda: legacy(data), iterations)
+            schema_us = self.time(lambda: validate_request(schema, data), iterations)
+            self.stdout.write(f"{name:<24} {legacy_us:>13.2f} {schema_us:>10.2f}")
+
+    def time(self, func, iterations):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        return (time.perf_counter() - started) / iterations * 1e6
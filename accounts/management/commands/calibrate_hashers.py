@@ -0,0 +1,157 @@
+import json
+import os
+import platform
+import statistics
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import Argon2PasswordHasher, PBKDF2PasswordHasher, ScryptPasswordHasher
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from accounts.hashers import MINIMUM_COSTS
+
+
+PASSWORD = "Calibrati0n-Passw0rd!"
+SALT = "abcdefghijklmnopqrstuv"
+KB = 1024
+MB = 1024 * 1024
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+class Command(BaseCommand):
+    help = "Time the password hashers on this host and write the cost that fits the login latency budget"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--budget-ms", type=float, default=settings.PASSWORD_HASH_BUDGET_MS,
+                            help="Time one hash may take on one core")
+        parser.add_argument("--max-memory-mb", type=int, default=64,
+                            help="Memory one scrypt/argon2 hash may use, every concurrent login needs this much")
+        parser.add_argument("--samples", type=int, default=3)
+        parser.add_argument("--dry-run", action="store_true", help="Report without writing the calibration file")
+
+    def handle(self, *args, **options):
+        self.budget = options["budget_ms"]
+        self.max_memory = options["max_memory_mb"] * MB
+        self.samples = options["samples"]
+        cores = os.cpu_count() or 1
+
+        results = {}
+        for algorithm, calibrate in [
+            ("pbkdf2_sha256", self.calibrate_pbkdf2),
+            ("scrypt", self.calibrate_scrypt),
+            ("argon2", self.calibrate_argon2),
+        ]:
+            result = calibrate()
+            if result is None:
+                self.stdout.write(f"{algorithm:<14} skipped, argon2-cffi is not installed")
+                continue
+            results[algorithm] = result
+
+        self.stdout.write(f"\n{cpu_model()}, {cores} cores, budget {self.budget:g} ms per hash\n")
+        self.stdout.write(f"{'hasher':<14} {'cost':<40} {'ms':>8} {'hashes/s/core':>14} {'hashes/s host':>14}")
+        for algorithm, result in results.items():
+            cost = ", ".join(f"{name}={value}" for name, value in result["params"].items())
+            self.stdout.write(
+                f"{algorithm:<14} {cost:<40} {result['ms']:>8.1f} "
+                f"{result['hashes_per_second_per_core']:>14.2f} {result['hashes_per_second_per_core'] * cores:>14.1f}"
+            )
+            if result["floored"]:
+                self.stdout.write(self.style.WARNING(
+                    f"  {algorithm}: the minimum cost takes longer than the budget, logins will take {result['ms']:.0f} ms"
+                ))
+
+        if options["dry_run"]:
+            return
+
+        path = str(settings.PASSWORD_HASH_CALIBRATION_PATH)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = {
+            "calibrated_at": timezone.now().isoformat(),
+            "host": platform.node(),
+            "cpu": cpu_model(),
+            "cores": cores,
+            "budget_ms": self.budget,
+            "hashers": results,
+        }
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(path + ".tmp", path)
+        self.stdout.write(self.style.SUCCESS(f"\nWrote {path}, used by accounts.hashers from the next password check"))
+
+    def time(self, hasher, **params):
+        """Median wall and CPU milliseconds of one hash."""
+        wall, cpu = [], []
+        for _ in range(self.samples):
+            started, started_cpu = time.perf_counter(), time.process_time()
+            hasher.encode(PASSWORD, SALT, **params)
+            wall.append((time.perf_counter() - started) * 1000)
+            cpu.append((time.process_time() - started_cpu) * 1000)
+        return statistics.median(wall), statistics.median(cpu)
+
+    def result(self, algorithm, params, wall_ms, cpu_ms):
+        floor = MINIMUM_COSTS[algorithm]
+        floored = any(params.get(name, 0) <= value for name, value in floor.items()) and wall_ms > self.budget
+        return {
+            "params": params,
+            "ms": round(wall_ms, 2),
+            # Argon2 with parallelism > 1 spreads one hash over several cores
+            "hashes_per_second_per_core": round(1000 / max(cpu_ms, wall_ms, 0.001), 2),
+            "floored": floored,
+        }
+
+    def calibrate_pbkdf2(self):
+        # Cost is linear in iterations: time a sample, scale, then time the result
+        hasher = PBKDF2PasswordHasher()
+        sample = 100_000
+        wall, _ = self.time(hasher, iterations=sample)
+        iterations = int(sample * self.budget / wall) // 10_000 * 10_000
+        iterations = max(iterations, MINIMUM_COSTS["pbkdf2_sha256"]["iterations"])
+        wall, cpu = self.time(hasher, iterations=iterations)
+        return self.result("pbkdf2_sha256", {"iterations": iterations}, wall, cpu)
+
+    def calibrate_scrypt(self):
+        # Work factor must be a power of two, double it while the next one still fits
+        hasher = ScryptPasswordHasher()
+        hasher.maxmem = 2 * self.max_memory
+        block_size = hasher.block_size
+        work_factor = MINIMUM_COSTS["scrypt"]["work_factor"]
+        wall, cpu = self.time(hasher, n=work_factor)
+        while 128 * work_factor * 2 * block_size <= self.max_memory and wall * 2 <= self.budget:
+            next_wall, next_cpu = self.time(hasher, n=work_factor * 2)
+            if next_wall > self.budget:
+                break
+            work_factor, wall, cpu = work_factor * 2, next_wall, next_cpu
+        params = {"work_factor": work_factor, "block_size": block_size, "parallelism": hasher.parallelism}
+        return self.result("scrypt", params, wall, cpu)
+
+    def calibrate_argon2(self):
+        try:
+            import argon2  # noqa: F401
+        except ImportError:
+            return None
+
+        # Memory is the expensive part for an attacker: take as much as allowed, then raise passes
+        hasher = Argon2PasswordHasher()
+        hasher.memory_cost = max(min(Argon2PasswordHasher.memory_cost, self.max_memory // KB), MINIMUM_COSTS["argon2"]["memory_cost"])
+        hasher.time_cost = MINIMUM_COSTS["argon2"]["time_cost"]
+        wall, cpu = self.time(hasher)
+        while True:
+            hasher.time_cost += 1
+            next_wall, next_cpu = self.time(hasher)
+            if next_wall > self.budget:
+                hasher.time_cost -= 1
+                break
+            wall, cpu = next_wall, next_cpu
+        params = {"time_cost": hasher.time_cost, "memory_cost": hasher.memory_cost, "parallelism": hasher.parallelism}
+        return self.result("argon2", params, wall, cpu)
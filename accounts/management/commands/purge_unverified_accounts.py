@@ -0,0 +1,122 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from rest_framework.authtoken.models import Token
+
+from accounts.bulk import apply_bulk_action
+from accounts.sharding import user_databases
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete unverified accounts older than --days together with their profile and token, "
+        "then ANALYZE and vacuum the database, on every database that holds users. Meant to run "
+        "from cron, or pass --every to keep it running as its own scheduler."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.UNVERIFIED_ACCOUNT_TTL_DAYS)
+        parser.add_argument("--chunk-size", type=int, default=200, help="Accounts deleted per transaction")
+        parser.add_argument("--pause", type=float, default=0.05, help="Seconds to sleep between chunks so other writers get the lock")
+        parser.add_argument("--database", help="Only purge this database, by default every database that holds users")
+        parser.add_argument("--dry-run", action="store_true")
+        parser.add_argument("--full-vacuum", action="store_true", help="Run a full VACUUM when incremental vacuum is not enabled")
+        parser.add_argument("--every", type=int, default=0, help="Repeat every N minutes instead of exiting")
+        parser.add_argument(
+            "--revoke-inactive-tokens",
+            action="store_true",
+            help="Also delete the tokens of deactivated users. Off by default: a deactivated user's token is "
+            "already rejected at authentication, and keeping it lets a reactivated user's clients stay signed in",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self.run_once(options)
+            if not options["every"]:
+                break
+            time.sleep(options["every"] * 60)
+
+    def run_once(self, options):
+        databases = [options["database"]] if options["database"] else user_databases()
+        for database in databases:
+            if len(databases) > 1:
+                self.stdout.write(f"Purging {database}")
+            self.purge(database, options)
+
+    def purge(self, database, options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        stale = User.objects.using(database).filter(
+            is_verified=False,
+            is_staff=False,
+            is_superuser=False,
+            date_joined__lt=cutoff,
+        )
+
+        if options["dry_run"]:
+            self.stdout.write(f"{stale.count()} unverified accounts older than {options['days']} days would be deleted")
+            return
+
+        size_before = self.database_size(database)
+
+        deleted = 0
+        while True:
+            ids = list(stale.order_by("id").values_list("id", flat=True)[:options["chunk_size"]])
+            if not ids:
+                break
+            # Each chunk is its own short transaction
+            result = apply_bulk_action(User.objects.using(database).filter(id__in=ids), "delete")
+            deleted += result["deleted"]
+            time.sleep(options["pause"])
+
+        self.stdout.write(f"Deleted {deleted} stale unverified accounts")
+
+        if options["revoke_inactive_tokens"]:
+            inactive = Token.objects.using(database).filter(user__is_active=False)
+            revoked = 0
+            while True:
+                keys = list(inactive.values_list("key", flat=True)[:options["chunk_size"]])
+                if not keys:
+                    break
+                revoked += Token.objects.using(database).filter(key__in=keys).delete()[0]
+                time.sleep(options["pause"])
+            self.stdout.write(f"Deleted {revoked} tokens of inactive users")
+
+        if connections[database].vendor == "sqlite":
+            self.compact_sqlite(database, options["full_vacuum"])
+            size_after = self.database_size(database)
+            self.stdout.write(f"Database size {size_before} -> {size_after} bytes, reclaimed {size_before - size_after} bytes")
+
+    def database_size(self, database):
+        if connections[database].vendor != "sqlite":
+            return 0
+        with connections[database].cursor() as cursor:
+            cursor.execute("PRAGMA page_count")
+            page_count = cursor.fetchone()[0]
+            cursor.execute("PRAGMA page_size")
+            page_size = cursor.fetchone()[0]
+        return page_count * page_size
+
+    def compact_sqlite(self, database, full_vacuum):
+        with connections[database].cursor() as cursor:
+            cursor.execute("ANALYZE")
+            cursor.execute("PRAGMA auto_vacuum")
+            auto_vacuum = cursor.fetchone()[0]
+            # 2 = INCREMENTAL: free pages can be returned without rewriting the file
+            if auto_vacuum == 2:
+                cursor.execute("PRAGMA incremental_vacuum")
+                cursor.fetchall()
+            elif full_vacuum:
+                # Switching to incremental needs one full VACUUM, later runs are cheap
+                cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                cursor.execute("VACUUM")
+            else:
+                self.stdout.write("Incremental vacuum is not enabled on this database, run with --full-vacuum once to enable it")
@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.email_filter import rebuild_email_filter, get_email_filter
+
+
+class Command(BaseCommand):
+    help = "Rebuild the shared email Bloom filter from the accounts table"
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        count = rebuild_email_filter()
+        elapsed = (time.perf_counter() - started) * 1000
+        self.stdout.write(f"Rebuilt {get_email_filter().path} with {count} emails in {elapsed:.1f} ms")
@@ -0,0 +1,86 @@
+import os
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.email_filter import rebuild_email_filter
+from accounts.sharding import database_for_user, is_sharded, move_users, shard_aliases, user_databases
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Move every account to the shard its email hashes to, staff and superusers to the default database. "
+        "Run it after turning sharding on (moves accounts out of the default database) and after changing ACCOUNTS_SHARDS. "
+        "--init creates and migrates the shard databases first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--init", action="store_true", help="Create and migrate the shard databases")
+        parser.add_argument("--chunk-size", type=int, default=500, help="Accounts moved per transaction")
+        parser.add_argument("--pause", type=float, default=0.05, help="Seconds to sleep between chunks so other writers get the lock")
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError("Sharding is off, set ACCOUNTS_SHARDS to the number of shards first.")
+
+        if options["init"]:
+            os.makedirs(settings.ACCOUNTS_SHARD_DIR, exist_ok=True)
+            for alias in shard_aliases():
+                self.stdout.write(f"Migrating {alias}")
+                call_command("migrate", database=alias, verbosity=0, interactive=False)
+
+        started = time.perf_counter()
+        total = kept = 0
+        for source in user_databases():
+            misplaced = self.misplaced_users(source, options["chunk_size"])
+            for target, ids in misplaced:
+                if options["dry_run"]:
+                    total += len(ids)
+                    continue
+                moved = move_users(ids, source, target)
+                total += moved
+                kept += len(ids) - moved
+                time.sleep(options["pause"])
+
+        if options["dry_run"]:
+            self.stdout.write(f"{total} accounts would be moved")
+            return
+
+        # Moves rerun after an interruption can leave the counts off
+        if total:
+            rebuild_email_filter()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Moved {total} accounts in {elapsed:.1f}s"))
+        if kept:
+            self.stdout.write(self.style.WARNING(
+                f"{kept} accounts with groups or permissions were left where they are, "
+                f"those rows only exist on the database they were assigned on"
+            ))
+
+    def misplaced_users(self, source, chunk_size):
+        """Yield (target shard, ids) chunks of users on ``source`` that belong elsewhere."""
+        last_id = 0
+        while True:
+            rows = list(
+                User.objects.using(source)
+                .filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "email", "is_staff", "is_superuser")[:chunk_size]
+            )
+            if not rows:
+                return
+            last_id = rows[-1][0]
+
+            by_target = {}
+            for user_id, email, is_staff, is_superuser in rows:
+                target = database_for_user(email, staff=is_staff or is_superuser)
+                if target != source:
+                    by_target.setdefault(target, []).append(user_id)
+            yield from by_target.items()
@@ -0,0 +1,28 @@
+# Generated by Django 5.1 on 2026-10-19 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_refreshtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuthEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('login', 'Login'), ('login_failed', 'Failed login'), ('logout', 'Logout'), ('code_issued', 'Verification code issued'), ('verified', 'Account verified'), ('verification_failed', 'Failed verification'), ('password_changed', 'Password changed')], max_length=32)),
+                ('user_id', models.BigIntegerField(blank=True, null=True)),
+                ('email', models.CharField(blank=True, max_length=254)),
+                ('ip_address', models.GenericIPAddressField(blank=True, null=True)),
+                ('created', models.DateTimeField()),
+                ('data', models.JSONField(blank=True, default=dict)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'created'], name='authevent_kind_created_idx'), models.Index(fields=['user_id', 'created'], name='authevent_user_created_idx')],
+            },
+        ),
+    ]
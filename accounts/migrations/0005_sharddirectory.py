@@ -0,0 +1,20 @@
+# Generated by Django 5.1 on 2026-10-19 17:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_authevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardDirectory',
+            fields=[
+                ('user_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('shard', models.CharField(max_length=32)),
+            ],
+        ),
+    ]
@@ -1,21 +1,55 @@
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.conf import settings
 
 
 
 from rest_framework.authtoken.models import Token
 
+from .email_filter import get_email_filter
+from .sharding import shard_for_email, shard_for_id, new_token_key, is_sharded
+
 
 # User model
 User = settings.AUTH_USER_MODEL
 
 
 class CustomUserManager(BaseUserManager):
+    def for_email(self, email):
+        """Manager bound to the shard that holds (or will hold) this email."""
+        return self.db_manager(shard_for_email(email))
+
+    def for_id(self, user_id):
+        return self.db_manager(shard_for_id(user_id))
+
+    def find_by_email(self, email, related=()):
+        """
+        The user with this email, or None. Looks in the email's shard, then in
+        "default" like get_by_natural_key(), where staff and accounts not moved
+        yet stay.
+        """
+        for alias in dict.fromkeys([shard_for_email(email), "default"]):
+            queryset = self.db_manager(alias).filter(email=email)
+            if related:
+                queryset = queryset.select_related(*related)
+            user = queryset.first()
+            if user is not None:
+                return user
+        return None
+
+    def get_by_natural_key(self, username):
+        if self._db is not None or not is_sharded():
+            return super().get_by_natural_key(username)
+        try:
+            return self.for_email(username).get(**{self.model.USERNAME_FIELD: username})
+        except self.model.DoesNotExist:
+            # Staff created with createsuperuser and accounts not moved yet stay in "default"
+            return self.db_manager("default").get(**{self.model.USERNAME_FIELD: username})
+
     def create_user(self, email, password=None, **extra_fields):
         if not email:
             raise ValueError('The Email field must be set')
@@ -36,7 +70,63 @@ class CustomUserManager(BaseUserManager):
 
         return self.create_user(email, password, **extra_fields)
 
-class CustomUser(AbstractBaseUser, PermissionsMixin):
+class DirtyFieldsMixin(models.Model):
+	"""
+	Remembers the values a row was loaded with so that save() only writes the
+	fields that changed, and does nothing at all when no field changed.
+	Passing update_fields explicitly bypasses the tracking.
+	"""
+
+	class Meta:
+		abstract = True
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._loaded_values = self._current_values()
+
+	def _current_values(self, fields=None):
+		# Deferred fields are not in __dict__ and are never dirty
+		if fields is None:
+			attnames = [field.attname for field in self._meta.concrete_fields]
+		else:
+			attnames = [self._meta.get_field(name).attname for name in fields]
+		return {attname: self.__dict__[attname] for attname in attnames if attname in self.__dict__}
+
+	def get_dirty_fields(self):
+		return [
+			attname for attname, value in self._current_values().items()
+			if attname not in self._loaded_values or self._loaded_values[attname] != value
+		]
+
+	def save(self, *args, **kwargs):
+		using = kwargs.get("using")
+		tracked = (
+			not self._state.adding
+			and not args
+			and kwargs.get("update_fields") is None
+			and not kwargs.get("force_insert")
+			and (using is None or using == self._state.db)
+		)
+		if tracked:
+			dirty = self.get_dirty_fields()
+			if not dirty:
+				# No post_save either, so related objects its receivers save are saved here
+				self.save_related()
+				return
+			kwargs["update_fields"] = dirty
+		super().save(*args, **kwargs)
+		# Only what was written is clean, other edits must still be saved later
+		self._loaded_values.update(self._current_values(kwargs.get("update_fields")))
+
+	def refresh_from_db(self, using=None, fields=None, **kwargs):
+		super().refresh_from_db(using=using, fields=fields, **kwargs)
+		self._loaded_values.update(self._current_values(fields))
+
+	def save_related(self):
+		pass
+
+
+class CustomUser(DirtyFieldsMixin, AbstractBaseUser, PermissionsMixin):
 	USER_ROLE = [('manager', 'manager'), ('cashier', 'cashier')]
 
 	email = models.EmailField(unique=True)
@@ -56,11 +146,24 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 	USERNAME_FIELD = 'email'
 	REQUIRED_FIELDS = ['first_name', 'last_name']
 
+	class Meta:
+		indexes = [
+			# Bulk operations and listings by role
+			models.Index(fields=['role', 'is_active'], name='user_role_active_idx'),
+			# Purging stale unverified accounts
+			models.Index(fields=['is_verified', 'date_joined'], name='user_verified_joined_idx'),
+			models.Index(fields=['is_active', 'is_verified'], name='user_active_verified_idx'),
+			models.Index(fields=['date_joined'], name='user_date_joined_idx'),
+		]
+
 	def __str__(self):
 		return self.email
 
+	def save_related(self):
+		save_user_profile(type(self), self)
 
-class Profile(models.Model):
+
+class Profile(DirtyFieldsMixin, models.Model):
 	GENDER_CHOICE = [('male', 'Male'), ('female', 'Female')]
 	
 	user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -106,22 +209,107 @@ class Profile(models.Model):
 	
 
 
+class RefreshToken(models.Model):
+	"""
+	Long lived token used to get new signed access tokens.
+	Only the SHA-256 digest of the token is stored.
+	"""
+	user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='refresh_tokens')
+	digest = models.BinaryField(max_length=32, unique=True)
+	expires_at = models.DateTimeField()
+	created = models.DateTimeField(auto_now_add=True)
+
+	def __str__(self):
+		return f"Refresh token for user {self.user_id}"
+
+
+class AuthEvent(models.Model):
+	"""
+	Append-only audit trail of authentication events.
+	Rows are written in batches by accounts.audit, never updated.
+	user_id is not a foreign key so the trail outlives deleted accounts.
+	"""
+	KIND_CHOICES = [
+		('login', 'Login'),
+		('login_failed', 'Failed login'),
+		('logout', 'Logout'),
+		('code_issued', 'Verification code issued'),
+		('verified', 'Account verified'),
+		('verification_failed', 'Failed verification'),
+		('password_changed', 'Password changed'),
+	]
+
+	kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+	user_id = models.BigIntegerField(null=True, blank=True)
+	email = models.CharField(max_length=254, blank=True)
+	ip_address = models.GenericIPAddressField(null=True, blank=True)
+	created = models.DateTimeField()
+	data = models.JSONField(default=dict, blank=True)
+
+	class Meta:
+		indexes = [
+			models.Index(fields=['kind', 'created'], name='authevent_kind_created_idx'),
+			models.Index(fields=['user_id', 'created'], name='authevent_user_created_idx'),
+		]
+
+	def save(self, *args, **kwargs):
+		if not self._state.adding:
+			raise ValueError("Auth events are append-only")
+		super().save(*args, **kwargs)
+
+	def __str__(self):
+		return f"{self.kind} {self.email or self.user_id} at {self.created}"
+
+
+class ShardDirectory(models.Model):
+	"""
+	Users that don't live on the shard their id range points to (see
+	accounts.sharding). Kept on "default".
+	"""
+	user_id = models.BigIntegerField(primary_key=True)
+	shard = models.CharField(max_length=32)
+
+	def __str__(self):
+		return f"User {self.user_id} on {self.shard}"
+
+
 # Profile will be automatically created when user is created
 
-def create_user_profile(sender, instance, created, **kwargs):
+def create_user_profile(sender, instance, created, using="default", **kwargs):
 	if created:
-		Profile.objects.create(user=instance, first_name=instance.first_name, last_name=instance.last_name)
+		Profile.objects.using(using).create(user=instance, first_name=instance.first_name, last_name=instance.last_name)
 
 def save_user_profile(sender, instance, **kwargs):
-	instance.profile.save()
+	# A profile that was never loaded can't have unsaved changes
+	if sender.profile.related.is_cached(instance):
+		instance.profile.save()
 
 
-def create_token(sender, instance=None, created=False, **kwargs):
+def create_token(sender, instance=None, created=False, using="default", **kwargs):
     if created:
-        Token.objects.create(user=instance)
+        Token.objects.using(using).create(user=instance, key=new_token_key(using))
+
+
+# Keep the shared email filter in step with the table
+
+def add_email_to_filter(sender, instance, created=False, update_fields=None, using="default", **kwargs):
+	# Adding early is safe, a rolled back row only leaves a false positive
+	if created or (update_fields is not None and 'email' in update_fields):
+		email, email_filter = instance.email, get_email_filter()
+		inode = email_filter.add(email, new_account=created)
+		# A rebuild from another process in the meantime missed the uncommitted row
+		transaction.on_commit(lambda: email_filter.add_if_rebuilt(email, inode, new_account=created), using=using)
+
+def remove_email_from_filter(sender, instance, using="default", **kwargs):
+	# Removing early is not: a rolled back delete would leave an account the filter says doesn't exist
+	email = instance.email
+	transaction.on_commit(lambda: get_email_filter().remove(email), using=using)
+
 
 post_save.connect(create_user_profile, sender=User)
 post_save.connect(save_user_profile, sender=User)
 post_save.connect(create_token, sender=User)
+post_save.connect(add_email_to_filter, sender=User)
+post_delete.connect(remove_email_from_filter, sender=User)
 
 
@@ -0,0 +1,292 @@
+"""
+Account state events pushed to the frontend as server-sent events.
+
+Views call publish() once an account changed (verified, profile updated).
+The event gets its id from a counter in the SSE_CACHE cache (one that never
+evicts, so ids can't fall back to 0) and is stored there for SSE_EVENT_TTL
+seconds, then it is handed straight to the subscribers in this process. Other workers (and ASGI workers when a WSGI one published) pick
+it up from the cache: while anyone is subscribed, one poller per process
+reads the counter every SSE_POLL_INTERVAL seconds, however many connections
+it serves. A client reconnecting with Last-Event-ID is replayed what it
+missed from the same cache entries. When some of it is gone (expired, or
+more than REPLAY_LIMIT events ago) the client gets a resync event instead and
+re-reads its state.
+
+A subscriber is an asyncio queue on the loop serving its connection, so an
+idle stream costs a queue and a suspended coroutine, no thread.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.dispatch import receiver
+
+from .authentication import grant_expires, grant_is_valid
+from .bootstrap import profile_snapshot
+from .bulk import REVOKE_TOKEN_ACTIONS, users_bulk_updated
+
+
+SEQUENCE_KEY = "accounts:events:seq"
+EVENT_KEY = "accounts:events:{}"
+REPLAY_LIMIT = 1000  # events looked at for a Last-Event-ID replay or a poller catching up
+WRITE_GRACE = 2  # seconds an id may stay missing (its publisher is between incr and set)
+RETRY_MS = 3000
+
+# Queued when a client fell too far behind, it re-reads its state
+RESYNC = {"type": "resync", "data": {}}
+
+
+def event_cache():
+    return caches[getattr(settings, "SSE_CACHE", "default")]
+
+
+# Publishing (any thread, any server)
+
+def publish(user_id, kind, data=None):
+    publish_many([user_id], kind, data)
+
+
+def publish_many(user_ids, kind, data=None):
+    if not user_ids:
+        return
+    events = [{"user": user_id, "type": kind, "data": data or {}, "origin": os.getpid()} for user_id in user_ids]
+    cache = event_cache()
+    cache.add(SEQUENCE_KEY, 0, timeout=None)
+    last = cache.incr(SEQUENCE_KEY, len(events))
+    for offset, event in enumerate(events):
+        event["id"] = last - len(events) + 1 + offset
+    cache.set_many({EVENT_KEY.format(event["id"]): event for event in events}, timeout=settings.SSE_EVENT_TTL)
+    broker = get_broker()
+    for event in events:
+        broker.dispatch(event)
+
+
+def current_sequence():
+    return event_cache().get(SEQUENCE_KEY, 0)
+
+
+def read_events(after, up_to):
+    """
+    (id, event) for the ids after..up_to, oldest first. Event is None when not
+    (or no longer) in the cache. Only the last REPLAY_LIMIT ids are read, see
+    skipped_events().
+    """
+    ids = range(max(after, up_to - REPLAY_LIMIT) + 1, up_to + 1)
+    found = event_cache().get_many([EVENT_KEY.format(event_id) for event_id in ids])
+    return [(event_id, found.get(EVENT_KEY.format(event_id))) for event_id in ids]
+
+
+def skipped_events(after, up_to):
+    return up_to - after > REPLAY_LIMIT
+
+
+@receiver(users_bulk_updated)
+def publish_bulk_update(sender, action, user_ids, **kwargs):
+    publish_many(user_ids, "account_updated", {"action": action})
+
+
+# Subscribing (the ASGI event loop)
+
+class Subscriber:
+
+    def __init__(self, user_id, loop):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue(settings.SSE_QUEUE_SIZE)
+
+    def deliver(self, event):
+        # Always called on self.loop
+        if self.queue.full():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = RESYNC
+        self.queue.put_nowait(event)
+
+
+class Broker:
+    """The subscribers of one process, see get_broker()."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.subscribers = {}  # user id -> set of Subscriber
+        self.poller = None
+        self.last_seen = 0
+        self.missing_since = None
+
+    def add(self, subscriber):
+        with self.lock:
+            self.subscribers.setdefault(subscriber.user_id, set()).add(subscriber)
+            # One poller per process, on the loop serving the streams
+            if self.poller is None or self.poller.done() or self.poller.get_loop() is not subscriber.loop:
+                self.poller = subscriber.loop.create_task(self.poll())
+
+    def remove(self, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[subscriber.user_id]
+
+    def dispatch(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers.get(event["user"], ()))
+        for subscriber in subscribers:
+            subscriber.loop.call_soon_threadsafe(subscriber.deliver, event)
+
+    def dispatch_all(self, event):
+        with self.lock:
+            subscribers = [subscriber for subscribers in self.subscribers.values() for subscriber in subscribers]
+        for subscriber in subscribers:
+            subscriber.loop.call_soon_threadsafe(subscriber.deliver, event)
+
+    async def poll(self):
+        self.last_seen = await sync_to_async(current_sequence, thread_sensitive=False)()
+        while self.subscribers:
+            await asyncio.sleep(settings.SSE_POLL_INTERVAL)
+            new, lost = await sync_to_async(self.read_new, thread_sensitive=False)()
+            for event in new:
+                self.dispatch(event)
+            if lost:
+                # Whose events they were is unknown, everyone re-reads their state
+                self.dispatch_all(RESYNC)
+
+    def read_new(self):
+        """Events other processes published since the last poll, and whether some could not be read."""
+        sequence = current_sequence()
+        if sequence <= self.last_seen:
+            return [], False
+        new = []
+        lost = skipped_events(self.last_seen, sequence)
+        for event_id, event in read_events(self.last_seen, sequence):
+            if event is None:
+                # Either not written yet (try again next poll) or expired
+                if self.missing_since is None:
+                    self.missing_since = time.monotonic()
+                if time.monotonic() - self.missing_since < WRITE_GRACE:
+                    break
+                lost = True
+            else:
+                self.missing_since = None
+                if event["origin"] != self.pid:
+                    new.append(event)
+            self.last_seen = event_id
+        else:
+            self.missing_since = None
+        return new, lost
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    # Subscribers of the parent are not ours after a fork
+    if _broker is None or _broker.pid != os.getpid():
+        _broker = Broker()
+    return _broker
+
+
+def load_state(user_id):
+    """What the frontend polled user_profile for, sent when a stream opens."""
+    User = get_user_model()
+    user = User.objects.for_id(user_id).select_related("profile").filter(pk=user_id).first()
+    if user is None:
+        return None
+    return {
+        "is_verified": user.is_verified,
+        "is_active": user.is_active,
+        "role": user.role,
+        "profile": profile_snapshot(user.profile),
+    }
+
+
+def stream_lifetime(grant):
+    """Seconds a stream may stay open: until its token expires, and at most SSE_MAX_LIFETIME."""
+    expires = grant_expires(grant)
+    if expires is None:
+        return settings.SSE_MAX_LIFETIME
+    return min(settings.SSE_MAX_LIFETIME, expires - time.time())
+
+
+def format_event(event_id, kind, data):
+    lines = [f"event: {kind}", f"data: {json.dumps(data, cls=DjangoJSONEncoder)}"]
+    if event_id is not None:
+        lines.insert(0, f"id: {event_id}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream_events(grant, last_event_id=None):
+    """
+    The body of an event stream: the current state (or what was missed since
+    ``last_event_id``), then every event for the grant's user as it is
+    published, until the token behind ``grant`` expires or stops being valid
+    (checked every SSE_REVALIDATE_INTERVAL seconds) or the account is
+    deactivated or deleted. A "closed" event says why it ended.
+    """
+    user_id = grant["u"]
+    loop = asyncio.get_running_loop()
+    closes_at = loop.time() + stream_lifetime(grant)
+    subscriber = Subscriber(user_id, loop)
+    broker = get_broker()
+    # Subscribe first so nothing published while the state is read is lost
+    broker.add(subscriber)
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+        sequence = await sync_to_async(current_sequence, thread_sensitive=False)()
+        last = sequence
+        if last_event_id is None:
+            state = await sync_to_async(load_state, thread_sensitive=False)(user_id)
+            yield format_event(sequence, "state", state)
+        else:
+            missed = await sync_to_async(read_events, thread_sensitive=False)(last_event_id, sequence)
+            if skipped_events(last_event_id, sequence) or any(event is None for _, event in missed):
+                # Part of what was missed is gone, replaying the rest would leave the client out of date
+                yield format_event(sequence, "resync", {})
+            else:
+                for _, event in missed:
+                    if event["user"] == user_id:
+                        yield format_event(event["id"], event["type"], event["data"])
+
+        check_at = loop.time() + settings.SSE_REVALIDATE_INTERVAL
+        ping_at = loop.time() + settings.SSE_HEARTBEAT_INTERVAL
+        while True:
+            now = loop.time()
+            if now >= closes_at:
+                yield format_event(None, "closed", {"reason": "expired"})
+                return
+            if now >= check_at:
+                if not await sync_to_async(grant_is_valid, thread_sensitive=False)(grant):
+                    yield format_event(None, "closed", {"reason": "revoked"})
+                    return
+                check_at = now + settings.SSE_REVALIDATE_INTERVAL
+            if now >= ping_at:
+                # A comment line, keeps proxies from closing an idle stream
+                yield ": ping\n\n"
+                ping_at = now + settings.SSE_HEARTBEAT_INTERVAL
+
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), min(closes_at, check_at, ping_at) - now)
+            except asyncio.TimeoutError:
+                continue
+            if event is RESYNC:
+                yield format_event(None, "resync", {})
+                continue
+            if event["id"] <= last:
+                continue
+            last = event["id"]
+            yield format_event(event["id"], event["type"], event["data"])
+            if event["type"] == "account_updated" and event["data"].get("action") in REVOKE_TOKEN_ACTIONS:
+                yield format_event(None, "closed", {"reason": event["data"]["action"]})
+                return
+    finally:
+        broker.remove(subscriber)
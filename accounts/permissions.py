@@ -6,4 +6,12 @@ class IsUserVerified(BasePermission):
         Allow access only to users that are verified
     """
     def has_permission(self, request, view):
-        return bool(request.user.is_verified)
\ No newline at end of file
+        return bool(request.user.is_verified)
+
+class IsManager(BasePermission):
+    """
+        Allow access only to managers and superusers
+    """
+    def has_permission(self, request, view):
+        user = request.user
+        return bool(user and user.is_authenticated and (user.is_superuser or user.role == "manager"))
@@ -0,0 +1,114 @@
+"""
+Token buckets shared by every worker on the host.
+
+The buckets live in a memory mapped file (RATE_LIMIT_PATH) laid out as a
+fixed size hash table, so a check is a hash, an flock and a few struct reads
+with no database or cache round trip. A key that finds no free slot in its
+probe window takes over the least recently used one, which at worst hands a
+stale key a fresh bucket. Keys are hashed with SECRET_KEY so nobody can
+craft keys that push someone else's bucket out.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+
+
+MAGIC = b"RLTB"
+HEADER = struct.Struct("<4sI")  # magic, slots
+SLOT = struct.Struct("<Qdd")  # key fingerprint, tokens left, last update
+PROBES = 8
+
+
+class SharedTokenBuckets:
+
+    def __init__(self, path, slots):
+        self.path = str(path)
+        self.slots = slots
+        self.secret = hashlib.sha256(settings.SECRET_KEY.encode()).digest()[:32]
+        # flock only excludes other processes, threads of a worker use this
+        self.thread_lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        # A forked worker must not share the parent's open file, its flock would be shared too
+        if self._pid == os.getpid():
+            return
+        if self._fd is not None:
+            self._map.close()
+            os.close(self._fd)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = HEADER.size + self.slots * SLOT.size
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != size or HEADER.unpack_from(os.pread(fd, HEADER.size, 0))[0] != MAGIC:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, HEADER.pack(MAGIC, self.slots), 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd, self._map, self._pid = fd, mmap.mmap(fd, size), os.getpid()
+
+    def _fingerprint(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=8, key=self.secret).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    def hit(self, key, capacity, period, now=None):
+        """
+        Take a token from ``key``'s bucket, which holds ``capacity`` tokens
+        and refills completely over ``period`` seconds. Returns 0 when the
+        request may go ahead, else the seconds until a token is available.
+        """
+        now = time.time() if now is None else now
+        rate = capacity / period
+        fingerprint = self._fingerprint(key)
+        start = fingerprint % self.slots
+
+        with self.thread_lock:
+            self._open()
+            buckets = self._map
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset = None
+                oldest = None
+                for i in range(PROBES):
+                    candidate = HEADER.size + ((start + i) % self.slots) * SLOT.size
+                    stored, tokens, updated = SLOT.unpack_from(buckets, candidate)
+                    if stored == fingerprint:
+                        offset = candidate
+                        tokens = min(capacity, tokens + (now - updated) * rate)
+                        break
+                    if oldest is None or updated < oldest[1]:
+                        oldest = (candidate, updated)
+                else:
+                    offset = oldest[0]
+                    tokens = capacity
+
+                if tokens >= 1:
+                    tokens -= 1
+                    wait = 0
+                else:
+                    wait = (1 - tokens) / rate
+                SLOT.pack_into(buckets, offset, fingerprint, tokens, now)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return wait
+
+
+_limiters = {}
+
+
+def get_rate_limiter():
+    path = str(settings.RATE_LIMIT_PATH)
+    if path not in _limiters:
+        _limiters[path] = SharedTokenBuckets(path, settings.RATE_LIMIT_SLOTS)
+    return _limiters[path]
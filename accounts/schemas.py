@@ -0,0 +1,124 @@
+"""
+Request schemas for the accounts views.
+
+Each schema is a pydantic model, so its validator is compiled (by
+pydantic-core) once when this module is imported. A payload is then checked
+and coerced in a single call, and every problem with it is reported at once:
+
+    payload, errors = validate_request(LoginRequest, request.data)
+    if errors:
+        return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+``errors`` keeps the usual "detail" message next to the list of field errors.
+"""
+
+from datetime import date
+from typing import Annotated, Literal, Optional
+
+from django.contrib.auth.password_validation import validate_password
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.validators import validate_email
+from pydantic import AfterValidator, BaseModel, BeforeValidator, ConfigDict, Field, ValidationError, model_validator
+from pydantic_core import PydanticCustomError
+
+
+def _check_email(value):
+    try:
+        validate_email(value)
+    except DjangoValidationError as e:
+        raise PydanticCustomError("invalid_email", " ".join(e.messages))
+    return value
+
+
+def _check_password(value):
+    try:
+        validate_password(value)
+    except DjangoValidationError as e:
+        raise PydanticCustomError("weak_password", " ".join(e.messages))
+    return value
+
+
+def _blank_to_none(value):
+    # Form fields are sent as "" when left empty
+    return None if value == "" else value
+
+
+Email = Annotated[str, Field(min_length=1, max_length=254), AfterValidator(_check_email)]
+Password = Annotated[str, Field(min_length=1, repr=False), AfterValidator(_check_password)]
+Name = Annotated[str, Field(min_length=1, max_length=100)]
+Gender = Literal["male", "female"]
+OptionalText = Annotated[Optional[str], BeforeValidator(_blank_to_none)]
+OptionalDate = Annotated[Optional[date], BeforeValidator(_blank_to_none)]
+
+
+class RequestSchema(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True, extra="ignore", frozen=True)
+
+
+class RegistrationRequest(RequestSchema):
+    email: Email
+    password: Password
+    password2: Annotated[str, Field(repr=False)]
+    first_name: Name
+    last_name: Name
+    gender: Gender
+    phone_number: Annotated[OptionalText, Field(max_length=100)] = None
+    address: Annotated[str, Field(max_length=100)] = ""
+    birth_date: OptionalDate = None
+    bio: OptionalText = None
+
+    @model_validator(mode="after")
+    def passwords_match(self):
+        if self.password != self.password2:
+            raise PydanticCustomError("password_mismatch", "Passwords must match")
+        return self
+
+
+class LoginRequest(RequestSchema):
+    email: Email
+    password: Password
+
+
+class EmailRequest(RequestSchema):
+    email: Email
+
+
+class VerificationRequest(RequestSchema):
+    user_id: int
+    code: int
+
+
+class RetryCodeRequest(RequestSchema):
+    user_id: int
+
+
+class ProfileUpdateRequest(RequestSchema):
+    """Every field is optional, only the ones sent (model_fields_set) are applied."""
+    first_name: Annotated[str, Field(max_length=100)] = ""
+    last_name: Annotated[str, Field(max_length=100)] = ""
+    phone_number: Annotated[OptionalText, Field(max_length=100)] = None
+    address: Annotated[str, Field(max_length=100)] = ""
+    gender: Gender = "male"
+    birth_date: OptionalDate = None
+    bio: OptionalText = None
+
+
+def format_errors(error):
+    errors = []
+    for item in error.errors(include_url=False):
+        field = ".".join(str(part) for part in item["loc"])
+        errors.append({"field": field, "message": item["msg"]})
+    first = errors[0]
+    detail = f"{first['field']}: {first['message']}" if first["field"] else first["message"]
+    return {"detail": detail, "errors": errors}
+
+
+def validate_request(schema, data):
+    """Return (payload, None) when ``data`` is valid, else (None, errors)."""
+    if hasattr(data, "dict") and hasattr(data, "getlist"):
+        # QueryDict from a form or multipart body, one value per field
+        data = data.dict()
+    try:
+        return schema.model_validate(data), None
+    except ValidationError as e:
+        return None, format_errors(e)
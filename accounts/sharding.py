@@ -0,0 +1,278 @@
+"""
+Accounts sharding across several SQLite databases.
+
+With ACCOUNTS_SHARDS = N (> 0) users, profiles, auth tokens and refresh
+tokens live in N databases, accounts_0 .. accounts_<N-1>, instead of
+"default". A user belongs to the shard picked by a stable hash of the
+normalized email, so lookups by email go straight to one shard. Staff and
+superusers are the exception: they stay on "default", where the admin log
+and the sessions that point at them are. The admin reaches the shards through
+its "database" filter.
+
+Ids stay unique across shards because every shard hands out ids from its own
+range: shard i starts at (i + 1) << SHARD_ID_SHIFT (see seed_shard_sequence).
+The range tells which shard created a user. Users that live elsewhere
+(accounts from before sharding, or moved by reshard_accounts) are listed in
+the ShardDirectory table on "default", which is looked up once per id and
+cached. Auth and refresh tokens carry their shard in a prefix.
+
+With ACCOUNTS_SHARDS = 0 (the default) everything stays in "default" and
+every helper here returns "default" without any lookup.
+"""
+
+import hashlib
+import secrets
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+
+SHARD_ID_SHIFT = 40
+
+# Models that are stored on the shards
+SHARDED_MODELS = {
+    "accounts.CustomUser",
+    "accounts.Profile",
+    "accounts.RefreshToken",
+    "authtoken.Token",
+    "authtoken.TokenProxy",
+}
+
+# Apps whose tables are created on the shards (auth, contenttypes and admin
+# for the relations deleting a user cascades to), minus the models that only
+# live on "default"
+SHARD_APPS = {"accounts", "authtoken", "auth", "contenttypes", "admin"}
+DEFAULT_ONLY_MODELS = {"authevent", "sharddirectory"}
+
+DIRECTORY_CACHE_TIMEOUT = 300
+
+
+def shard_aliases():
+    return settings.ACCOUNTS_SHARD_ALIASES
+
+
+def is_sharded():
+    return bool(getattr(settings, "ACCOUNTS_SHARDS", 0))
+
+
+def user_databases():
+    """Every database that may hold users: the shards, and "default" for accounts not moved yet."""
+    if not is_sharded():
+        return ["default"]
+    return [*shard_aliases(), "default"]
+
+
+def shard_for_email(email):
+    if not is_sharded():
+        return "default"
+    aliases = shard_aliases()
+    digest = hashlib.blake2b((email or "").strip().lower().encode(), digest_size=8).digest()
+    return aliases[int.from_bytes(digest, "big") % len(aliases)]
+
+
+def database_for_user(email, staff=False):
+    """
+    Where a new account goes. Staff and superusers stay on "default", next to
+    the admin log and sessions that reference them; everyone else goes to the
+    shard of their email.
+    """
+    return "default" if staff else shard_for_email(email)
+
+
+def shard_index(alias):
+    return shard_aliases().index(alias)
+
+
+def home_shard(user_id):
+    """The shard whose id range ``user_id`` comes from, "default" for older ids."""
+    index = (user_id >> SHARD_ID_SHIFT) - 1
+    aliases = shard_aliases()
+    return aliases[index] if 0 <= index < len(aliases) else "default"
+
+
+def shard_for_id(user_id):
+    if not is_sharded():
+        return "default"
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return "default"
+
+    key = f"accounts:shard:{user_id}"
+    shard = cache.get(key)
+    if shard is None:
+        from .models import ShardDirectory
+
+        shard = ShardDirectory.objects.filter(user_id=user_id).values_list("shard", flat=True).first()
+        shard = shard or home_shard(user_id)
+        cache.set(key, shard, timeout=DIRECTORY_CACHE_TIMEOUT)
+    return shard
+
+
+def record_moved_users(user_ids, shard):
+    """Point the directory at ``shard`` for users that were just moved there."""
+    from .models import ShardDirectory
+
+    listed = [user_id for user_id in user_ids if home_shard(user_id) != shard]
+    ShardDirectory.objects.filter(user_id__in=set(user_ids) - set(listed)).delete()
+    ShardDirectory.objects.bulk_create(
+        [ShardDirectory(user_id=user_id, shard=shard) for user_id in listed],
+        update_conflicts=True,
+        update_fields=["shard"],
+        unique_fields=["user_id"],
+    )
+    cache.set_many({f"accounts:shard:{user_id}": shard for user_id in user_ids}, timeout=DIRECTORY_CACHE_TIMEOUT)
+
+
+def move_users(user_ids, source, target):
+    """
+    Move users with their profiles from ``source`` to ``target``, keeping
+    their ids. Auth and refresh tokens name their shard, so they are dropped
+    and the users log in again. Returns how many users were moved.
+
+    Users with groups or permissions are never moved: those rows point at
+    Group and Permission rows of ``source``. Staff and superusers only move
+    to "default" (see database_for_user).
+
+    Safe to rerun after an interruption: copies left on ``target`` by an
+    earlier attempt are replaced. The directory is updated before the
+    originals are deleted so id lookups never miss.
+    """
+    from django.contrib.auth import get_user_model
+    from django.db import transaction
+
+    from .models import Profile
+
+    User = get_user_model()
+    users = User.objects.using(source).filter(id__in=user_ids, groups=None, user_permissions=None)
+    if target != "default":
+        users = users.filter(is_staff=False, is_superuser=False)
+    users = list(users)
+    if not users:
+        return 0
+    moved_ids = [user.id for user in users]
+    profiles = list(Profile.objects.using(source).filter(user_id__in=moved_ids))
+
+    with transaction.atomic(using=target):
+        User.objects.using(target).filter(id__in=moved_ids).delete()
+        sequence = _user_sequence(target)
+        User.objects.using(target).bulk_create(users)
+        for profile in profiles:
+            profile.pk = None
+        Profile.objects.using(target).bulk_create(profiles)
+        # Copied ids must not push the shard's own id range forward
+        if sequence is not None:
+            _set_user_sequence(target, sequence)
+
+    record_moved_users(moved_ids, target)
+
+    # Deleting the originals takes their emails out of the shared filter,
+    # count the copies in first so the emails are never missing from it
+    from .email_filter import get_email_filter
+
+    email_filter = get_email_filter()
+    for user in users:
+        email_filter.add(user.email)
+
+    with transaction.atomic(using=source):
+        User.objects.using(source).filter(id__in=moved_ids).delete()
+    return len(users)
+
+
+def _user_sequence(using):
+    from django.contrib.auth import get_user_model
+
+    if connections[using].vendor != "sqlite":
+        return None
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [get_user_model()._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _set_user_sequence(using, value):
+    from django.contrib.auth import get_user_model
+
+    with connections[using].cursor() as cursor:
+        cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [value, get_user_model()._meta.db_table])
+
+
+# Tokens: "s<index>." followed by the secret. Unsharded tokens never contain
+# a dot, so they are told apart without a lookup.
+
+def shard_token(alias, secret):
+    if alias == "default" or not is_sharded():
+        return secret
+    return f"s{shard_index(alias):03d}.{secret}"
+
+
+def shard_for_token(token):
+    if not is_sharded() or not token:
+        return "default"
+    prefix, dot, _ = token.partition(".")
+    if not dot or len(prefix) != 4 or prefix[0] != "s" or not prefix[1:].isdigit():
+        return "default"
+    aliases = shard_aliases()
+    index = int(prefix[1:])
+    return aliases[index] if index < len(aliases) else "default"
+
+
+def new_token_key(alias):
+    """A 40 character DRF token key for a user stored on ``alias``."""
+    key = shard_token(alias, secrets.token_hex(20))
+    return key[:40]
+
+
+def seed_shard_sequence(using, **kwargs):
+    """
+    post_migrate: start a shard's user ids at the bottom of its range.
+    SQLite AUTOINCREMENT continues from sqlite_sequence, which is never lowered.
+    """
+    if not is_sharded() or using not in shard_aliases() or connections[using].vendor != "sqlite":
+        return
+    from django.contrib.auth import get_user_model
+
+    table = get_user_model()._meta.db_table
+    base = (shard_index(using) + 1) << SHARD_ID_SHIFT
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, base])
+        elif row[0] < base:
+            cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [base, table])
+
+
+class ShardRouter:
+    """
+    Sends reads and writes for the sharded models to the database of the
+    instance they concern. Queries without an instance go to whatever the
+    caller picked with using(), for_email() or for_id(), else "default".
+    """
+
+    def _db_for_model(self, model, **hints):
+        if not is_sharded() or model._meta.label not in SHARDED_MODELS:
+            return None
+        instance = hints.get("instance")
+        if instance is None:
+            return None
+        if instance._state.db:
+            return instance._state.db
+        if model._meta.label == settings.AUTH_USER_MODEL:
+            return database_for_user(instance.email, staff=instance.is_staff or instance.is_superuser)
+        user_id = getattr(instance, "user_id", None)
+        return shard_for_id(user_id) if user_id is not None else None
+
+    db_for_read = _db_for_model
+    db_for_write = _db_for_model
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.label in SHARDED_MODELS and obj2._meta.label in SHARDED_MODELS:
+            return obj1._state.db == obj2._state.db
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == "default" or db not in getattr(settings, "ACCOUNTS_SHARD_ALIASES", []):
+            return None
+        return app_label in SHARD_APPS and model_name not in DEFAULT_ONLY_MODELS
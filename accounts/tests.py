@@ -1,3 +1,1118 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import re
+import signal
+import tempfile
+import time
+import zlib
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import QuerySet
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient, APIRequestFactory
+
+from inventory_kooltech_be.concurrency import get_semaphore
+from inventory_kooltech_be import memory
+from inventory_kooltech_be.middleware import (
+    CompressionMiddleware,
+    MemoryAccountingMiddleware,
+    ProfilingMiddleware,
+    compression_exempt,
+)
+from inventory_kooltech_be.sqlite_cache import SQLiteCache
+from inventory_kooltech_be.test_runner import TEST_SHARD_ALIASES
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+
+from . import audit, email_filter, hashers, idempotency, notifications, sharding, tokens, views
+from .bulk import apply_bulk_action
+from .email_filter import get_email_filter, rebuild_email_filter
+from .management.commands import purge_unverified_accounts
+from .ratelimit import SharedTokenBuckets
+from .models import AuthEvent, CustomUser, Profile, RefreshToken
+
+
+# Tables on the request path that must always be read through an index
+HOT_TABLES = ("accounts_customuser", "accounts_profile", "authtoken_token")
+
+# "SCAN accounts_customuser" without an index is a full table scan
+FULL_SCAN = re.compile(r"\bSCAN (?:TABLE )?(%s)\b(?! USING)" % "|".join(HOT_TABLES))
+
+PASSWORD = "Str0ng-Passw0rd!"
+
+EMAIL_FILTER_PATH = os.path.join(tempfile.mkdtemp(), "email_filter.bin")
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    EMAIL_FILTER_PATH=EMAIL_FILTER_PATH,
+    AUDIT_LOG_ENABLED=False,
+    RATE_LIMIT_ENABLED=False,
+)
+@mock.patch("accounts.views.send_registration_code_mail", return_value=200)
+class AccountsQueryPlanTests(TestCase):
+    """
+    Runs every accounts endpoint, checks the exact number of queries it issues
+    and that none of them scans a hot table instead of using an index.
+    """
+
+    def setUp(self):
+        rebuild_email_filter()
+        self.client = APIClient()
+        self.user = CustomUser.objects.create_user("cashier@example.com", PASSWORD)
+        self.manager = CustomUser.objects.create_user("manager@example.com", PASSWORD, role="manager", is_verified=True)
+
+    def query_plan(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            return " | ".join(row[-1] for row in cursor.fetchall())
+
+    def assertQueries(self, expected, method, url_name, data=None, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(reverse(url_name), data=data, **kwargs)
+
+        statements = [query["sql"] for query in context.captured_queries]
+        self.assertEqual(len(statements), expected, "\n".join(statements))
+
+        for sql in statements:
+            if not sql.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                continue
+            plan = self.query_plan(sql)
+            self.assertIsNone(FULL_SCAN.search(plan), f"Full table scan:\n{sql}\n{plan}")
+        return response
+
+    def authenticate(self, user):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + user.auth_token.key)
+
+    def test_create_user(self, send_mail):
+        data = {
+            "email": "new@example.com",
+            "password": PASSWORD,
+            "password2": PASSWORD,
+            "first_name": "New",
+            "last_name": "User",
+            "gender": "female",
+            "address": "Lagos",
+        }
+        response = self.assertQueries(5, "post", "create_user_view", data, format="json")
+        self.assertEqual(response.status_code, 201)
+
+    def test_create_user_invalid_payload(self, send_mail):
+        data = {"email": "not-an-email", "password": PASSWORD, "password2": "other", "first_name": "New", "gender": "other"}
+        response = self.assertQueries(0, "post", "create_user_view", data, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            [error["field"] for error in response.data["errors"]],
+            ["email", "last_name", "gender"],
+        )
+
+    def test_login(self, send_mail):
+        data = {"email": self.user.email, "password": PASSWORD}
+        response = self.assertQueries(7, "post", "login_view", data, format="json")
+        self.assertEqual(response.status_code, 200)
+
+    def test_session_bootstrap(self, send_mail):
+        data = {"email": self.user.email, "password": PASSWORD}
+        response = self.assertQueries(7, "post", "session_bootstrap", data, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {"token", "user", "profile", "permissions"})
+        self.assertIn("image_url", response.data["profile"])
+
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + response.data["token"]["token"])
+        response = self.assertQueries(1, "get", "session_bootstrap")
+        self.assertEqual(response.status_code, 200)
+        response = self.assertQueries(1, "get", "session_bootstrap", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_session_bootstrap_fields(self, send_mail):
+        self.authenticate(self.user)
+        url = reverse("session_bootstrap")
+        response = self.client.get(url, {"fields": "permissions,profile.first_name"})
+        self.assertEqual(response.data["profile"], {"first_name": ""})
+        self.assertEqual(set(response.data), {"profile", "permissions"})
+        response = self.client.get(url, {"fields": "profile.password"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_login_unknown_email(self, send_mail):
+        data = {"email": "nobody@example.com", "password": PASSWORD}
+        response = self.assertQueries(0, "post", "login_view", data, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_logout(self, send_mail):
+        self.authenticate(self.user)
+        response = self.assertQueries(7, "post", "logout_view")
+        self.assertEqual(response.status_code, 200)
+
+    def test_verify_user(self, send_mail):
+        self.user.code = 1234
+        self.user.save()
+        data = {"user_id": self.user.id, "code": 1234}
+        response = self.assertQueries(2, "post", "verify_user_upon_registration", data, format="json")
+        self.assertEqual(response.status_code, 200)
+
+    def test_verify_user_retry_code(self, send_mail):
+        response = self.assertQueries(2, "post", "verify_user_retry_code", {"user_id": self.user.id}, format="json")
+        self.assertEqual(response.status_code, 200)
+
+    def test_forget_password(self, send_mail):
+        response = self.assertQueries(2, "post", "forget_password_view_email", {"email": self.user.email}, format="json")
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_profile(self, send_mail):
+        self.authenticate(self.user)
+        response = self.assertQueries(2, "get", "user_profile")
+        self.assertEqual(response.status_code, 200)
+
+    def test_update_profile(self, send_mail):
+        self.authenticate(self.user)
+        response = self.assertQueries(3, "put", "user_profile", {"bio": "Hello"}, format="multipart")
+        self.assertEqual(response.status_code, 200)
+
+    def test_bulk_operation_by_ids(self, send_mail):
+        self.authenticate(self.manager)
+        data = {"action": "verify", "ids": [self.user.id]}
+        response = self.assertQueries(5, "post", "bulk_user_operations", data, format="json")
+        self.assertEqual(response.data["updated"], 1)
+
+    def test_bulk_operation_by_filter(self, send_mail):
+        self.authenticate(self.manager)
+        data = {"action": "deactivate", "filter": {"role": "cashier", "is_active": True}}
+        response = self.assertQueries(6, "post", "bulk_user_operations", data, format="json")
+        self.assertEqual(response.data["updated"], 1)
+
+    def test_managers_cannot_act_on_other_managers(self, send_mail):
+        other = CustomUser.objects.create_user("other.manager@example.com", PASSWORD, role="manager")
+        self.authenticate(self.manager)
+        data = {"action": "deactivate", "ids": [other.id, self.user.id]}
+        response = self.client.post(reverse("bulk_user_operations"), data, format="json")
+        self.assertEqual(response.data["updated"], 1)
+        self.assertTrue(CustomUser.objects.get(id=other.id).is_active)
+
+    def test_bulk_operation_rejects_non_object_body(self, send_mail):
+        self.authenticate(self.manager)
+        response = self.client.post(reverse("bulk_user_operations"), [{"action": "verify"}], format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_operation_cannot_delete(self, send_mail):
+        self.authenticate(self.manager)
+        data = {"action": "delete", "ids": [self.user.id]}
+        response = self.client.post(reverse("bulk_user_operations"), data, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(CustomUser.objects.filter(id=self.user.id).exists())
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    EMAIL_FILTER_PATH=EMAIL_FILTER_PATH,
+    AUDIT_LOG_ENABLED=False,
+    RATE_LIMIT_ENABLED=False,
+)
+class IdempotencyTests(TestCase):
+
+    def setUp(self):
+        idempotency.get_cache().clear()
+        rebuild_email_filter()
+        self.client = APIClient()
+        self.user = CustomUser.objects.create_user("cashier@example.com", PASSWORD)
+
+    def post(self, email, key="retry-1"):
+        return self.client.post(reverse("forget_password_view_email"), {"email": email}, format="json", HTTP_IDEMPOTENCY_KEY=key)
+
+    @mock.patch("accounts.views.send_registration_code_mail", return_value=200)
+    def test_replays_and_payload_mismatch(self, send_mail):
+        self.assertEqual(self.post(self.user.email).status_code, 200)
+        response = self.post(self.user.email)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response[idempotency.REPLAYED_HEADER], "true")
+        self.assertEqual(send_mail.call_count, 1)
+        self.assertEqual(self.post("other@example.com").status_code, 422)
+
+    def test_retry_while_in_flight_is_not_held(self):
+        retries = []
+
+        def send_mail(*args, **kwargs):
+            retries.append(self.post(self.user.email).status_code)
+            retries.append(self.post("other@example.com").status_code)
+            return 200
+
+        with mock.patch("accounts.views.send_registration_code_mail", side_effect=send_mail):
+            self.assertEqual(self.post(self.user.email).status_code, 200)
+        self.assertEqual(retries, [409, 422])
+
+
+class DirtyFieldsTests(TestCase):
+
+    def setUp(self):
+        user = CustomUser.objects.create_user("cashier@example.com", PASSWORD)
+        self.user = CustomUser.objects.get(id=user.id)
+
+    def test_unchanged_save_is_a_no_op(self):
+        with self.assertNumQueries(0):
+            self.user.save()
+
+    def test_save_writes_only_changed_fields(self):
+        self.user.first_name = "Ada"
+        with CaptureQueriesContext(connection) as context:
+            self.user.save()
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertIn('SET "first_name" = ', context.captured_queries[0]["sql"])
+        self.assertNotIn('"email"', context.captured_queries[0]["sql"])
+
+    def test_user_save_does_not_touch_unloaded_profile(self):
+        self.user.is_verified = True
+        with self.assertNumQueries(1):
+            self.user.save()
+
+    def test_unchanged_user_save_still_saves_changed_profile(self):
+        self.user.profile.bio = "Hello"
+        # Only the profile row is written
+        with self.assertNumQueries(1):
+            self.user.save()
+        self.assertEqual(CustomUser.objects.get(id=self.user.id).profile.bio, "Hello")
+
+    def test_user_save_cascades_to_changed_profile(self):
+        self.user.profile.bio = "Hello"
+        self.user.is_verified = True
+        self.user.save()
+        self.assertEqual(CustomUser.objects.get(id=self.user.id).profile.bio, "Hello")
+
+    def test_update_fields_save_keeps_other_edits_dirty(self):
+        self.user.first_name = "Ada"
+        self.user.is_verified = True
+        self.user.save(update_fields=["is_verified"])
+        self.user.save()
+        self.assertEqual(CustomUser.objects.get(id=self.user.id).first_name, "Ada")
+
+
+@override_settings(EMAIL_FILTER_PATH=EMAIL_FILTER_PATH)
+class EmailFilterTests(TestCase):
+
+    def setUp(self):
+        rebuild_email_filter()
+        self.filter = get_email_filter()
+
+    def test_created_and_deleted_users_are_tracked(self):
+        self.assertFalse(self.filter.might_contain("new@example.com"))
+        user = CustomUser.objects.create_user("new@example.com", PASSWORD)
+        self.assertTrue(self.filter.might_contain("NEW@example.com "))
+        with self.captureOnCommitCallbacks(execute=True):
+            user.delete()
+            # Until the delete commits the account may still come back
+            self.assertTrue(self.filter.might_contain("new@example.com"))
+        self.assertFalse(self.filter.might_contain("new@example.com"))
+
+    def test_rebuild_before_commit_does_not_lose_new_email(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            CustomUser.objects.create_user("new@example.com", PASSWORD)
+            # Another process rebuilds from the committed rows, which don't have it yet
+            self.filter.rebuild(CustomUser.objects.exclude(email="new@example.com").values_list("email", flat=True))
+            self.assertFalse(self.filter.might_contain("new@example.com"))
+        self.assertTrue(self.filter.might_contain("new@example.com"))
+        self.assertEqual(self.filter.accounts, CustomUser.objects.count())
+
+    def test_stale_filter_is_rebuilt_on_first_use(self):
+        # A database restore brings back rows the filter never saw
+        CustomUser.objects.bulk_create([CustomUser(email="restored@example.com")])
+        self.assertFalse(self.filter.might_contain("restored@example.com"))
+        email_filter._checked.clear()
+        self.assertTrue(email_filter.email_may_exist("restored@example.com"))
+        self.assertEqual(self.filter.accounts, CustomUser.objects.count())
+
+    def test_rebuild_picks_up_existing_rows(self):
+        CustomUser.objects.bulk_create([CustomUser(email="bulk@example.com")])
+        self.assertFalse(self.filter.might_contain("bulk@example.com"))
+        rebuild_email_filter()
+        self.assertTrue(self.filter.might_contain("bulk@example.com"))
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    EMAIL_FILTER_PATH=EMAIL_FILTER_PATH,
+    ACCOUNTS_AUTH_MODE="signed",
+    AUDIT_LOG_ENABLED=False,
+    RATE_LIMIT_ENABLED=False,
+)
+class SignedTokenTests(TestCase):
+
+    def setUp(self):
+        rebuild_email_filter()
+        self.client = APIClient()
+        self.user = CustomUser.objects.create_user("cashier@example.com", PASSWORD)
+        response = self.client.post(reverse("login_view"), {"email": self.user.email, "password": PASSWORD}, format="json")
+        self.tokens = response.data
+
+    def test_access_token_is_checked_without_token_queries(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.tokens["token"])
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("user_profile"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["email"], self.user.email)
+        self.assertFalse([q for q in context.captured_queries if "authtoken_token" in q["sql"]])
+
+    def test_refresh_token_is_rotated(self):
+        url = reverse("token_refresh_view")
+        response = self.client.post(url, {"refresh": self.tokens["refresh"]}, format="json")
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(url, {"refresh": self.tokens["refresh"]}, format="json")
+        self.assertEqual(response.status_code, 401)
+
+    def test_racing_refreshes_get_one_pair(self):
+        first = QuerySet.first
+
+        def first_then_race(queryset):
+            refresh = first(queryset)
+            # Another request with the same token rotates it between our read and our delete
+            RefreshToken.objects.filter(pk=refresh.pk).delete()
+            return refresh
+
+        with mock.patch.object(QuerySet, "first", autospec=True, side_effect=first_then_race):
+            with self.assertRaises(tokens.InvalidToken):
+                tokens.rotate_refresh_token(self.tokens["refresh"])
+        self.assertFalse(RefreshToken.objects.filter(user=self.user).exists())
+
+    def test_logout_revokes_access_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.tokens["token"])
+        response = self.client.post(reverse("logout_view"), {"refresh": self.tokens["refresh"]}, format="json")
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(reverse("user_profile"))
+        self.assertEqual(response.status_code, 401)
+
+    def test_password_change_signs_out_other_devices(self):
+        # The view has no route, call it directly
+        data = {"old_password": PASSWORD, "new_password": "N3w-Passw0rd!x", "confirm_new_password": "N3w-Passw0rd!x"}
+        request = APIRequestFactory().post("/", data, format="json", HTTP_AUTHORIZATION="Token " + self.tokens["token"])
+        changed = views.change_user_password(request)
+        self.assertEqual(changed.status_code, 200)
+
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.tokens["token"])
+        self.assertEqual(self.client.get(reverse("user_profile")).status_code, 401)
+        response = self.client.post(reverse("token_refresh_view"), {"refresh": self.tokens["refresh"]}, format="json")
+        self.assertEqual(response.status_code, 401)
+        # The device that changed it stays signed in
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + changed.data["token"])
+        self.assertEqual(self.client.get(reverse("user_profile")).status_code, 200)
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    EMAIL_FILTER_PATH=EMAIL_FILTER_PATH,
+    AUDIT_LOG_ENABLED=True,
+    RATE_LIMIT_ENABLED=False,
+)
+@mock.patch("accounts.audit._ensure_flusher")  # flushed by hand, no background thread in tests
+class AuthEventTests(TestCase):
+
+    def setUp(self):
+        rebuild_email_filter()
+        self.client = APIClient()
+        self.user = CustomUser.objects.create_user("cashier@example.com", PASSWORD)
+        self.admin = CustomUser.objects.create_superuser("admin@example.com", PASSWORD)
+
+    def login(self, password):
+        return self.client.post(reverse("login_view"), {"email": self.user.email, "password": password}, format="json")
+
+    def test_events_are_buffered_and_written_in_one_batch(self, ensure_flusher):
+        self.login("Wr0ng-Passw0rd!")
+        self.login(PASSWORD)
+        self.assertFalse(AuthEvent.objects.exists())
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(audit.flush_events(), 2)
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertEqual(list(AuthEvent.objects.order_by("id").values_list("kind", flat=True)), ["login_failed", "login"])
+
+    def test_forwarded_for_is_only_trusted_behind_proxies(self, ensure_flusher):
+        request = RequestFactory().get("/", HTTP_X_FORWARDED_FOR="6.6.6.6, 10.0.0.7", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(audit.client_ip(request), "10.0.0.1")
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, "NUM_PROXIES": 1}):
+            # The spoofable first entry is never used, the one our proxy added is
+            self.assertEqual(audit.client_ip(request), "10.0.0.7")
+
+    def test_events_are_append_only(self, ensure_flusher):
+        self.login(PASSWORD)
+        audit.flush_events()
+        event = AuthEvent.objects.get()
+        with self.assertRaises(ValueError):
+            event.save()
+
+    def test_admin_can_tail_events(self, ensure_flusher):
+        self.login("Wr0ng-Passw0rd!")
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(reverse("auth_events"), {"kind": "login_failed"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([event["email"] for event in response.data["results"]], [self.user.email])
+
+        self.client.force_authenticate(None)
+        self.login(PASSWORD)
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(reverse("auth_events"), {"after_id": response.data["last_id"]})
+        self.assertEqual([event["kind"] for event in response.data["results"]], ["login"])
+
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get(reverse("auth_events")).status_code, 403)
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"], EMAIL_FILTER_PATH=EMAIL_FILTER_PATH)
+class PurgeUnverifiedAccountsTests(TestCase):
+
+    def setUp(self):
+        old = timezone.now() - timedelta(days=settings.UNVERIFIED_ACCOUNT_TTL_DAYS + 1)
+        self.stale = [
+            CustomUser.objects.create_user(f"stale{i}@example.com", PASSWORD, date_joined=old) for i in range(3)
+        ]
+        self.kept = [
+            CustomUser.objects.create_user("verified@example.com", PASSWORD, date_joined=old, is_verified=True),
+            CustomUser.objects.create_user("staff@example.com", PASSWORD, date_joined=old, is_staff=True),
+            CustomUser.objects.create_user("recent@example.com", PASSWORD),
+        ]
+
+    def purge(self, **options):
+        call_command("purge_unverified_accounts", pause=0, stdout=io.StringIO(), **options)
+
+    def test_deletes_stale_unverified_accounts_with_profile_and_token(self):
+        self.purge()
+        stale_ids = [user.id for user in self.stale]
+        self.assertFalse(CustomUser.objects.filter(id__in=stale_ids).exists())
+        self.assertFalse(Profile.objects.filter(user_id__in=stale_ids).exists())
+        self.assertFalse(Token.objects.filter(user_id__in=stale_ids).exists())
+        self.assertEqual(set(CustomUser.objects.values_list("id", flat=True)), {user.id for user in self.kept})
+
+    def test_deletes_in_chunks(self):
+        with mock.patch.object(purge_unverified_accounts, "apply_bulk_action", wraps=apply_bulk_action) as delete:
+            self.purge(chunk_size=2)
+        self.assertEqual(delete.call_count, 2)
+        self.assertEqual(CustomUser.objects.count(), len(self.kept))
+
+    def test_dry_run_deletes_nothing(self):
+        self.purge(dry_run=True)
+        self.assertEqual(CustomUser.objects.count(), len(self.stale) + len(self.kept))
+
+    def test_inactive_users_keep_their_token_unless_asked(self):
+        user = CustomUser.objects.create_user("inactive@example.com", PASSWORD, is_verified=True, is_active=False)
+        Token.objects.get_or_create(user=user)
+
+        self.purge()
+        self.assertTrue(Token.objects.filter(user=user).exists())
+
+        self.purge(revoke_inactive_tokens=True)
+        self.assertFalse(Token.objects.filter(user=user).exists())
+
+
+@override_settings(ACCOUNTS_SHARDS=3, ACCOUNTS_SHARD_ALIASES=["accounts_0", "accounts_1", "accounts_2"])
+class ShardRoutingTests(SimpleTestCase):
+
+    def test_email_shard_is_stable_and_normalized(self):
+        shard = sharding.shard_for_email("Cashier@Example.com ")
+        self.assertEqual(shard, sharding.shard_for_email("cashier@example.com"))
+        shards = {sharding.shard_for_email(f"user{i}@example.com") for i in range(100)}
+        self.assertEqual(shards, {"accounts_0", "accounts_1", "accounts_2"})
+
+    def test_id_ranges_name_their_shard(self):
+        self.assertEqual(sharding.home_shard((2 << sharding.SHARD_ID_SHIFT) + 5), "accounts_1")
+        # Accounts from before sharding
+        self.assertEqual(sharding.home_shard(42), "default")
+
+    def test_tokens_carry_their_shard(self):
+        key = sharding.new_token_key("accounts_2")
+        self.assertEqual(len(key), 40)
+        self.assertEqual(sharding.shard_for_token(key), "accounts_2")
+        self.assertEqual(sharding.shard_for_token("9944b09199c62bcf9418ad846dd0e4bbdfc6ee4b"), "default")
+
+    @override_settings(ACCOUNTS_SHARDS=0, ACCOUNTS_SHARD_ALIASES=[])
+    def test_everything_is_default_when_off(self):
+        self.assertEqual(sharding.shard_for_email("cashier@example.com"), "default")
+        self.assertEqual(sharding.shard_for_id(2 << sharding.SHARD_ID_SHIFT), "default")
+        self.assertEqual(sharding.shard_for_token(sharding.new_token_key("default")), "default")
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    EMAIL_FILTER_PATH=EMAIL_FILTER_PATH,
+    AUDIT_LOG_ENABLED=False,
+    RATE_LIMIT_ENABLED=False,
+    ACCOUNTS_SHARDS=len(TEST_SHARD_ALIASES),
+    ACCOUNTS_SHARD_ALIASES=TEST_SHARD_ALIASES,
+)
+@mock.patch("accounts.views.send_registration_code_mail", return_value=200)
+class ShardedAccountsTests(TransactionTestCase):
+    """Registration, login, the admin and resharding with accounts spread over two shards."""
+
+    databases = {"default", *TEST_SHARD_ALIASES}
+
+    def setUp(self):
+        for alias in TEST_SHARD_ALIASES:
+            sharding.seed_shard_sequence(alias)
+        cache.clear()
+        rebuild_email_filter()
+        self.admin = CustomUser.objects.create_superuser("admin@example.com", PASSWORD)
+
+    def email_on(self, alias, name="cashier"):
+        return next(
+            email for email in (f"{name}{i}@example.com" for i in range(100)) if sharding.shard_for_email(email) == alias
+        )
+
+    def login(self, email):
+        client = APIClient()
+        response = client.post(reverse("login_view"), {"email": email, "password": PASSWORD}, format="json")
+        self.assertEqual(response.status_code, 200)
+        client.credentials(HTTP_AUTHORIZATION="Token " + response.data["token"])
+        response = client.get(reverse("user_profile"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["email"], email)
+
+    def test_register_and_login(self, send_mail):
+        email = self.email_on(TEST_SHARD_ALIASES[1])
+        data = {
+            "email": email,
+            "password": PASSWORD,
+            "password2": PASSWORD,
+            "first_name": "New",
+            "last_name": "User",
+            "gender": "female",
+        }
+        response = APIClient().post(reverse("create_user_view"), data, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sharding.home_shard(response.data["user_id"]), TEST_SHARD_ALIASES[1])
+        user = CustomUser.objects.using(TEST_SHARD_ALIASES[1]).select_related("profile").get(email=email)
+        self.assertEqual(user.profile.first_name, "New")
+        self.login(email)
+
+    def test_staff_stay_on_default(self, send_mail):
+        self.assertEqual(self.admin._state.db, "default")
+        self.assertEqual(self.admin.id, CustomUser.objects.using("default").get(email=self.admin.email).id)
+
+    def test_admin_manages_sharded_users(self, send_mail):
+        alias = TEST_SHARD_ALIASES[0]
+        self.client.force_login(self.admin)
+
+        email = self.email_on(alias)
+        response = self.client.post(
+            reverse("admin:accounts_customuser_add"),
+            {"email": email, "password1": PASSWORD, "password2": PASSWORD, "is_active": "on"},
+        )
+        self.assertEqual(response.status_code, 302)
+        user = CustomUser.objects.using(alias).get(email=email)
+
+        changelist = reverse("admin:accounts_customuser_changelist")
+        self.assertContains(self.client.get(changelist, {"database": alias}), email)
+        self.assertNotContains(self.client.get(changelist, {"database": "default"}), email)
+
+        response = self.client.post(
+            f"{changelist}?database={alias}",
+            {"action": "bulk_verify", "_selected_action": [user.id], "index": 0},
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(CustomUser.objects.using(alias).get(id=user.id).is_verified)
+
+        change = reverse("admin:accounts_customuser_change", args=[user.id])
+        self.assertEqual(self.client.get(change).status_code, 200)
+        response = self.client.post(change, {
+            "email": email,
+            "first_name": "Ada",
+            "last_name": "",
+            "code": "",
+            "is_verified": "on",
+            "is_active": "on",
+            "last_login_0": "",
+            "last_login_1": "",
+            "date_joined_0": "2024-01-01",
+            "date_joined_1": "00:00:00",
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(CustomUser.objects.using(alias).get(id=user.id).first_name, "Ada")
+
+        response = self.client.post(reverse("admin:accounts_customuser_delete", args=[user.id]), {"post": "yes"})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(CustomUser.objects.using(alias).filter(id=user.id).exists())
+        self.assertEqual(LogEntry.objects.filter(user=self.admin).count(), 3)
+
+    def test_reshard_moves_accounts_to_their_shard(self, send_mail):
+        email = self.email_on(TEST_SHARD_ALIASES[1])
+        user = CustomUser.objects.db_manager("default").create_user(email, PASSWORD)
+
+        call_command("reshard_accounts", pause=0, stdout=io.StringIO())
+
+        self.assertFalse(CustomUser.objects.using("default").filter(id=user.id).exists())
+        moved = CustomUser.objects.using(TEST_SHARD_ALIASES[1]).select_related("profile").get(id=user.id)
+        self.assertEqual(moved.profile.user_id, user.id)
+        self.assertEqual(sharding.shard_for_id(user.id), TEST_SHARD_ALIASES[1])
+        self.assertTrue(CustomUser.objects.using("default").filter(id=self.admin.id).exists())
+        self.login(email)
+
+    def test_purge_covers_every_shard(self, send_mail):
+        old = timezone.now() - timedelta(days=settings.UNVERIFIED_ACCOUNT_TTL_DAYS + 1)
+        users = [
+            CustomUser.objects.for_email(email).create_user(email, PASSWORD, date_joined=old)
+            for email in (self.email_on(alias) for alias in TEST_SHARD_ALIASES)
+        ]
+        self.assertEqual({user._state.db for user in users}, set(TEST_SHARD_ALIASES))
+
+        call_command("purge_unverified_accounts", pause=0, stdout=io.StringIO())
+
+        for user in users:
+            self.assertFalse(CustomUser.objects.using(user._state.db).filter(id=user.id).exists())
+        self.assertTrue(CustomUser.objects.filter(id=self.admin.id).exists())
+
+    def test_reshard_leaves_users_with_groups_in_place(self, send_mail):
+        user = CustomUser.objects.db_manager("default").create_user(self.email_on(TEST_SHARD_ALIASES[0]), PASSWORD)
+        user.groups.add(Group.objects.create(name="Cashiers"))
+
+        call_command("reshard_accounts", pause=0, stdout=io.StringIO())
+
+        user = CustomUser.objects.using("default").get(id=user.id)
+        self.assertEqual([group.name for group in user.groups.all()], ["Cashiers"])
+        self.assertFalse(CustomUser.objects.using(TEST_SHARD_ALIASES[0]).filter(id=user.id).exists())
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    EMAIL_FILTER_PATH=EMAIL_FILTER_PATH,
+    AUDIT_LOG_ENABLED=False,
+    RATE_LIMIT_ENABLED=True,
+    REST_FRAMEWORK={"DEFAULT_THROTTLE_RATES": {"login_ip": "100/m", "login_email": "2/m", "verify_user": "1/h"}},
+)
+class RateLimitTests(TestCase):
+
+    def setUp(self):
+        # A fresh bucket file per test
+        self.enterContext(self.settings(RATE_LIMIT_PATH=os.path.join(tempfile.mkdtemp(), "ratelimit.bin")))
+        rebuild_email_filter()
+        self.client = APIClient()
+        self.user = CustomUser.objects.create_user("cashier@example.com", PASSWORD)
+
+    def test_login_is_rejected_before_any_query(self):
+        data = {"email": self.user.email, "password": "Wr0ng-Passw0rd!"}
+        for _ in range(2):
+            self.assertEqual(self.client.post(reverse("login_view"), data, format="json").status_code, 400)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse("login_view"), {**data, "email": "Cashier@example.com"}, format="json")
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        self.assertEqual(len(context.captured_queries), 0)
+
+        # Other accounts are not affected
+        response = self.client.post(reverse("login_view"), {**data, "email": "other@example.com"}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_verification_guesses_are_limited(self):
+        data = {"user_id": self.user.id, "code": 1111}
+        self.assertEqual(self.client.post(reverse("verify_user_upon_registration"), data, format="json").status_code, 400)
+        self.assertEqual(self.client.post(reverse("verify_user_upon_registration"), data, format="json").status_code, 429)
+
+    def test_user_id_spellings_share_a_bucket(self):
+        url = reverse("verify_user_upon_registration")
+        self.assertEqual(self.client.post(url, {"user_id": str(self.user.id), "code": 1111}, format="json").status_code, 400)
+        for spelling in (f"0{self.user.id}", f" {self.user.id}", f"+{self.user.id}", f"{self.user.id}.0"):
+            response = self.client.post(url, {"user_id": spelling, "code": 1111}, format="json")
+            self.assertEqual(response.status_code, 429, spelling)
+
+    def test_throttled_requests_do_not_take_hashing_permits(self):
+        data = {"email": self.user.email, "password": "Wr0ng-Passw0rd!"}
+        for _ in range(2):
+            self.client.post(reverse("login_view"), data, format="json")
+
+        # Every permit is held: the throttle still answers, only the hashing itself waits
+        semaphore, _ = get_semaphore("password_hashing")
+        with mock.patch.object(semaphore, "acquire", return_value=None) as acquire:
+            self.assertEqual(self.client.post(reverse("login_view"), data, format="json").status_code, 429)
+            acquire.assert_not_called()
+            response = self.client.post(reverse("login_view"), {**data, "email": "other@example.com"}, format="json")
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+
+    def test_buckets_refill(self):
+        buckets = SharedTokenBuckets(os.path.join(tempfile.mkdtemp(), "ratelimit.bin"), 64)
+        self.assertEqual(buckets.hit("key", 2, 60, now=1000), 0)
+        self.assertEqual(buckets.hit("key", 2, 60, now=1000), 0)
+        self.assertAlmostEqual(buckets.hit("key", 2, 60, now=1000), 30)
+        self.assertEqual(buckets.hit("key", 2, 60, now=1030), 0)
+
+
+@override_settings(
+    PASSWORD_HASHERS=["accounts.hashers.CalibratedPBKDF2PasswordHasher", "django.contrib.auth.hashers.MD5PasswordHasher"],
+    EMAIL_FILTER_PATH=EMAIL_FILTER_PATH,
+    AUDIT_LOG_ENABLED=False,
+    RATE_LIMIT_ENABLED=False,
+)
+@mock.patch.dict(hashers.MINIMUM_COSTS["pbkdf2_sha256"], {"iterations": 1000})
+class CalibratedHasherTests(TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "hashers.json")
+        self.enterContext(self.settings(PASSWORD_HASH_CALIBRATION_PATH=self.path))
+        self.calibrate(2000)
+        rebuild_email_filter()
+        with self.settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"]):
+            self.user = CustomUser.objects.create_user("cashier@example.com", PASSWORD)
+
+    def calibrate(self, iterations):
+        with open(self.path, "w") as f:
+            json.dump({"hashers": {"pbkdf2_sha256": {"params": {"iterations": iterations}}}}, f)
+        # Rewritten within the mtime granularity of some filesystems
+        hashers._calibration.clear()
+
+    def login(self):
+        data = {"email": self.user.email, "password": PASSWORD}
+        self.assertEqual(APIClient().post(reverse("login_view"), data, format="json").status_code, 200)
+        self.user.refresh_from_db()
+        return self.user.password
+
+    def test_login_upgrades_stored_hash(self):
+        self.assertTrue(self.login().startswith("pbkdf2_sha256$2000$"))
+
+    def test_small_cost_changes_do_not_rehash(self):
+        encoded = self.login()
+        self.calibrate(2100)
+        self.assertEqual(self.login(), encoded)
+        self.calibrate(4000)
+        self.assertTrue(self.login().startswith("pbkdf2_sha256$4000$"))
+
+    def test_scrypt_rehashes_only_when_the_cost_changes(self):
+        hasher = hashers.CalibratedScryptPasswordHasher()
+        encoded = hasher.encode(PASSWORD, hasher.salt())
+        self.assertFalse(hasher.must_update(encoded))
+        with open(self.path, "w") as f:
+            json.dump({"hashers": {"scrypt": {"params": {"work_factor": 2 ** 15}}}}, f)
+        hashers._calibration.clear()
+        self.assertTrue(hasher.must_update(encoded))
+
+
+class CompressionMiddlewareTests(SimpleTestCase):
+
+    body = json.dumps([{"id": i, "email": f"cashier{i}@example.com", "role": "cashier"} for i in range(100)]).encode()
+
+    def compress(self, response, view=None):
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip")
+        if view is not None:
+            request.resolver_match = mock.Mock(func=view)
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def test_gzip_output_is_padded_by_a_random_length(self):
+        lengths = set()
+        for _ in range(20):
+            response = self.compress(HttpResponse(self.body, content_type="application/json"))
+            self.assertEqual(response["Content-Encoding"], "gzip")
+            self.assertEqual(gzip.decompress(response.content), self.body)
+            lengths.add(len(response.content))
+        self.assertGreater(len(lengths), 1)
+
+    def test_small_and_exempt_responses_are_left_alone(self):
+        response = self.compress(HttpResponse(b"{}", content_type="application/json"))
+        self.assertFalse(response.has_header("Content-Encoding"))
+        view = compression_exempt(lambda request: None)
+        response = self.compress(HttpResponse(self.body, content_type="application/json"), view)
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response.content, self.body)
+
+    def test_streaming_chunks_are_flushed_as_they_come(self):
+        chunks = [self.body[:1000], self.body[1000:]]
+        response = self.compress(StreamingHttpResponse(iter(chunks), content_type="application/json"))
+        decompressor = zlib.decompressobj(31)
+        output = list(response.streaming_content)
+        self.assertEqual(decompressor.decompress(output[0]), chunks[0])
+        self.assertEqual(gzip.decompress(b"".join(output)), self.body)
+
+
+def slow_view(request):
+    time.sleep(0.05)
+    return HttpResponse(b"ok")
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    EMAIL_FILTER_PATH=EMAIL_FILTER_PATH,
+    PROFILING_SECRET="profile-secret",
+    PROFILING_SAMPLE_RATE=0,
+    PROFILING_MODE="sample",
+)
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+        self.enterContext(self.settings(PROFILING_SPOOL_DIR=tempfile.mkdtemp()))
+
+    def profile(self, **headers):
+        request = RequestFactory().get("/auth/profile/", headers=headers)
+        return ProfilingMiddleware(slow_view)(request)
+
+    def read_capture(self, response):
+        with open(os.path.join(settings.PROFILING_SPOOL_DIR, response["X-Profile-Capture"])) as f:
+            return f.read()
+
+    def test_secret_header_profiles_the_request(self):
+        response = self.profile(x_profile_request="profile-secret")
+        self.assertIn("slow_view", self.read_capture(response))
+        self.assertFalse(self.profile(x_profile_request="wrong").has_header("X-Profile-Capture"))
+        with self.settings(PROFILING_SECRET=""):
+            self.assertFalse(self.profile(x_profile_request="").has_header("X-Profile-Capture"))
+
+    def test_requests_are_sampled_at_the_configured_rate(self):
+        with self.settings(PROFILING_SAMPLE_RATE=0.1), mock.patch("random.random", return_value=0.05):
+            self.assertTrue(self.profile().has_header("X-Profile-Capture"))
+        with self.settings(PROFILING_SAMPLE_RATE=0.1), mock.patch("random.random", return_value=0.5):
+            self.assertFalse(self.profile().has_header("X-Profile-Capture"))
+        self.assertFalse(self.profile().has_header("X-Profile-Capture"))
+
+    def test_asgi_profiles_the_thread_running_the_view(self):
+        async def get_response(request):
+            # What Django does with a sync view under ASGI
+            return await sync_to_async(slow_view, thread_sensitive=True)(request)
+
+        async def handle():
+            async with ThreadSensitiveContext():
+                request = RequestFactory().get("/", headers={"x_profile_request": "profile-secret"})
+                return await ProfilingMiddleware(get_response)(request)
+
+        response = asyncio.run(handle())
+        self.assertIn("slow_view", self.read_capture(response))
+
+    def test_captures_are_listed_and_downloaded_by_admins_only(self):
+        name = self.profile(x_profile_request="profile-secret")["X-Profile-Capture"]
+        client = APIClient()
+
+        cashier = CustomUser.objects.create_user("cashier@example.com", PASSWORD)
+        client.credentials(HTTP_AUTHORIZATION="Token " + cashier.auth_token.key)
+        self.assertEqual(client.get(reverse("profile_captures")).status_code, 403)
+        self.assertEqual(client.get(reverse("profile_capture_download", args=[name])).status_code, 403)
+
+        admin = CustomUser.objects.create_user("admin@example.com", PASSWORD, is_staff=True)
+        client.credentials(HTTP_AUTHORIZATION="Token " + admin.auth_token.key)
+        response = client.get(reverse("profile_captures"), {"route": "auth_profile.get"})
+        self.assertEqual([capture["name"] for capture in response.data], [name])
+        self.assertEqual(client.get(reverse("profile_captures"), {"route": "login_view.post"}).data, [])
+
+        response = client.get(reverse("profile_capture_download", args=[name]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"slow_view", b"".join(response.streaming_content))
+        response = client.get(reverse("profile_capture_download", args=["missing.collapsed"]))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    EMAIL_FILTER_PATH=EMAIL_FILTER_PATH,
+    MEMORY_TRACEMALLOC=False,
+    MEMORY_SNAPSHOT_INTERVAL=3600,
+)
+class MemoryAccountingTests(TestCase):
+
+    def setUp(self):
+        self.enterContext(self.settings(MEMORY_SPOOL_DIR=tempfile.mkdtemp()))
+        self.enterContext(mock.patch.object(memory, "_gunicorn_worker", None))
+
+    def write_worker(self, pid, updated):
+        with open(os.path.join(settings.MEMORY_SPOOL_DIR, f"worker-{pid}.json"), "w") as f:
+            json.dump({"pid": pid, "updated": updated}, f)
+
+    def test_route_stats(self):
+        stats = memory.RouteStats()
+        stats.add(1024)
+        stats.add(3072)
+        stats.add_allocations([{"where": f"app.py:{i}", "size_kb": i, "count": 1} for i in range(100)])
+        self.assertEqual(len(stats.allocations), memory.TOP_ALLOCATIONS * 2)
+        data = stats.as_dict()
+        self.assertEqual((data["requests"], data["avg_growth_kb"], data["max_growth_kb"]), (2, 2.0, 3.0))
+        self.assertEqual(data["top_allocations"][0], {"where": "app.py:99", "size_kb": 99, "count": 1})
+        self.assertEqual(len(data["top_allocations"]), memory.TOP_ALLOCATIONS)
+
+    def test_growth_per_1000_requests(self):
+        tracker = memory.MemoryTracker()
+        tracker.history = [(0, 100.0, 0), (1000, 102.0, 0), (2000, 104.0, 0)]
+        self.assertEqual(tracker.growth_per_1000_requests(), 2.0)
+        tracker.history = tracker.history[:1]
+        self.assertIsNone(tracker.growth_per_1000_requests())
+
+    @override_settings(MEMORY_RECYCLE_GROWTH_MB=10)
+    def test_recycles_once_past_the_growth_threshold(self):
+        tracker = memory.MemoryTracker()
+        # The first request sets the baseline
+        self.assertFalse(tracker.record("GET user_profile", 0, 100 * memory.MB))
+        self.assertFalse(tracker.record("GET user_profile", 100 * memory.MB, 109 * memory.MB))
+        self.assertTrue(tracker.record("GET user_profile", 109 * memory.MB, 111 * memory.MB))
+        self.assertFalse(tracker.record("GET user_profile", 111 * memory.MB, 112 * memory.MB))
+        self.assertEqual([worker["recycling"] for worker in memory.list_workers()], [True])
+
+    def test_only_gunicorn_workers_are_recycled(self):
+        middleware = MemoryAccountingMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().get("/", SERVER_SOFTWARE="uvicorn")
+        with mock.patch("os.kill") as kill:
+            middleware.recycle(request, 200 * memory.MB)
+            kill.assert_not_called()
+            memory.mark_gunicorn_worker()
+            middleware.recycle(request, 200 * memory.MB)
+            kill.assert_called_once_with(os.getpid(), signal.SIGTERM)
+
+    def test_list_workers_prunes_dead_workers(self):
+        for pid in range(1, 5):
+            self.write_worker(pid, updated=pid)
+        with open(os.path.join(settings.MEMORY_SPOOL_DIR, "worker-9.json"), "w") as f:
+            f.write("{")
+        with mock.patch.object(memory, "pid_alive", side_effect=lambda pid: pid == 1):
+            workers = memory.list_workers(keep=2)
+        self.assertEqual([(worker["pid"], worker["alive"]) for worker in workers], [(1, True), (4, False)])
+        self.assertEqual(
+            sorted(os.listdir(settings.MEMORY_SPOOL_DIR)), ["worker-1.json", "worker-4.json", "worker-9.json"]
+        )
+
+    def test_ops_memory_is_for_admins(self):
+        client = APIClient()
+        cashier = CustomUser.objects.create_user("cashier@example.com", PASSWORD)
+        client.credentials(HTTP_AUTHORIZATION="Token " + cashier.auth_token.key)
+        self.assertEqual(client.get(reverse("memory_workers")).status_code, 403)
+
+        admin = CustomUser.objects.create_user("admin@example.com", PASSWORD, is_staff=True)
+        client.credentials(HTTP_AUTHORIZATION="Token " + admin.auth_token.key)
+        response = client.get(reverse("memory_workers"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(os.getpid(), [worker["pid"] for worker in response.data])
+
+
+class SQLiteCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = SQLiteCache(os.path.join(tempfile.mkdtemp(), "cache.sqlite3"), {"OPTIONS": {"MAX_ENTRIES": 10}})
+
+    def test_add_and_incr_are_atomic_statements(self):
+        self.assertTrue(self.cache.add("lock", "a"))
+        self.assertFalse(self.cache.add("lock", "b"))
+        self.cache.set("counter", 1)
+        self.assertEqual(self.cache.incr("counter", 5), 6)
+        # Another worker sees the same row
+        other = SQLiteCache(self.cache.path, {})
+        self.assertEqual(other.decr("counter"), 5)
+        self.assertEqual(other.get("lock"), "a")
+        with self.assertRaises(ValueError):
+            other.incr("missing")
+
+    def test_expired_and_least_recently_used_entries_go(self):
+        self.cache.set("gone", 1, timeout=-1)
+        self.assertIsNone(self.cache.get("gone"))
+        self.assertTrue(self.cache.add("gone", 2))
+        with mock.patch("inventory_kooltech_be.sqlite_cache.CULL_EVERY", 1):
+            self.cache.set_many({f"key:{i}": i for i in range(20)})
+            self.cache.set("last", 1)
+        self.assertLessEqual(len(self.cache.get_many([f"key:{i}" for i in range(20)])), 10)
+        self.assertEqual(self.cache.get("last"), 1)
+
+    def test_get_many_keeps_rows_from_being_evicted(self):
+        self.cache.set_many({f"key:{i}": i for i in range(10)})
+        with mock.patch("time.time", return_value=time.time() + 60):
+            self.cache.get_many(["key:0"])
+            with mock.patch("inventory_kooltech_be.sqlite_cache.CULL_EVERY", 1):
+                self.cache.set_many({f"new:{i}": i for i in range(5)})
+        self.assertEqual(self.cache.get("key:0"), 0)
+
+    def test_state_cache_only_drops_expired_rows(self):
+        state = SQLiteCache(os.path.join(tempfile.mkdtemp(), "state.sqlite3"), {"OPTIONS": {"MAX_ENTRIES": 10, "EVICT": False}})
+        with mock.patch("inventory_kooltech_be.sqlite_cache.CULL_EVERY", 1):
+            state.set_many({f"key:{i}": i for i in range(30)})
+            state.set("gone", 1, timeout=-1)
+        self.assertEqual(len(state.get_many([f"key:{i}" for i in range(30)])), 30)
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    EMAIL_FILTER_PATH=EMAIL_FILTER_PATH,
+    AUDIT_LOG_ENABLED=False,
+    RATE_LIMIT_ENABLED=False,
+    SSE_POLL_INTERVAL=0.01,
+)
+class AccountEventStreamTests(TransactionTestCase):
+    # Streams read on pool threads, whose connections can't see a TestCase transaction
+
+    def setUp(self):
+        rebuild_email_filter()
+        self.user = CustomUser.objects.create_user("cashier@example.com", PASSWORD)
+        self.token = self.user.auth_token.key
+
+    async def get_ticket(self):
+        response = await self.async_client.post(reverse("stream_ticket_view"), headers={"Authorization": f"Token {self.token}"})
+        return response.json()["ticket"]
+
+    async def open_stream(self, **params):
+        response = await self.async_client.get(reverse("account_event_stream"), {"ticket": await self.get_ticket(), **params})
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        stream = aiter(response.streaming_content)
+        self.assertTrue((await anext(stream)).startswith(b"retry:"))
+        return stream
+
+    async def next_event(self, stream):
+        return (await asyncio.wait_for(anext(stream), 2)).decode()
+
+    async def test_state_then_published_events(self):
+        stream = await self.open_stream()
+        self.assertIn('event: state', await self.next_event(stream))
+
+        await sync_to_async(notifications.publish)(self.user.id, "verified", {"is_verified": True})
+        event = await self.next_event(stream)
+        self.assertIn("event: verified", event)
+        self.assertIn('"is_verified": true', event)
+        await stream.aclose()
+
+    async def test_events_of_other_workers_arrive_through_the_cache(self):
+        stream = await self.open_stream(last_event_id=await sync_to_async(notifications.current_sequence)())
+        with mock.patch("os.getpid", return_value=0):
+            # Published by "another process", only the poller can deliver it
+            await sync_to_async(notifications.publish)(self.user.id, "profile_updated", {"bio": "Hello"})
+        self.assertIn("event: profile_updated", await self.next_event(stream))
+        await stream.aclose()
+
+    async def test_replay_with_lost_events_asks_for_a_resync(self):
+        await sync_to_async(notifications.publish)(self.user.id, "verified", {"is_verified": True})
+        sequence = await sync_to_async(notifications.current_sequence)()
+        # Expired before the client came back
+        await sync_to_async(notifications.event_cache().delete)(notifications.EVENT_KEY.format(sequence))
+        stream = await self.open_stream(last_event_id=sequence - 1)
+        event = await self.next_event(stream)
+        self.assertIn(f"id: {sequence}", event)
+        self.assertIn("event: resync", event)
+        await stream.aclose()
+
+    async def test_tickets_are_single_use_and_tokens_stay_out_of_urls(self):
+        ticket = await self.get_ticket()
+        self.assertNotIn(self.token, ticket)
+        response = await self.async_client.get(reverse("account_event_stream"), {"ticket": ticket})
+        await response.streaming_content.aclose()
+        response = await self.async_client.get(reverse("account_event_stream"), {"ticket": ticket})
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.get(reverse("account_event_stream"), {"token": self.token})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_stream_closes_when_the_account_is_deactivated(self):
+        stream = await self.open_stream()
+        await self.next_event(stream)
+        await sync_to_async(notifications.publish)(self.user.id, "account_updated", {"action": "deactivate"})
+        self.assertIn("event: account_updated", await self.next_event(stream))
+        self.assertIn('"reason": "deactivate"', await self.next_event(stream))
+        with self.assertRaises(StopAsyncIteration):
+            await self.next_event(stream)
+
+    @override_settings(SSE_REVALIDATE_INTERVAL=0.05)
+    async def test_stream_closes_when_its_token_is_revoked(self):
+        stream = await self.open_stream()
+        await self.next_event(stream)
+        # Logging out deletes the token
+        await Token.objects.filter(key=self.token).adelete()
+        event = await self.next_event(stream)
+        self.assertIn("event: closed", event)
+        self.assertIn('"reason": "revoked"', event)
+
+    def test_sync_workers_refuse_streams(self):
+        response = self.client.get(reverse("account_event_stream"), headers={"Authorization": f"Token {self.token}"})
+        self.assertEqual(response.status_code, 501)
@@ -0,0 +1,124 @@
+from django.conf import settings
+
+from pydantic import TypeAdapter, ValidationError
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+from .email_filter import normalize_email
+from .ratelimit import get_rate_limiter
+
+
+class SharedRateThrottle(SimpleRateThrottle):
+    """
+    SimpleRateThrottle backed by the shared token buckets in accounts.ratelimit
+    instead of the (per worker) cache. Rates come from DEFAULT_THROTTLE_RATES.
+    DRF runs throttles before the view, so a rejected request never reaches
+    the ORM or the password hasher.
+    """
+
+    def get_rate(self):
+        # Read at instantiation so rates can be changed in settings and tests
+        return api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+
+    def allow_request(self, request, view):
+        if self.rate is None or not settings.RATE_LIMIT_ENABLED:
+            return True
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+        self.wait_seconds = get_rate_limiter().hit(key, self.num_requests, self.duration)
+        return not self.wait_seconds
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class ClientIPThrottle(SharedRateThrottle):
+    def get_cache_key(self, request, view):
+        return f"{self.scope}:{self.get_ident(request)}"
+
+
+# Coerces like the int fields of accounts.schemas, so "1", "01" and "+1" share user 1's bucket
+user_id_adapter = TypeAdapter(int)
+
+
+def normalize_user_id(value):
+    try:
+        return user_id_adapter.validate_python(value)
+    except ValidationError:
+        # The view rejects it before any lookup
+        return None
+
+
+class FieldThrottle(SharedRateThrottle):
+    """
+    Keyed by a field of the request body, normalized the way the view will
+    read it so that spelling a value differently does not give a new bucket.
+    Not throttled when the field is missing or invalid.
+    """
+    field = None
+
+    def normalize(self, value):
+        return value
+
+    def get_cache_key(self, request, view):
+        data = request.data
+        value = data.get(self.field) if hasattr(data, "get") else None
+        if value is None or value == "":
+            return None
+        value = self.normalize(value)
+        if value is None or value == "":
+            return None
+        return f"{self.scope}:{value}"
+
+
+class EmailThrottle(FieldThrottle):
+    field = "email"
+
+    def normalize(self, value):
+        return normalize_email(str(value))
+
+
+class UserIdThrottle(FieldThrottle):
+    field = "user_id"
+
+    def normalize(self, value):
+        return normalize_user_id(value)
+
+
+class LoginIPThrottle(ClientIPThrottle):
+    scope = "login_ip"
+
+
+class LoginEmailThrottle(EmailThrottle):
+    scope = "login_email"
+
+
+class BootstrapLoginIPThrottle(LoginIPThrottle):
+    """login_ip for the password half (POST) of session_bootstrap, revalidating with a token is not a login."""
+
+    def get_cache_key(self, request, view):
+        if request.method != "POST":
+            return None
+        return super().get_cache_key(request, view)
+
+
+class VerifyIPThrottle(ClientIPThrottle):
+    scope = "verify_ip"
+
+
+class VerifyUserThrottle(UserIdThrottle):
+    scope = "verify_user"
+
+
+class CodeIPThrottle(ClientIPThrottle):
+    scope = "code_ip"
+
+
+class CodeEmailThrottle(EmailThrottle):
+    scope = "code_target"
+
+
+class CodeUserThrottle(UserIdThrottle):
+    scope = "code_target"
+
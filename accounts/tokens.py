@@ -0,0 +1,217 @@
+"""
+Signed access tokens and refresh tokens (ACCOUNTS_AUTH_MODE = "signed").
+
+An access token is an HMAC signed, timestamped payload carrying the user's id,
+email, role and flags. It is checked without touching the database and lives
+ACCESS_TOKEN_LIFETIME seconds. A refresh token is a random secret of which
+only the digest is stored. Refreshing rotates it.
+
+Revoked access tokens are remembered in this process and in the cache until
+they would have expired anyway. Revoking everything a user holds (logout on
+all devices, deactivation, role change) stores a "not before" time for the
+user instead.
+
+A stream ticket opens one event stream (EventSource can't send an
+Authorization header, so it goes in the query string). It lives
+STREAM_TICKET_LIFETIME seconds, is accepted once and carries a grant instead
+of the token it was issued for, so one showing up in an access log is useless.
+"""
+
+import hashlib
+import secrets
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.cache import caches
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .bulk import users_bulk_updated
+from .models import RefreshToken
+from .sharding import shard_for_id, shard_for_token, shard_token
+
+
+ACCESS_SALT = "accounts.tokens.access"
+STREAM_TICKET_SALT = "accounts.tokens.stream"
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def signed_tokens_enabled():
+    return getattr(settings, "ACCOUNTS_AUTH_MODE", "token") == "signed"
+
+
+def is_signed_token(token):
+    # DRF tokens are 40 hex characters, signed tokens always contain the signer separator
+    return ":" in token
+
+
+def access_lifetime():
+    return getattr(settings, "ACCESS_TOKEN_LIFETIME", 300)
+
+
+# Revocation
+
+_revoked = {}  # jti -> expiry timestamp
+
+
+def revocation_cache():
+    # Must not evict: a dropped entry would make a revoked token valid again
+    return caches[getattr(settings, "TOKEN_REVOCATION_CACHE", "default")]
+
+
+def _prune_revoked(now):
+    for jti, expires in list(_revoked.items()):
+        if expires <= now:
+            del _revoked[jti]
+
+
+def revoke_access_token(claims):
+    expires = claims["i"] + access_lifetime()
+    ttl = int(expires - time.time()) + 1
+    if ttl <= 0:
+        return
+    _prune_revoked(time.time())
+    _revoked[claims["j"]] = expires
+    revocation_cache().set(f"accounts:revoked:{claims['j']}", 1, timeout=ttl)
+
+
+def revoke_user_tokens(user_ids):
+    """Reject every access token issued so far to these users."""
+    now = time.time()
+    revocation_cache().set_many({f"accounts:not-before:{user_id}": now for user_id in user_ids}, timeout=access_lifetime() + 1)
+
+
+@receiver(users_bulk_updated)
+def revoke_tokens_after_bulk_update(sender, action, user_ids, using="default", **kwargs):
+    revoke_user_tokens(user_ids)
+    if action in ("deactivate", "delete"):
+        RefreshToken.objects.using(using).filter(user_id__in=user_ids).delete()
+
+
+def is_revoked(claims):
+    if claims["j"] in _revoked:
+        return True
+    shared = revocation_cache().get_many([f"accounts:revoked:{claims['j']}", f"accounts:not-before:{claims['u']}"])
+    if shared.get(f"accounts:revoked:{claims['j']}"):
+        return True
+    not_before = shared.get(f"accounts:not-before:{claims['u']}")
+    return not_before is not None and claims["i"] <= not_before
+
+
+# Access tokens
+
+def issue_access_token(user):
+    claims = {
+        "u": user.pk,
+        "e": user.email,
+        "r": user.role,
+        "v": user.is_verified,
+        "s": user.is_staff,
+        "su": user.is_superuser,
+        "i": time.time(),
+        "j": secrets.token_urlsafe(8),
+    }
+    return signing.dumps(claims, salt=ACCESS_SALT)
+
+
+def read_access_token(token):
+    """Return the claims of a valid access token, or raise InvalidToken."""
+    try:
+        claims = signing.loads(token, salt=ACCESS_SALT, max_age=access_lifetime())
+    except signing.SignatureExpired:
+        raise InvalidToken("Access token has expired.")
+    except signing.BadSignature:
+        raise InvalidToken("Invalid token.")
+    if is_revoked(claims):
+        raise InvalidToken("Access token has been revoked.")
+    return claims
+
+
+def user_from_claims(claims):
+    """An unsaved-looking User built from the claims, no query involved."""
+    User = get_user_model()
+    user = User(
+        id=claims["u"],
+        email=claims["e"],
+        role=claims["r"],
+        is_verified=claims["v"],
+        is_staff=claims["s"],
+        is_superuser=claims["su"],
+        is_active=True,
+    )
+    user._state.adding = False
+    user._state.db = shard_for_id(claims["u"])
+    return user
+
+
+# Stream tickets
+
+def stream_ticket_lifetime():
+    return getattr(settings, "STREAM_TICKET_LIFETIME", 30)
+
+
+def issue_stream_ticket(grant):
+    """``grant`` says what the stream re-checks while it is open, see authentication.stream_grant()."""
+    return signing.dumps({"g": grant, "j": secrets.token_urlsafe(8)}, salt=STREAM_TICKET_SALT)
+
+
+def redeem_stream_ticket(ticket):
+    """Return the grant of a valid, unused stream ticket, or raise InvalidToken."""
+    try:
+        claims = signing.loads(ticket, salt=STREAM_TICKET_SALT, max_age=stream_ticket_lifetime())
+    except signing.SignatureExpired:
+        raise InvalidToken("Stream ticket has expired.")
+    except signing.BadSignature:
+        raise InvalidToken("Invalid stream ticket.")
+    # Only the first request to present it gets to add the marker
+    if not revocation_cache().add(f"accounts:stream-ticket:{claims['j']}", 1, timeout=stream_ticket_lifetime() + 1):
+        raise InvalidToken("Stream ticket has already been used.")
+    return claims["g"]
+
+
+# Refresh tokens
+
+def _digest(token):
+    return hashlib.sha256(token.encode()).digest()
+
+
+def issue_refresh_token(user):
+    token = shard_token(user._state.db, secrets.token_urlsafe(32))
+    lifetime = getattr(settings, "REFRESH_TOKEN_LIFETIME", 60 * 60 * 24 * 14)
+    RefreshToken.objects.using(user._state.db).create(user=user, digest=_digest(token), expires_at=timezone.now() + timedelta(seconds=lifetime))
+    return token
+
+
+def issue_token_pair(user):
+    return {
+        "token": issue_access_token(user),
+        "refresh": issue_refresh_token(user),
+        "expires_in": access_lifetime(),
+    }
+
+
+def rotate_refresh_token(token):
+    """Swap a refresh token for a new access/refresh pair, or raise InvalidToken."""
+    tokens = RefreshToken.objects.using(shard_for_token(token)).filter(digest=_digest(token or ""))
+    refresh = tokens.select_related("user").first()
+    if refresh is None:
+        raise InvalidToken("Invalid refresh token.")
+    # Of two requests racing with the same token only the one whose DELETE removed the row gets a pair
+    deleted, _ = tokens.delete()
+    if deleted != 1:
+        raise InvalidToken("Invalid refresh token.")
+    if refresh.expires_at <= timezone.now():
+        raise InvalidToken("Refresh token has expired.")
+    if not refresh.user.is_active:
+        raise InvalidToken("User is inactive.")
+    return refresh.user, issue_token_pair(refresh.user)
+
+
+def revoke_refresh_token(token):
+    RefreshToken.objects.using(shard_for_token(token)).filter(digest=_digest(token or "")).delete()
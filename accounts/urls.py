@@ -7,16 +7,28 @@ from .views import (
     verify_user_retry_code,
     login_view,
     logout_view,
+    session_bootstrap,
+    stream_ticket_view,
+    account_event_stream,
+    bulk_user_operations,
+    token_refresh_view,
+    auth_events,
 
 )
 
 urlpatterns = [
     path('users/', create_user_view, name="create_user_view"),
+    path('users/bulk/', bulk_user_operations, name="bulk_user_operations"), # action, ids | filter
     path('login/', login_view, name="login_view"),
     path('logout/', logout_view, name="logout_view"),
+    path('bootstrap/', session_bootstrap, name="session_bootstrap"), # email, password (POST) | token (GET); ?fields=
+    path('token/refresh/', token_refresh_view, name="token_refresh_view"), # refresh
+    path('events/', auth_events, name="auth_events"), # kind, user_id, email, after_id, limit
     path('verify-user-upon-registration/', verify_user_upon_registration, name="verify_user_upon_registration"), # code, user_id
 
     path('profile/', user_profile, name="user_profile"),
+    path('stream/ticket/', stream_ticket_view, name="stream_ticket_view"),
+    path('stream/', account_event_stream, name="account_event_stream"), # ticket, last_event_id (EventSource, ASGI only)
     
     path('forget-password-with-email/', forget_password_view_email, name="forget_password_view_email"), # email
     path('verify-user-retry-code/', verify_user_retry_code, name="verify_user_retry_code"), # user_id
@@ -2,13 +2,20 @@
 from django.shortcuts import render
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+
+from asgiref.sync import sync_to_async
 
 from cloudinary.uploader import upload
 from decouple import config
 
 # Rest Framework
 from rest_framework import status
-from rest_framework.decorators import api_view, permission_classes, authentication_classes, parser_classes
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.decorators import api_view, permission_classes, authentication_classes, parser_classes, throttle_classes
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.parsers import MultiPartParser, FormParser
@@ -16,12 +23,14 @@ from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 
+from inventory_kooltech_be.concurrency import concurrency_limited
+from inventory_kooltech_be.middleware import compression_exempt
+
 from .serializers import UserProfileSerializer
 
-from .models import Profile
+from .models import Profile, RefreshToken
 
 from .helpers import (
-    check_email, 
     check_password,
     send_registration_code_mail,
     generate_4_digit_code,
@@ -29,7 +38,56 @@ from .helpers import (
 
 )
 
-from .permissions import IsUserVerified
+from .permissions import IsUserVerified, IsManager
+from .throttling import (
+    LoginIPThrottle,
+    LoginEmailThrottle,
+    BootstrapLoginIPThrottle,
+    VerifyIPThrottle,
+    VerifyUserThrottle,
+    CodeIPThrottle,
+    CodeEmailThrottle,
+    CodeUserThrottle,
+)
+from .idempotency import idempotent
+from .email_filter import email_may_exist
+from .authentication import AUTHENTICATION_CLASSES, PROFILE_AUTHENTICATION_CLASSES, authenticate_stream, stream_grant
+from .tokens import (
+    InvalidToken,
+    signed_tokens_enabled,
+    is_signed_token,
+    issue_stream_ticket,
+    issue_token_pair,
+    read_access_token,
+    revoke_access_token,
+    revoke_refresh_token,
+    revoke_user_tokens,
+    rotate_refresh_token,
+    stream_ticket_lifetime,
+)
+from .bulk import apply_bulk_action, BulkActionError, ALLOWED_FILTERS, API_ACTIONS
+from .schemas import (
+    validate_request,
+    RegistrationRequest,
+    LoginRequest,
+    EmailRequest,
+    VerificationRequest,
+    RetryCodeRequest,
+    ProfileUpdateRequest,
+)
+from .audit import record_event, flush_events, query_events
+from .sharding import new_token_key, shard_for_token, user_databases
+from .bootstrap import (
+    InvalidFields,
+    build_bootstrap,
+    compute_etag,
+    etag_matches,
+    parse_fields,
+    permission_snapshot,
+    profile_snapshot,
+    select_fields,
+)
+from .notifications import publish, stream_events
 
 
 # Global User
@@ -37,54 +95,17 @@ User = get_user_model()
 
 
 @api_view(['POST'])
+@idempotent
+@concurrency_limited("password_hashing")
 def create_user_view(request):
     if request.method == 'POST':
-        email = request.data.get("email")
-        password = request.data.get("password", None)
-        password2 = request.data.get("password2", None)
-        first_name = request.data.get("first_name", None)
-        last_name = request.data.get("last_name", None)
-        phone_number = request.data.get("phone_number")
-        gender = request.data.get("gender")
-        address = request.data.get("address")
-        birth_date = request.data.get("birth_date", None)
-        bio = request.data.get("bio", None)
-
-        # Check for missing fields
-        if not email:
-            return Response({"detail": "Email is a required field"}, status=status.HTTP_400_BAD_REQUEST)
-        
-        if not password:
-            return Response({"detail": "Password is required"}, status=status.HTTP_400_BAD_REQUEST)
-        
-        if not password2:
-            return Response({"detail": "Confirm Password is required"}, status=status.HTTP_400_BAD_REQUEST)
-        
-        if password != password2:
-            return Response({"detail": "Passwords must match"}, status=status.HTTP_400_BAD_REQUEST)
-
-        GENDER_CHOICES = ["male", "female"]
-        
-        if gender not in GENDER_CHOICES:
-            return Response({"detail": "Gender is required and must be either a male or female"}, status=status.HTTP_400_BAD_REQUEST)
-
-    
-        if not all([first_name, last_name]):
-            return Response({"detail": "First Name and Last Name are all required."}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Validate email and password using Django validators
-        email_valid_status = check_email(email)
-        password_valid_status = check_password(password)
-
-        if not email_valid_status.status:
-            return Response({"detail": " ".join(email_valid_status.error_messages)}, status=status.HTTP_400_BAD_REQUEST)
-
-        if not password_valid_status.status:
-            return Response({"detail": " ".join(password_valid_status.error_messages)}, status=status.HTTP_400_BAD_REQUEST)
+        payload, errors = validate_request(RegistrationRequest, request.data)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        email = payload.email
 
         # Lastly Check if user already exists
-        existing_user = User.objects.filter(email=email)
-        if len(existing_user) > 1 or existing_user:
+        if email_may_exist(email) and User.objects.find_by_email(email) is not None:
             return Response({
                 "detail": "User with email already exists."
             }, status=status.HTTP_400_BAD_REQUEST)
@@ -92,29 +113,27 @@ def create_user_view(request):
             # Finally create user Create user
             code = generate_4_digit_code()
 
-            data = request.data
-            user = User.objects.create(email=email)
+            user = User.objects.for_email(email).create(email=email)
             user.code = code
-            user.set_password(password)
+            user.set_password(payload.password)
 
             user.save()
 
             
             
 
-            user.profile.first_name = first_name
-            user.profile.last_name = last_name
-            user.profile.phone_number = phone_number
-            user.profile.gender = gender
-            user.profile.birth_date = birth_date
-            user.profile.address = address
-            user.profile.bio = bio
+            user.profile.first_name = payload.first_name
+            user.profile.last_name = payload.last_name
+            user.profile.phone_number = payload.phone_number
+            user.profile.gender = payload.gender
+            user.profile.birth_date = payload.birth_date
+            user.profile.address = payload.address
+            user.profile.bio = payload.bio
 
             user.profile.save()
             user.save()
 
             token_key = user.auth_token.key
-            print(data)
             user_details = {
                 "message": f"A verification code was sent to {user.email}",
                 # "auth_token": token_key,
@@ -128,6 +147,7 @@ def create_user_view(request):
             }
 
             send_registration_code_mail(code, user.email)
+            record_event("code_issued", request, user, reason="registration")
             
 
             return Response(user_details, status=status.HTTP_201_CREATED)
@@ -138,19 +158,22 @@ def create_user_view(request):
 
 # Forget Password view
 @api_view(['POST'])
+@throttle_classes([CodeIPThrottle, CodeEmailThrottle])
+@idempotent
 def forget_password_view_email(request):
     """
     This view sends password reset code to user's email
     
     """
     # Get user email
-    data = request.data
-    email = data.get("email")
+    payload, errors = validate_request(EmailRequest, request.data)
+    if errors:
+        return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+    email = payload.email
     code_generated = generate_4_digit_code()
     # Check if user with email exists in the database
-    try:
-        user = User.objects.get(email=email)
-    except User.DoesNotExist:
+    user = User.objects.find_by_email(email) if email_may_exist(email) else None
+    if user is None:
         return Response({"detail": "User with email does not exist"}, status=status.HTTP_400_BAD_REQUEST)
     
     # Set the code in the user email
@@ -160,6 +183,7 @@ def forget_password_view_email(request):
     # Here we should sent a verification code to user for confirmation of their identity
     # Send code verification to provided email
     response_gotten_from_code = send_registration_code_mail(code_generated, email)
+    record_event("code_issued", request, user, reason="password_reset", mail_status=response_gotten_from_code)
 
     # Return a response
     if response_gotten_from_code == 200:
@@ -172,15 +196,18 @@ def forget_password_view_email(request):
 
 # Verify user registration
 @api_view(['POST'])
+@throttle_classes([VerifyIPThrottle, VerifyUserThrottle])
 def verify_user_upon_registration(request):
     """Verifies a user upon registration using the provided code"""
-    data = request.data
-    code = data.get("code")
-    user_id = data.get("user_id")
+    payload, errors = validate_request(VerificationRequest, request.data)
+    if errors:
+        return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+    code = payload.code
+    user_id = payload.user_id
 
     # Check if user exists in database
     try:
-        user = User.objects.get(id=user_id)
+        user = User.objects.for_id(user_id).get(id=user_id)
     except User.DoesNotExist:
         return Response({"detail": "User does not exist."}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -190,31 +217,39 @@ def verify_user_upon_registration(request):
             user.is_verified = True
             user.code = None
             user.save()
+            record_event("verified", request, user)
+            publish(user.id, "verified", {"is_verified": True})
             return Response({
                 "message": "Account has been verified successfully. Proceed to login.",
             }, status=status.HTTP_200_OK)
         else:
+            record_event("verification_failed", request, user)
             return Response({"detail": "User code is invalid"}, status=status.HTTP_400_BAD_REQUEST)
     except AssertionError:
+        record_event("verification_failed", request, user, reason="malformed_code")
         return Response({"detail": "Values must be valid integers"}, status=status.HTTP_400_BAD_REQUEST)
 
 
 
 # Retry Verify user registration
 @api_view(['POST'])
+@throttle_classes([CodeIPThrottle, CodeUserThrottle])
+@idempotent
 def verify_user_retry_code(request):
     """
     Resend verification code to user mail
     All that is needed to perform this task is the user_id
     """
-    data = request.data
-    user_id = data.get("user_id")
+    payload, errors = validate_request(RetryCodeRequest, request.data)
+    if errors:
+        return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+    user_id = payload.user_id
     # Generate and send new profile code
     code_generated = generate_4_digit_code()
 
     # Check if user exists
     try:
-        user = User.objects.get(id=user_id)
+        user = User.objects.for_id(user_id).get(id=user_id)
     except User.DoesNotExist:
         # print("User does not exist.")
         return Response({"detail": "Invalid user id. User does not exist."}, status=status.HTTP_400_BAD_REQUEST)
@@ -224,6 +259,7 @@ def verify_user_retry_code(request):
     user.save()
 
     response_gotten_from_code = send_registration_code_mail(code_generated, user.email)
+    record_event("code_issued", request, user, reason="retry", mail_status=response_gotten_from_code)
     if response_gotten_from_code == 200:
         return Response({"message": "Code was resent to your email"}, status=status.HTTP_200_OK)
     else:
@@ -235,7 +271,7 @@ def verify_user_retry_code(request):
 
 # GET AND UPDATE USER PROFILE
 @api_view(['GET', 'PUT'])
-@authentication_classes([TokenAuthentication])
+@authentication_classes(AUTHENTICATION_CLASSES)
 @permission_classes([IsAuthenticated])
 @parser_classes([MultiPartParser, FormParser])
 def user_profile(request):
@@ -252,33 +288,23 @@ def user_profile(request):
                 "image_url": user.profile.image_url,
                 "bio": user.profile.bio,
                 "role": user.role,
-                "permissions": {
-                    "is_superuser": user.is_superuser,
-                    "is_manager": user.role == "manager",
-                    "is_cashier": user.role == "cashier",
-                    "is_verified": user.is_verified,
-                }
+                "permissions": permission_snapshot(user),
             }
             return Response(user_profile_data, status=status.HTTP_200_OK)
         else:
             return Response({"detail": "Authorization header not found in the request."}, status=status.HTTP_400_BAD_REQUEST)
 
     elif request.method == "PUT":
-        # Profile details
-        first_name = request.data.get("first_name", user.profile.first_name)
-        last_name = request.data.get("last_name", user.profile.last_name)
-        phone_number = request.data.get("phone_number", user.profile.phone_number)
-        address = request.data.get("address", user.profile.address)
-        gender = request.data.get("gender", user.profile.gender)
-        role = request.data.get("role", user.role)
-        birth_date = request.data.get("birth_date", user.profile.birth_date)
-        bio = request.data.get("bio", user.profile.bio)
+        # Profile details, only the fields that were sent are changed
+        payload, errors = validate_request(ProfileUpdateRequest, request.data)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
         # Handle the image upload to Cloudinary
         image = request.FILES.get('image', None)
 
         try:
-            profile = Profile.objects.get(user=request.user)
+            profile = Profile.objects.using(user._state.db).get(user=request.user)
         except Profile.DoesNotExist:
             return Response({"detail": "Profile was not  found"}, status=status.HTTP_404_NOT_FOUND)
         
@@ -291,15 +317,11 @@ def user_profile(request):
                 return Response({"detail": "Image upload failed", "error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
 
-        profile.first_name = first_name
-        profile.last_name = last_name
-        profile.phone_number = phone_number
-        profile.address = address
-        profile.gender = gender
-        profile.birth_date = birth_date
-        profile.bio = bio
+        for field in payload.model_fields_set:
+            setattr(profile, field, getattr(payload, field))
         
         profile.save()
+        publish(user.id, "profile_updated", profile_snapshot(profile))
 
         serializer = UserProfileSerializer(profile)
         
@@ -311,8 +333,9 @@ def user_profile(request):
 
 # CHANGE LOGGED IN USER PASSWORD
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication])
+@authentication_classes(AUTHENTICATION_CLASSES)
 @permission_classes([IsAuthenticated])
+@concurrency_limited("password_hashing")
 def change_user_password(request):
     data = request.data
     
@@ -332,7 +355,7 @@ def change_user_password(request):
     # It is highly unlikely that user does not
     # exist given the token
     try:
-        user = User.objects.get(id=request.user.id)
+        user = User.objects.for_id(request.user.id).get(id=request.user.id)
     except User.DoesNotExist:
         return Response({"detail": " ".join(["Invalid user credentials. User does not exist."])}, status=status.HTTP_404_NOT_FOUND)
     
@@ -342,6 +365,7 @@ def change_user_password(request):
     
     # Check if old_password field is correct or wrong
     if not user.check_password(old_password):
+        record_event("password_changed", request, user, success=False)
         return Response({"detail": " ".join(["Old Password entered is incorrect"])}, status=status.HTTP_400_BAD_REQUEST)
     
     # Check if passwords meet the django validation score
@@ -356,64 +380,132 @@ def change_user_password(request):
     # Finally update password
     user.set_password(new_password)
     user.save()
+    record_event("password_changed", request, user, success=True)
+
+    if signed_tokens_enabled():
+        # Sign out every other device, this one gets a fresh pair
+        revoke_user_tokens([user.pk])
+        RefreshToken.objects.using(user._state.db).filter(user=user).delete()
+        return Response({"message": "Password was successfully updated.", **issue_token_pair(user)}, status=status.HTTP_200_OK)
     return Response({"message": "Password was successfully updated."}, status=status.HTTP_200_OK)
 
 
 # USER LOGOUT VIEW
+@compression_exempt
 @api_view(['POST'])
+@throttle_classes([LoginIPThrottle, LoginEmailThrottle])
+@concurrency_limited("password_hashing")
 def login_view(request):
-    data = request.data
-    email = data.get("email")
-    password = data.get("password")
-
-    if not all([email, password]):
-        return Response({'detail': "User email and password are required."}, status=status.HTTP_400_BAD_REQUEST)
-    
-    email_valid_status = check_email(email)
-    password_valid_status = check_password(password)
-
-    if not email_valid_status.status:
-        return Response({"detail": " ".join(email_valid_status.error_messages)}, status=status.HTTP_400_BAD_REQUEST)
-
-    if not password_valid_status.status:
-        return Response({"detail": " ".join(password_valid_status.error_messages)}, status=status.HTTP_400_BAD_REQUEST)
+    payload, errors = validate_request(LoginRequest, request.data)
+    if errors:
+        return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+    email = payload.email
+    password = payload.password
 
     # Check if user with email exists
-    users = User.objects.filter(email=email)
-
-    user = users.first()
+    user = User.objects.find_by_email(email) if email_may_exist(email) else None
 
-    user_exists = users.exists()
-
-    if not user_exists:
+    if user is None:
+        record_event("login_failed", request, email=email, reason="unknown_email")
         return Response({"detail": "User with email does not exist. "}, status=status.HTTP_400_BAD_REQUEST)
     
     if not user.check_password(password):
+        record_event("login_failed", request, user, reason="bad_password")
         return Response({"detail": "User password is not correct"}, status=status.HTTP_400_BAD_REQUEST)
 
-    oldTokens = Token.objects.filter(user__id=user.id)
+    user_details = {
+        'user_id': user.pk,
+        'email': user.email,
+        "permissions": permission_snapshot(user),
+    }
+
+    record_event("login", request, user, mode="signed" if signed_tokens_enabled() else "token")
+    return Response({**issue_login_tokens(user), **user_details})
+
+
+def issue_login_tokens(user):
+    # Signed mode: no token rows are touched, the refresh token is one insert
+    if signed_tokens_enabled():
+        return issue_token_pair(user)
+
+    oldTokens = Token.objects.using(user._state.db).filter(user__id=user.id)
     for token in oldTokens:
         token.delete()
 
-    token, _ = Token.objects.get_or_create(user=user)
+    token, _ = Token.objects.using(user._state.db).get_or_create(user=user, defaults={"key": new_token_key(user._state.db)})
+    return {'token': token.key}
 
-    return Response({
-        'token': token.key,
-        'user_id': user.pk,
-        'email': user.email,
-        "permissions": {
-            "is_superuser": user.is_superuser,
-            "is_manager": user.role == "manager",
-            "is_cashier": user.role == "cashier",
-            "is_verified": user.is_verified,
-        }
-    })
+
+# EVERYTHING THE APP NEEDS ON START: TOKEN, PROFILE AND PERMISSIONS
+@compression_exempt
+@api_view(['GET', 'POST'])
+@authentication_classes(PROFILE_AUTHENTICATION_CLASSES)
+@throttle_classes([BootstrapLoginIPThrottle, LoginEmailThrottle])
+@concurrency_limited("password_hashing", methods=("POST",))
+def session_bootstrap(request):
+    """
+    POST email/password logs in like login_view. GET with the token the app
+    already holds revalidates it. Both read the user and profile in a single
+    joined query. See accounts.bootstrap for ?fields= and the ETag.
+    """
+    try:
+        selected = parse_fields(request.query_params.get("fields"))
+    except InvalidFields as e:
+        return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    if request.method == 'POST':
+        payload, errors = validate_request(LoginRequest, request.data)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        email = payload.email
+
+        user = User.objects.find_by_email(email, related=("profile",)) if email_may_exist(email) else None
+        if user is None:
+            record_event("login_failed", request, email=email, reason="unknown_email")
+            return Response({"detail": "User with email does not exist. "}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not user.check_password(payload.password):
+            record_event("login_failed", request, user, reason="bad_password")
+            return Response({"detail": "User password is not correct"}, status=status.HTTP_400_BAD_REQUEST)
+
+        record_event("login", request, user, mode="signed" if signed_tokens_enabled() else "token", via="bootstrap")
+        # Without the token section this is only a password check, the tokens the app holds stay valid
+        tokens = issue_login_tokens(user) if "token" in selected else {}
+    else:
+        if not request.user.is_authenticated:
+            return Response({"detail": "Authentication credentials were not provided."}, status=status.HTTP_401_UNAUTHORIZED)
+
+        user = request.user
+        if not User.profile.is_cached(user):
+            # Signed tokens carry no profile, ProfileTokenAuthentication already joined it
+            user = User.objects.for_id(user.pk).select_related("profile").filter(pk=user.pk).first()
+            if user is None:
+                return Response({"detail": "User does not exist."}, status=status.HTTP_404_NOT_FOUND)
+        tokens = {"token": request.auth if isinstance(request.auth, str) else request.auth.key}
+
+    try:
+        profile = user.profile
+    except Profile.DoesNotExist:
+        return Response({"detail": "Profile was not  found"}, status=status.HTTP_404_NOT_FOUND)
+
+    data = select_fields({"token": tokens, **build_bootstrap(user, profile)}, selected)
+    etag = compute_etag(data)
+
+    if request.method == 'GET' and etag_matches(request.headers.get("If-None-Match"), etag):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(data, status=status.HTTP_200_OK)
+
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ("Authorization",))
+    return response
 
 
 
 # USER LOGOUT VIEW
 @api_view(['POST'])
-@authentication_classes([TokenAuthentication])
+@authentication_classes(AUTHENTICATION_CLASSES)
 @permission_classes([IsAuthenticated])
 def logout_view(request):
     user = request.user
@@ -423,40 +515,185 @@ def logout_view(request):
         # Extract the token from the Authorization header
         auth_header = request.headers['Authorization']
         _, token = auth_header.split()  # Assuming the token is separated by a space after "Token"
+
+        if is_signed_token(token):
+            try:
+                revoke_access_token(read_access_token(token))
+            except InvalidToken:
+                return Response({"detail": "Invalid token."}, status=status.HTTP_401_UNAUTHORIZED)
+            revoke_refresh_token(request.data.get("refresh"))
+            record_event("logout", request, user)
+            return Response({"detail": "Logged out successfully."}, status=status.HTTP_200_OK)
         
         # Check if the token exists in the database
         try:
-            user_token = Token.objects.get(key=token)
+            user_token = Token.objects.using(shard_for_token(token)).get(key=token)
             user_token.delete()
         except Token.DoesNotExist:
             return Response({"detail": "Invalid token."}, status=status.HTTP_401_UNAUTHORIZED)
 
-        token, _ = Token.objects.get_or_create(user=user)
+        token, _ = Token.objects.using(user._state.db).get_or_create(user=user, defaults={"key": new_token_key(user._state.db)})
+        record_event("logout", request, user)
 
         return Response({"detail": "Logged out successfully."}, status=status.HTTP_200_OK)
     else:
         return Response({"detail": "Authentication credentials were not provided."}, status=status.HTTP_401_UNAUTHORIZED)
 
 
+# SHORT LIVED, SINGLE USE TICKET THAT OPENS ONE EVENT STREAM
+@compression_exempt
+@api_view(['POST'])
+@authentication_classes(AUTHENTICATION_CLASSES)
+@permission_classes([IsAuthenticated])
+def stream_ticket_view(request):
+    ticket = issue_stream_ticket(stream_grant(request.user, request.auth))
+    return Response({"ticket": ticket, "expires_in": stream_ticket_lifetime()}, status=status.HTTP_200_OK)
 
 
+# ACCOUNT EVENTS STREAM (SERVER-SENT EVENTS), REPLACES POLLING user_profile
+async def account_event_stream(request):
+    """
+    Plain async Django view, DRF views are synchronous. EventSource cannot set
+    headers, so it opens the stream with ?ticket= from stream_ticket_view;
+    tokens are only accepted in the Authorization header.
 
+    The stream ends with a "closed" event when its token expires or is
+    revoked, or the account is deactivated or deleted. The client then needs
+    a new ticket, reconnecting with the used one fails.
+    """
+    if request.method != 'GET':
+        return JsonResponse({"detail": "HTTP method is not allowed"}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
+    # A sync worker would hold a whole worker per open stream
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({"detail": "Event streams are served by the ASGI application only."}, status=status.HTTP_501_NOT_IMPLEMENTED)
 
+    try:
+        grant = await sync_to_async(authenticate_stream, thread_sensitive=False)(request)
+    except AuthenticationFailed as e:
+        return JsonResponse({"detail": str(e.detail)}, status=status.HTTP_401_UNAUTHORIZED)
 
+    last_event_id = request.headers.get("Last-Event-ID") or request.GET.get("last_event_id")
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
 
+    response = StreamingHttpResponse(stream_events(grant, last_event_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # nginx would otherwise hold the events back
+    return response
 
 
+# EXCHANGE A REFRESH TOKEN FOR A NEW ACCESS TOKEN
+@compression_exempt
+@api_view(['POST'])
+def token_refresh_view(request):
+    if not signed_tokens_enabled():
+        return Response({"detail": "Signed tokens are not enabled."}, status=status.HTTP_404_NOT_FOUND)
 
+    try:
+        user, tokens = rotate_refresh_token(request.data.get("refresh"))
+    except InvalidToken as e:
+        return Response({"detail": str(e)}, status=status.HTTP_401_UNAUTHORIZED)
 
+    return Response({**tokens, "user_id": user.pk}, status=status.HTTP_200_OK)
 
 
+# BULK ACCOUNT OPERATIONS
+@api_view(['POST'])
+@authentication_classes(AUTHENTICATION_CLASSES)
+@permission_classes([IsAuthenticated, IsManager])
+def bulk_user_operations(request):
+    """
+    Run one action over many users at once.
+    Users are selected either by "ids" or by "filter", e.g.
+    {"action": "verify", "ids": [1, 2, 3]}
+    {"action": "set_role", "role": "cashier", "filter": {"role": "manager", "is_active": true}}
+    """
+    data = request.data
+    if not isinstance(data, dict):
+        return Response({"detail": "Expected a JSON object."}, status=status.HTTP_400_BAD_REQUEST)
+    action = data.get("action")
+    ids = data.get("ids")
+    filters = data.get("filter")
+
+    if action not in API_ACTIONS:
+        return Response({"detail": f"Unknown action. Expected one of: {', '.join(API_ACTIONS)}"}, status=status.HTTP_400_BAD_REQUEST)
+    if (ids is None) == (filters is None):
+        return Response({"detail": "Provide either ids or filter."}, status=status.HTTP_400_BAD_REQUEST)
+
+    queryset = User.objects.all()
+    if ids is not None:
+        if not isinstance(ids, list):
+            return Response({"detail": "ids must be a list of user ids."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ids = [int(user_id) for user_id in ids]
+        except (TypeError, ValueError):
+            return Response({"detail": "ids must be a list of user ids."}, status=status.HTTP_400_BAD_REQUEST)
+        queryset = queryset.filter(id__in=ids)
+    else:
+        if not isinstance(filters, dict) or not filters:
+            return Response({"detail": "filter must be a non empty object."}, status=status.HTTP_400_BAD_REQUEST)
+        unknown = set(filters) - ALLOWED_FILTERS
+        if unknown:
+            return Response({"detail": f"Unsupported filters: {', '.join(sorted(unknown))}"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            queryset = queryset.filter(**filters)
+        except ValidationError as e:
+            return Response({"detail": " ".join(e.messages)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Managers can only act on cashiers and nobody can act on their own account
+    queryset = queryset.exclude(id=request.user.id)
+    if not request.user.is_superuser:
+        queryset = queryset.filter(role="cashier", is_superuser=False)
+
+    # One transaction per shard, the counts are added up. Not atomic across
+    # shards: if a later shard fails, the earlier ones stay committed.
+    result = {}
+    try:
+        for alias in user_databases():
+            shard_result = apply_bulk_action(queryset.using(alias), action, role=data.get("role"))
+            for key, value in shard_result.items():
+                result[key] = result.get(key, 0) + value if isinstance(value, int) else value
+    except BulkActionError as e:
+        return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+    return Response(result, status=status.HTTP_200_OK)
 
 
-
-
-
-
-
-
+# AUTH EVENT LOG (admins only)
+@api_view(['GET'])
+@authentication_classes(AUTHENTICATION_CLASSES)
+@permission_classes([IsAdminUser])
+def auth_events(request):
+    """
+    Query the auth event log. Filters: kind, user_id, email, limit.
+    Pass after_id (the last id seen) to tail the log, oldest first.
+    """
+    params = request.query_params
+    try:
+        user_id = int(params["user_id"]) if params.get("user_id") else None
+        after_id = int(params["after_id"]) if params.get("after_id") else None
+        limit = min(max(int(params.get("limit", 100)), 1), 1000)
+    except ValueError:
+        return Response({"detail": "user_id, after_id and limit must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Include this worker's events that haven't been written yet
+    flush_events()
+
+    events = query_events(kind=params.get("kind"), user_id=user_id, email=params.get("email"), after_id=after_id, limit=limit)
+    results = [
+        {
+            "id": event.id,
+            "kind": event.kind,
+            "user_id": event.user_id,
+            "email": event.email,
+            "ip_address": event.ip_address,
+            "created": event.created,
+            "data": event.data,
+        }
+        for event in events
+    ]
+    last_id = max((event.id for event in events), default=after_id)
+    return Response({"results": results, "last_id": last_id}, status=status.HTTP_200_OK)
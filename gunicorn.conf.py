@@ -0,0 +1,124 @@
+"""
+Gunicorn configuration for inventory_kooltech_be.
+
+    gunicorn -c gunicorn.conf.py inventory_kooltech_be.wsgi
+
+Gunicorn picks this file up automatically when started from the project root.
+The worker class and count are chosen from GUNICORN_PROFILE and the CPU count:
+
+    sync     2 * CPUs + 1 sync workers (default)
+    gthread  CPUs + 1 workers with GUNICORN_THREADS threads each
+    uvicorn  CPUs uvicorn workers serving the ASGI application
+
+Every value can be overridden through the environment (GUNICORN_WORKERS,
+GUNICORN_THREADS, GUNICORN_MAX_REQUESTS, ...).
+"""
+
+import multiprocessing
+import os
+
+import decouple
+
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "inventory_kooltech_be.settings")
+
+CPU_COUNT = multiprocessing.cpu_count()
+
+PROFILE = decouple.config("GUNICORN_PROFILE", default="sync")
+
+PROFILES = {
+    "sync": {
+        "worker_class": "sync",
+        "workers": CPU_COUNT * 2 + 1,
+        "threads": 1,
+        "wsgi_app": "inventory_kooltech_be.wsgi:application",
+    },
+    "gthread": {
+        "worker_class": "gthread",
+        "workers": CPU_COUNT + 1,
+        "threads": 4,
+        "wsgi_app": "inventory_kooltech_be.wsgi:application",
+    },
+    "uvicorn": {
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "workers": CPU_COUNT,
+        "threads": 1,
+        "wsgi_app": "inventory_kooltech_be.asgi:application",
+    },
+}
+
+if PROFILE not in PROFILES:
+    raise RuntimeError(f"Unknown GUNICORN_PROFILE {PROFILE!r}, expected one of {', '.join(PROFILES)}")
+
+_profile = PROFILES[PROFILE]
+
+# Server
+bind = decouple.config("GUNICORN_BIND", default="0.0.0.0:8000")
+wsgi_app = _profile["wsgi_app"]
+worker_class = _profile["worker_class"]
+workers = decouple.config("GUNICORN_WORKERS", default=_profile["workers"], cast=int)
+threads = decouple.config("GUNICORN_THREADS", default=_profile["threads"], cast=int)
+
+# Load Django once in the master so workers fork warm
+preload_app = decouple.config("GUNICORN_PRELOAD", default=True, cast=bool)
+
+# Recycle workers after a number of requests. The jitter keeps them from
+# all restarting at the same moment. /ops/memory/ reports how much a worker
+# grows per thousand requests, size this from it.
+max_requests = decouple.config("GUNICORN_MAX_REQUESTS", default=1000, cast=int)
+max_requests_jitter = decouple.config("GUNICORN_MAX_REQUESTS_JITTER", default=100, cast=int)
+timeout = decouple.config("GUNICORN_TIMEOUT", default=30, cast=int)
+graceful_timeout = decouple.config("GUNICORN_GRACEFUL_TIMEOUT", default=30, cast=int)
+keepalive = decouple.config("GUNICORN_KEEPALIVE", default=5, cast=int)
+
+# Logging
+accesslog = decouple.config("GUNICORN_ACCESSLOG", default="-")
+errorlog = decouple.config("GUNICORN_ERRORLOG", default="-")
+loglevel = decouple.config("GUNICORN_LOGLEVEL", default="info")
+
+
+# Hooks
+
+def when_ready(server):
+    """Master is up, runs once before the workers are forked."""
+    import django
+
+    # Already done when the application is preloaded
+    django.setup()
+
+    from inventory_kooltech_be.warmup import warm_up, rebuild_email_filter, close_connections
+
+    if preload_app:
+        warm_up()
+    rebuild_email_filter()
+    # Connections opened in the master must not be shared with the forks
+    close_connections()
+    server.log.info("Warm-up complete (profile=%s, workers=%s, threads=%s)", PROFILE, workers, threads)
+
+
+def post_worker_init(worker):
+    """
+    Worker has forked and loaded the application. Database connections are
+    not opened here: with CONN_MAX_AGE = 0 Django closes them after every
+    request, and under uvicorn requests run on other threads anyway.
+    """
+    from inventory_kooltech_be.memory import mark_gunicorn_worker
+    from inventory_kooltech_be.warmup import warm_up
+
+    # Lets MemoryAccountingMiddleware recycle the worker, whatever its class
+    mark_gunicorn_worker()
+    if not preload_app:
+        warm_up()
+
+
+def worker_exit(server, worker):
+    from accounts.audit import flush_events
+    from inventory_kooltech_be.memory import get_tracker
+    from inventory_kooltech_be.warmup import close_connections
+
+    # Write buffered auth events and the last memory numbers before the worker goes away
+    flush_events()
+    tracker = get_tracker()
+    if tracker.requests:
+        tracker.write()
+    close_connections()
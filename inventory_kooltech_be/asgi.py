@@ -9,8 +9,35 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.core.handlers.asgi import ASGIHandler
+from django.urls import reverse
+from django.utils.functional import cached_property
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'inventory_kooltech_be.settings')
 
-application = get_asgi_application()
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    Django runs every request in a ThreadSensitiveContext, and the thread it
+    starts there for sync middleware and signal receivers lives until the
+    response ends: every open event stream would hold a thread. Streams are
+    handled outside that context, so their few sync steps share asgiref's one
+    sync thread instead.
+    """
+
+    stream_views = ("account_event_stream",)
+
+    @cached_property
+    def stream_paths(self):
+        return {reverse(name) for name in self.stream_views}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.stream_paths:
+            await self.handle(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
+
+
+django.setup(set_prefix=False)
+application = StreamingASGIHandler()
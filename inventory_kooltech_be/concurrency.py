@@ -0,0 +1,122 @@
+"""
+Cross-worker concurrency limits, see concurrency_limited().
+
+A SharedSemaphore is a directory of lock files. Holding an flock on one of the
+``limit`` slot files is a permit to run; holding one of the ``queue`` files is
+a place in the wait queue. Every gunicorn worker on the host opens the same
+files, so the limits hold across processes, and the kernel drops the locks of
+a worker that dies.
+"""
+
+import fcntl
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.http import JsonResponse
+
+
+class SharedSemaphore:
+
+    def __init__(self, directory, limit, queue_size):
+        self.directory = str(directory)
+        self.slots = [os.path.join(self.directory, f"slot-{i}") for i in range(limit)]
+        self.queue = [os.path.join(self.directory, f"queue-{i}") for i in range(queue_size)]
+        # flock belongs to the open file, so every thread needs its own descriptors
+        self.local = threading.local()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _fd(self, path):
+        fds = getattr(self.local, "fds", None)
+        if fds is None:
+            fds = self.local.fds = {}
+        if path not in fds:
+            fds[path] = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        return fds[path]
+
+    def _try_lock(self, paths):
+        for path in paths:
+            fd = self._fd(path)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                continue
+        return None
+
+    def acquire(self, timeout):
+        """
+        Return a permit, or None when the queue is full or ``timeout`` seconds
+        pass without a slot freeing up.
+        """
+        permit = self._try_lock(self.slots)
+        if permit is not None:
+            return permit
+
+        place = self._try_lock(self.queue)
+        if place is None:
+            return None
+        try:
+            deadline = time.monotonic() + timeout
+            delay = 0.002
+            while time.monotonic() < deadline:
+                time.sleep(delay)
+                permit = self._try_lock(self.slots)
+                if permit is not None:
+                    return permit
+                delay = min(delay * 2, 0.05)
+            return None
+        finally:
+            fcntl.flock(place, fcntl.LOCK_UN)
+
+    def release(self, permit):
+        fcntl.flock(permit, fcntl.LOCK_UN)
+
+
+_semaphores = {}
+
+
+def get_semaphore(name):
+    """The SharedSemaphore of the CONCURRENCY_LIMITS entry ``name``, and its wait timeout."""
+    options = settings.CONCURRENCY_LIMITS[name]
+    directory = os.path.join(str(settings.CONCURRENCY_LOCK_DIR), name)
+    if directory not in _semaphores:
+        _semaphores[directory] = SharedSemaphore(directory, options["limit"], options.get("queue", 0))
+    return _semaphores[directory], options.get("timeout", 1.0)
+
+
+def concurrency_limited(name, methods=None):
+    """
+    Cap how many requests of the CONCURRENCY_LIMITS class ``name`` run at once
+    across all workers, so CPU heavy views (password hashing) can't take every
+    worker away from cheap ones. Requests that find the queue full or time out
+    get a 503 with Retry-After.
+
+    Must be applied below ``@api_view``: the permit is only taken once DRF has
+    authenticated and throttled the request, so throttled clients don't hold
+    slots. ``methods`` limits it to some HTTP methods.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if methods is not None and request.method not in methods:
+                return view(request, *args, **kwargs)
+
+            semaphore, timeout = get_semaphore(name)
+            permit = semaphore.acquire(timeout)
+            if permit is None:
+                response = JsonResponse({"detail": "Server is busy, retry shortly."}, status=503)
+                response["Retry-After"] = str(max(1, math.ceil(timeout)))
+                return response
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                semaphore.release(permit)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,272 @@
+"""
+Per worker memory accounting used by MemoryAccountingMiddleware.
+
+Every request records the worker's resident set size (RSS) before and after,
+so each route accumulates how much it grew the process. With
+MEMORY_TRACEMALLOC on, a sample of requests (MEMORY_ROUTE_SAMPLE_RATE) is
+also diffed with tracemalloc to name the lines that allocated the memory the
+route kept, and the whole worker is diffed against its previous snapshot
+every MEMORY_SNAPSHOT_INTERVAL seconds.
+
+Each worker writes its numbers to MEMORY_SPOOL_DIR/worker-<pid>.json at that
+interval. The history of (requests served, RSS) pairs gives the growth per
+thousand requests, which is what max_requests should be sized from.
+"""
+
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+from django.conf import settings
+
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+MB = 1024 * 1024
+HISTORY_LENGTH = 120
+TOP_ALLOCATIONS = 15
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # No procfs (macOS): fall back to the peak, which never goes down
+        return peak_rss()
+
+
+def peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def top_differences(new, old, limit=TOP_ALLOCATIONS):
+    """The lines whose allocations grew the most between two snapshots."""
+    stats = new.compare_to(old, "lineno")
+    top = []
+    for stat in stats:
+        if stat.size_diff <= 0:
+            continue
+        frame = stat.traceback[0]
+        top.append({
+            "where": f"{frame.filename}:{frame.lineno}",
+            "size_kb": round(stat.size_diff / 1024, 1),
+            "count": stat.count_diff,
+        })
+        if len(top) == limit:
+            break
+    return top
+
+
+def filtered_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+
+
+class RouteStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.growth = 0
+        self.max_growth = 0
+        self.allocations = {}  # where -> (size_kb, count), from sampled requests
+
+    def add(self, growth):
+        self.requests += 1
+        self.growth += growth
+        self.max_growth = max(self.max_growth, growth)
+
+    def add_allocations(self, top):
+        for item in top:
+            size, count = self.allocations.get(item["where"], (0, 0))
+            self.allocations[item["where"]] = (size + item["size_kb"], count + item["count"])
+        if len(self.allocations) > TOP_ALLOCATIONS * 4:
+            kept = sorted(self.allocations.items(), key=lambda item: item[1][0], reverse=True)[:TOP_ALLOCATIONS * 2]
+            self.allocations = dict(kept)
+
+    def as_dict(self):
+        top = sorted(self.allocations.items(), key=lambda item: item[1][0], reverse=True)[:TOP_ALLOCATIONS]
+        return {
+            "requests": self.requests,
+            "rss_growth_mb": round(self.growth / MB, 2),
+            "avg_growth_kb": round(self.growth / self.requests / 1024, 1) if self.requests else 0,
+            "max_growth_kb": round(self.max_growth / 1024, 1),
+            "top_allocations": [{"where": where, "size_kb": round(size, 1), "count": count} for where, (size, count) in top],
+        }
+
+
+class MemoryTracker:
+    """One per worker process, see get_tracker()."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.baseline = None
+        self.requests = 0
+        self.routes = {}
+        self.history = []
+        self.worker_diff = []
+        self.last_snapshot = None
+        self.last_write = time.monotonic()
+        self.recycling = False
+
+        self.use_tracemalloc = getattr(settings, "MEMORY_TRACEMALLOC", False)
+        if self.use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(getattr(settings, "MEMORY_TRACEMALLOC_FRAMES", 1))
+
+    def should_sample(self):
+        return self.use_tracemalloc and random.random() < getattr(settings, "MEMORY_ROUTE_SAMPLE_RATE", 0.01)
+
+    def record(self, route, before, after, allocations=None):
+        """Account one finished request. Returns True when the worker should be recycled."""
+        with self.lock:
+            if self.baseline is None:
+                # The first request pays for lazy imports and caches, it is the floor
+                self.baseline = after
+            self.requests += 1
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = RouteStats()
+            stats.add(after - before)
+            if allocations:
+                stats.add_allocations(allocations)
+
+            interval = getattr(settings, "MEMORY_SNAPSHOT_INTERVAL", 60)
+            if time.monotonic() - self.last_write >= interval:
+                self.last_write = time.monotonic()
+                self.take_snapshot(after)
+                self.write()
+
+            threshold = getattr(settings, "MEMORY_RECYCLE_GROWTH_MB", 0)
+            if threshold and not self.recycling and after - self.baseline > threshold * MB:
+                self.recycling = True
+                self.take_snapshot(after)
+                self.write()
+                return True
+        return False
+
+    def take_snapshot(self, rss):
+        self.history.append((self.requests, round(rss / MB, 2), round(time.time())))
+        del self.history[:-HISTORY_LENGTH]
+        if self.use_tracemalloc:
+            snapshot = filtered_snapshot()
+            if self.last_snapshot is not None:
+                self.worker_diff = top_differences(snapshot, self.last_snapshot)
+            self.last_snapshot = snapshot
+
+    def growth_per_1000_requests(self):
+        """Least squares slope of RSS over requests served, in MB."""
+        points = [(requests, rss) for requests, rss, _ in self.history]
+        if len(points) < 2:
+            return None
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        variance = sum((x - mean_x) ** 2 for x, _ in points)
+        if not variance:
+            return None
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+        return round(slope * 1000, 2)
+
+    def as_dict(self):
+        rss = current_rss()
+        return {
+            "pid": self.pid,
+            "started": self.started,
+            "updated": time.time(),
+            "requests": self.requests,
+            "rss_mb": round(rss / MB, 2),
+            "baseline_rss_mb": round(self.baseline / MB, 2) if self.baseline else None,
+            "peak_rss_mb": round(peak_rss() / MB, 2),
+            "growth_per_1000_requests_mb": self.growth_per_1000_requests(),
+            "tracemalloc": self.use_tracemalloc,
+            "recycling": self.recycling,
+            "history": self.history,
+            "worker_growth": self.worker_diff,
+            "routes": {route: stats.as_dict() for route, stats in self.routes.items()},
+        }
+
+    def write(self):
+        spool_dir = get_spool_dir()
+        os.makedirs(spool_dir, exist_ok=True)
+        path = os.path.join(spool_dir, f"worker-{self.pid}.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.as_dict(), f)
+        os.replace(tmp_path, path)
+
+
+def get_spool_dir():
+    return str(settings.MEMORY_SPOOL_DIR)
+
+
+_tracker = None
+_gunicorn_worker = None  # pid of the process gunicorn's post_worker_init ran in
+
+
+def mark_gunicorn_worker():
+    """Called by gunicorn.conf.py's post_worker_init, for every worker class."""
+    global _gunicorn_worker
+    _gunicorn_worker = os.getpid()
+
+
+def is_gunicorn_worker():
+    return _gunicorn_worker == os.getpid()
+
+
+def get_tracker():
+    global _tracker
+    # A forked worker starts its own accounting
+    if _tracker is None or _tracker.pid != os.getpid():
+        _tracker = MemoryTracker()
+    return _tracker
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def list_workers(keep=50):
+    """The latest numbers of every worker, live ones first. Old files are pruned."""
+    spool_dir = get_spool_dir()
+    if not os.path.isdir(spool_dir):
+        return []
+    workers = []
+    for entry in os.scandir(spool_dir):
+        if not (entry.name.startswith("worker-") and entry.name.endswith(".json")):
+            continue
+        try:
+            with open(entry.path) as f:
+                worker = json.load(f)
+        except (OSError, ValueError):
+            continue
+        worker["alive"] = pid_alive(worker["pid"])
+        worker["path"] = entry.path
+        workers.append(worker)
+
+    workers.sort(key=lambda worker: (worker["alive"], worker["updated"]), reverse=True)
+    for worker in workers[keep:]:
+        if not worker["alive"]:
+            try:
+                os.remove(worker["path"])
+            except FileNotFoundError:
+                pass
+    for worker in workers:
+        del worker["path"]
+    return workers[:keep]
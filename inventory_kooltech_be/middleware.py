@@ -0,0 +1,364 @@
+"""
+Project wide middleware.
+"""
+
+import hmac
+import logging
+import os
+import random
+import re
+import secrets
+import signal
+import struct
+import time
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+from .memory import current_rss, filtered_snapshot, get_tracker, is_gunicorn_worker, top_differences
+from .profiling import RequestProfile
+
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+
+DEFAULT_COMPRESSION_CONTENT_TYPES = [
+    "application/json",
+    "text/html",
+    "text/plain",
+    "text/csv",
+]
+
+
+class AsyncCapableMiddleware:
+    """
+    Runs in the handler's mode: under ASGI it is awaited directly instead of
+    Django wrapping it in sync_to_async, which would give every request (and
+    every open event stream) a thread of its own. Subclasses implement both
+    __call__ (WSGI) and __acall__ (ASGI).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+
+def compression_exempt(view):
+    """
+    Never compress this view's responses. For views that return secrets
+    (tokens) next to data from the request: compressing both together is what
+    BREACH guesses the secret from.
+    """
+    view.compression_exempt = True
+    return view
+
+
+class GzipStream:
+    def __init__(self, level, max_random_bytes=0):
+        # Raw deflate, the gzip header and trailer are written here
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.header = self.make_header(max_random_bytes)
+        self.crc = 0
+        self.size = 0
+
+    @staticmethod
+    def make_header(max_random_bytes):
+        # Like GZipMiddleware, a file name of random length makes the response
+        # length vary, which BREACH needs to be stable (gzip ignores the name)
+        if not max_random_bytes:
+            return b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+        name = b"a" * secrets.randbelow(max_random_bytes) + b"\x00"
+        return b"\x1f\x8b\x08\x08\x00\x00\x00\x00\x00\xff" + name
+
+    def emit(self, data):
+        if self.header is not None:
+            data, self.header = self.header + data, None
+        return data
+
+    def compress(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        return self.emit(self.compressor.compress(data))
+
+    def flush(self):
+        # Z_SYNC_FLUSH emits everything written so far without ending the stream
+        return self.emit(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        trailer = struct.pack("<II", self.crc, self.size & 0xFFFFFFFF)
+        return self.emit(self.compressor.flush(zlib.Z_FINISH)) + trailer
+
+
+class BrotliStream:
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def parse_accept_encoding(header):
+    """Return the set of encodings the client accepts (q > 0)."""
+    accepted = set()
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if quality > 0:
+            accepted.add(coding)
+    return accepted
+
+
+class CompressionMiddleware(AsyncCapableMiddleware):
+    """
+    Compress responses with brotli (when installed) or gzip.
+
+    Only responses whose content type is listed in COMPRESSION_CONTENT_TYPES
+    and whose body is at least COMPRESSION_MIN_SIZE bytes are compressed.
+    Responses that already carry a Content-Encoding are left alone, and so are
+    those of views marked with @compression_exempt. Streaming responses are
+    compressed chunk by chunk and flushed after every chunk so nothing is
+    buffered. Gzip output is padded by up to COMPRESSION_MAX_RANDOM_BYTES.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.min_size = getattr(settings, "COMPRESSION_MIN_SIZE", 1024)
+        self.content_types = set(getattr(settings, "COMPRESSION_CONTENT_TYPES", DEFAULT_COMPRESSION_CONTENT_TYPES))
+        self.gzip_level = getattr(settings, "COMPRESSION_GZIP_LEVEL", 6)
+        self.brotli_quality = getattr(settings, "COMPRESSION_BROTLI_QUALITY", 5)
+        self.max_random_bytes = getattr(settings, "COMPRESSION_MAX_RANDOM_BYTES", 100)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        return self.process_response(request, response)
+
+    def select_encoding(self, request):
+        accepted = parse_accept_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        if brotli is not None and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+    def get_stream(self, encoding):
+        if encoding == "br":
+            return BrotliStream(self.brotli_quality)
+        return GzipStream(self.gzip_level, self.max_random_bytes)
+
+    def should_compress(self, request, response):
+        if response.has_header("Content-Encoding") or response.has_header("Content-Range"):
+            return False
+        match = getattr(request, "resolver_match", None)
+        if match is not None and getattr(match.func, "compression_exempt", False):
+            return False
+        content_type = response.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type not in self.content_types:
+            return False
+        if not response.streaming and len(response.content) < self.min_size:
+            return False
+        return True
+
+    def process_response(self, request, response):
+        if not self.should_compress(request, response):
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+
+        encoding = self.select_encoding(request)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = self.compress_async_stream(response.streaming_content, encoding)
+            else:
+                response.streaming_content = self.compress_stream(response.streaming_content, encoding)
+            # The compressed size is unknown until the stream ends
+            del response.headers["Content-Length"]
+        else:
+            stream = self.get_stream(encoding)
+            compressed_content = stream.compress(response.content) + stream.finish()
+            # Only use the compressed content if it's actually shorter
+            if len(compressed_content) >= len(response.content):
+                return response
+            response.content = compressed_content
+            response.headers["Content-Length"] = str(len(compressed_content))
+
+        # A strong ETag no longer matches the encoded bytes
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = encoding
+
+        return response
+
+    def compress_stream(self, chunks, encoding):
+        stream = self.get_stream(encoding)
+        for chunk in chunks:
+            if not chunk:
+                continue
+            data = stream.compress(chunk) + stream.flush()
+            if data:
+                yield data
+        yield stream.finish()
+
+    async def compress_async_stream(self, chunks, encoding):
+        stream = self.get_stream(encoding)
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            data = stream.compress(chunk) + stream.flush()
+            if data:
+                yield data
+        yield stream.finish()
+
+
+class ProfilingMiddleware(AsyncCapableMiddleware):
+    """
+    Profile a sample of requests and write one capture per request to
+    PROFILING_SPOOL_DIR.
+
+    A request is profiled when it is picked by PROFILING_SAMPLE_RATE
+    (0 disables sampling) or when it carries the X-Profile-Request header set
+    to PROFILING_SECRET. When neither applies the cost is one header lookup.
+    """
+
+    header = "HTTP_X_PROFILE_REQUEST"
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.sample_rate = getattr(settings, "PROFILING_SAMPLE_RATE", 0)
+        self.secret = getattr(settings, "PROFILING_SECRET", "")
+
+    def should_profile(self, request):
+        requested = request.META.get(self.header)
+        if requested is not None:
+            return bool(self.secret) and hmac.compare_digest(requested.encode(), self.secret.encode())
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        profile = RequestProfile()
+        started = time.perf_counter()
+        profile.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.stop()
+        return self.save(request, response, profile, started)
+
+    async def __acall__(self, request):
+        if not self.should_profile(request):
+            return await self.get_response(request)
+
+        # Sync views don't run on the event loop but in the request's sync
+        # thread, which every thread_sensitive call of the request shares:
+        # start and stop there so that thread is the one profiled
+        profile = RequestProfile()
+        started = time.perf_counter()
+        await sync_to_async(profile.start, thread_sensitive=True)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(profile.stop, thread_sensitive=True)()
+        return self.save(request, response, profile, started)
+
+    def save(self, request, response, profile, started):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        match = getattr(request, "resolver_match", None)
+        route = match.url_name if match and match.url_name else re.sub(r"\W+", "_", request.path).strip("_") or "root"
+        response["X-Profile-Capture"] = profile.save(f"{route}.{request.method.lower()}", elapsed_ms)
+        return response
+
+
+class MemoryAccountingMiddleware(AsyncCapableMiddleware):
+    """
+    Record how much each request grows the worker's RSS, per route, and with
+    MEMORY_TRACEMALLOC which lines allocated what it kept (see memory.py).
+
+    When MEMORY_RECYCLE_GROWTH_MB is set and the worker has grown that much
+    past its first request, a gunicorn worker sends itself SIGTERM once the
+    response is ready. Gunicorn lets it finish and starts a fresh one.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.enabled = getattr(settings, "MEMORY_ACCOUNTING_ENABLED", True)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+
+        tracker, snapshot, before = self.start()
+        response = self.get_response(request)
+        return self.finish(request, response, tracker, snapshot, before)
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+
+        tracker, snapshot, before = self.start()
+        response = await self.get_response(request)
+        return self.finish(request, response, tracker, snapshot, before)
+
+    def start(self):
+        tracker = get_tracker()
+        snapshot = filtered_snapshot() if tracker.should_sample() else None
+        return tracker, snapshot, current_rss()
+
+    def finish(self, request, response, tracker, snapshot, before):
+        after = current_rss()
+        allocations = top_differences(filtered_snapshot(), snapshot) if snapshot is not None else None
+
+        match = getattr(request, "resolver_match", None)
+        route = match.url_name if match and match.url_name else "unresolved"
+        if tracker.record(f"{request.method} {route}", before, after, allocations):
+            self.recycle(request, after)
+        return response
+
+    def recycle(self, request, rss):
+        # SERVER_SOFTWARE can't tell, UvicornWorker doesn't set it
+        if not is_gunicorn_worker():
+            logger.warning("Worker %s passed the memory limit (%.0f MB) but is not run by gunicorn", os.getpid(), rss / 2**20)
+            return
+        logger.warning("Recycling worker %s at %.0f MB RSS", os.getpid(), rss / 2**20)
+        os.kill(os.getpid(), signal.SIGTERM)
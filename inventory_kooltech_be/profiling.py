@@ -0,0 +1,165 @@
+"""
+Request profiling used by ProfilingMiddleware.
+
+The default profiler is a stack sampler: one background thread wakes up every
+PROFILING_INTERVAL seconds, reads the current frame of each thread that is
+being profiled (sys._current_frames) and counts the collapsed stack. Output is
+in the collapsed-stack format read by flamegraph.pl and speedscope:
+
+    root_function;caller;callee 42
+
+With PROFILING_MODE = "cprofile" (or on interpreters without
+sys._current_frames) requests are run under cProfile instead and a pstats
+dump is written.
+"""
+
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+
+CAPTURE_EXTENSIONS = (".collapsed", ".prof")
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class StackSampler:
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.targets = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, thread_id):
+        counter = Counter()
+        with self.lock:
+            self.targets[thread_id] = counter
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="request-sampler", daemon=True)
+                self.thread.start()
+        return counter
+
+    def stop(self, thread_id):
+        with self.lock:
+            return self.targets.pop(thread_id, Counter())
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.targets:
+                    # Exit when idle, the next start() spawns a new thread
+                    self.thread = None
+                    return
+                targets = list(self.targets.items())
+            frames = sys._current_frames()
+            for thread_id, counter in targets:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    counter[collapse(frame)] += 1
+
+
+_sampler = None
+
+
+def get_sampler():
+    global _sampler
+    if _sampler is None:
+        _sampler = StackSampler(getattr(settings, "PROFILING_INTERVAL", 0.005))
+    return _sampler
+
+
+def use_sampler():
+    return getattr(settings, "PROFILING_MODE", "sample") == "sample" and hasattr(sys, "_current_frames")
+
+
+def get_spool_dir():
+    return str(settings.PROFILING_SPOOL_DIR)
+
+
+class RequestProfile:
+    """Profile the calling thread between start() and stop()."""
+
+    def __init__(self):
+        self.sampled = use_sampler()
+        self.profiler = None
+        self.counter = None
+
+    def start(self):
+        if self.sampled:
+            self.counter = get_sampler().start(threading.get_ident())
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        if self.sampled:
+            get_sampler().stop(threading.get_ident())
+        else:
+            self.profiler.disable()
+
+    def save(self, route, elapsed_ms):
+        spool_dir = get_spool_dir()
+        os.makedirs(spool_dir, exist_ok=True)
+        name = f"{route}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{int(elapsed_ms)}ms"
+        if self.sampled:
+            name += ".collapsed"
+            with open(os.path.join(spool_dir, name), "w") as f:
+                for stack, count in self.counter.most_common():
+                    f.write(f"{stack} {count}\n")
+        else:
+            name += ".prof"
+            self.profiler.dump_stats(os.path.join(spool_dir, name))
+        prune_captures(spool_dir, getattr(settings, "PROFILING_MAX_CAPTURES", 200))
+        return name
+
+
+def list_captures():
+    spool_dir = get_spool_dir()
+    if not os.path.isdir(spool_dir):
+        return []
+    captures = []
+    for entry in os.scandir(spool_dir):
+        if entry.is_file() and entry.name.endswith(CAPTURE_EXTENSIONS):
+            stat = entry.stat()
+            captures.append({
+                "name": entry.name,
+                "route": entry.name.split("-", 1)[0],
+                "size": stat.st_size,
+                "created": stat.st_mtime,
+            })
+    return sorted(captures, key=lambda capture: capture["created"], reverse=True)
+
+
+def capture_path(name):
+    """Absolute path of a capture, or None if ``name`` is not one."""
+    if name != os.path.basename(name) or not name.endswith(CAPTURE_EXTENSIONS):
+        return None
+    path = os.path.join(get_spool_dir(), name)
+    return path if os.path.isfile(path) else None
+
+
+def prune_captures(spool_dir, keep):
+    captures = list_captures()
+    for capture in captures[keep:]:
+        try:
+            os.remove(os.path.join(spool_dir, capture["name"]))
+        except FileNotFoundError:
+            pass
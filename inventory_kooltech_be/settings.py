@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 from pathlib import Path
 import os
 from decouple import config
+from corsheaders.defaults import default_headers
 
 # Clodinary
 import cloudinary
@@ -62,9 +63,16 @@ INSTALLED_APPS = [
 
 # CUSTOM USER MODEL
 AUTH_USER_MODEL = 'accounts.CustomUser'
+AUTHENTICATION_BACKENDS = ['accounts.authentication.ShardedModelBackend']
+
+# Points every file under var/ at a temporary directory for the test run
+TEST_RUNNER = 'inventory_kooltech_be.test_runner.IsolatedVarTestRunner'
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'inventory_kooltech_be.middleware.MemoryAccountingMiddleware',
+    'inventory_kooltech_be.middleware.CompressionMiddleware',
+    'inventory_kooltech_be.middleware.ProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.common.CommonMiddleware',
@@ -74,11 +82,54 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Response compression (brotli when installed, otherwise gzip). COMPRESSION_CONTENT_TYPES
+# overrides the types compressed (DEFAULT_COMPRESSION_CONTENT_TYPES in middleware.py)
+COMPRESSION_MIN_SIZE = config('COMPRESSION_MIN_SIZE', default=1024, cast=int)
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+COMPRESSION_MAX_RANDOM_BYTES = 100  # gzip padding against BREACH, as GZipMiddleware
+
+# Request profiling. Captures are listed at /ops/profiles/ for admins.
+PROFILING_SAMPLE_RATE = config('PROFILING_SAMPLE_RATE', default=0.0, cast=float)
+PROFILING_SECRET = config('PROFILING_SECRET', default='')  # value of the X-Profile-Request header
+PROFILING_MODE = config('PROFILING_MODE', default='sample')  # sample | cprofile
+PROFILING_INTERVAL = 0.005
+PROFILING_SPOOL_DIR = config('PROFILING_SPOOL_DIR', default=str(BASE_DIR / 'var' / 'profiles'))
+PROFILING_MAX_CAPTURES = 200
+
+# Per worker memory accounting (inventory_kooltech_be/memory.py), served at /ops/memory/
+MEMORY_ACCOUNTING_ENABLED = config('MEMORY_ACCOUNTING_ENABLED', default=True, cast=bool)
+MEMORY_TRACEMALLOC = config('MEMORY_TRACEMALLOC', default=False, cast=bool)  # slows every allocation down
+MEMORY_TRACEMALLOC_FRAMES = 1
+MEMORY_ROUTE_SAMPLE_RATE = config('MEMORY_ROUTE_SAMPLE_RATE', default=0.01, cast=float)
+MEMORY_SNAPSHOT_INTERVAL = config('MEMORY_SNAPSHOT_INTERVAL', default=60, cast=int)  # seconds
+MEMORY_SPOOL_DIR = config('MEMORY_SPOOL_DIR', default=str(BASE_DIR / 'var' / 'memory'))
+MEMORY_RECYCLE_GROWTH_MB = config('MEMORY_RECYCLE_GROWTH_MB', default=0, cast=int)  # 0 never recycles
+
+# Host wide caps on in-flight requests per route class (shared by all workers)
+CONCURRENCY_LOCK_DIR = config('CONCURRENCY_LOCK_DIR', default=str(BASE_DIR / 'var' / 'concurrency'))
+CONCURRENCY_LIMITS = {
+    "password_hashing": {
+        "limit": config('HASHING_CONCURRENCY', default=os.cpu_count() or 1, cast=int),
+        "queue": config('HASHING_QUEUE', default=16, cast=int),
+        "timeout": 2.0,
+    },
+}
+
 # CORS
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
 ]
 
+CORS_ALLOW_HEADERS = (
+    *default_headers,
+    "idempotency-key",
+)
+
+CORS_EXPOSE_HEADERS = (
+    "idempotent-replayed",
+)
+
 CORS_ALLOW_METHODS = (
     "DELETE",
     "GET",
@@ -88,6 +139,80 @@ CORS_ALLOW_METHODS = (
     "PUT",
 )
 
+# "token": DRF database tokens. "signed": stateless signed access tokens plus refresh tokens
+ACCOUNTS_AUTH_MODE = config('ACCOUNTS_AUTH_MODE', default='token')
+ACCESS_TOKEN_LIFETIME = config('ACCESS_TOKEN_LIFETIME', default=300, cast=int)
+REFRESH_TOKEN_LIFETIME = config('REFRESH_TOKEN_LIFETIME', default=60 * 60 * 24 * 14, cast=int)
+
+# Caches shared by every worker on the host, SQLite files in WAL mode (inventory_kooltech_be/sqlite_cache.py).
+# "default" (shard directory, idempotency keys) evicts least recently used rows past MAX_ENTRIES.
+# "state" (token revocations, event ids) only drops rows when they expire.
+CACHES = {
+    'default': {
+        'BACKEND': 'inventory_kooltech_be.sqlite_cache.SQLiteCache',
+        'LOCATION': config('CACHE_PATH', default=str(BASE_DIR / 'var' / 'cache.sqlite3')),
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': config('CACHE_MAX_ENTRIES', default=50000, cast=int),
+            'CULL_FREQUENCY': 4,
+        },
+    },
+    'state': {
+        'BACKEND': 'inventory_kooltech_be.sqlite_cache.SQLiteCache',
+        'LOCATION': config('STATE_CACHE_PATH', default=str(BASE_DIR / 'var' / 'state.sqlite3')),
+        'TIMEOUT': None,
+        'OPTIONS': {'EVICT': False},
+    },
+}
+TOKEN_REVOCATION_CACHE = 'state'
+
+# Server-sent account events at /auth/stream/ (accounts/notifications.py), needs GUNICORN_PROFILE=uvicorn
+SSE_CACHE = 'state'  # never evicts, event ids must not restart at 0
+SSE_HEARTBEAT_INTERVAL = 15  # seconds, a comment line keeps proxies from closing idle streams
+SSE_POLL_INTERVAL = config('SSE_POLL_INTERVAL', default=1.0, cast=float)  # how soon other workers' events arrive
+SSE_EVENT_TTL = 300  # seconds events stay in the cache for Last-Event-ID replay
+SSE_QUEUE_SIZE = 32  # events a slow client may fall behind before it is told to resync
+SSE_REVALIDATE_INTERVAL = 60  # seconds between checks that a stream's token was not revoked
+SSE_MAX_LIFETIME = 60 * 60  # seconds, caps streams opened with DRF tokens (they never expire)
+STREAM_TICKET_LIFETIME = 30  # seconds a ?ticket= for opening a stream is accepted
+
+# Idempotency-Key replay window for registration and code emails
+IDEMPOTENCY_TTL = 60 * 60 * 24
+IDEMPOTENCY_LOCK_TIMEOUT = 30
+
+# Unverified accounts older than this are removed by purge_unverified_accounts
+UNVERIFIED_ACCOUNT_TTL_DAYS = config('UNVERIFIED_ACCOUNT_TTL_DAYS', default=7, cast=int)
+
+# Shared Bloom filter of registered emails, lets lookups for unknown emails skip the database
+EMAIL_FILTER_ENABLED = config('EMAIL_FILTER_ENABLED', default=True, cast=bool)
+EMAIL_FILTER_PATH = config('EMAIL_FILTER_PATH', default=str(BASE_DIR / 'var' / 'email_filter.bin'))
+EMAIL_FILTER_SLOTS = 1 << 22  # ~1% false positives at 400k accounts
+EMAIL_FILTER_HASHES = 7
+
+# Auth event log, buffered per worker and written in batches
+AUDIT_LOG_ENABLED = config('AUDIT_LOG_ENABLED', default=True, cast=bool)
+AUDIT_BATCH_SIZE = config('AUDIT_BATCH_SIZE', default=100, cast=int)
+AUDIT_FLUSH_INTERVAL = config('AUDIT_FLUSH_INTERVAL', default=2.0, cast=float)
+AUDIT_MAX_BUFFER = 10000  # oldest events are dropped past this if the database is unavailable
+
+# Rate limits for login and verification codes, kept in a file every worker maps
+RATE_LIMIT_ENABLED = config('RATE_LIMIT_ENABLED', default=True, cast=bool)
+RATE_LIMIT_PATH = config('RATE_LIMIT_PATH', default=str(BASE_DIR / 'var' / 'ratelimit.bin'))
+RATE_LIMIT_SLOTS = 1 << 16
+
+REST_FRAMEWORK = {
+    # Proxies in front of gunicorn, used to read the client IP from X-Forwarded-For
+    'NUM_PROXIES': config('NUM_PROXIES', default=0, cast=int),
+    'DEFAULT_THROTTLE_RATES': {
+        'login_ip': '30/m',
+        'login_email': '5/m',
+        'verify_ip': '30/m',
+        'verify_user': '10/h',  # 4 digit codes, 10 guesses an hour
+        'code_ip': '10/m',
+        'code_target': '5/h',
+    },
+}
+
 # Cloudinary Storage
 CLOUDINARY_STORAGE = {
     'CLOUD_NAME': config('CLOUDINARY_CLOUD_NAME'),
@@ -128,6 +253,26 @@ DATABASES = {
     }
 }
 
+# Accounts sharding: with ACCOUNTS_SHARDS > 0 users, profiles and tokens are spread
+# over that many SQLite files by a hash of the email (see accounts/sharding.py).
+# Create them with `manage.py reshard_accounts --init`, which also moves existing accounts.
+ACCOUNTS_SHARDS = config('ACCOUNTS_SHARDS', default=0, cast=int)
+ACCOUNTS_SHARD_DIR = config('ACCOUNTS_SHARD_DIR', default=str(BASE_DIR / 'var' / 'shards'))
+ACCOUNTS_SHARD_ALIASES = [f'accounts_{i}' for i in range(ACCOUNTS_SHARDS)]
+
+for alias in ACCOUNTS_SHARD_ALIASES:
+    DATABASES[alias] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(ACCOUNTS_SHARD_DIR, f'{alias}.sqlite3'),
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+    }
+
+DATABASE_ROUTERS = ['accounts.sharding.ShardRouter']
+
 # DATABASES = {
 #     'default': dj_database_url.config(
 #         default=config("DATABASE_URL")
@@ -153,6 +298,23 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Password hashing. `manage.py calibrate_hashers` writes the cost that fits the budget on this
+# host, PASSWORD_HASHERS[0] hashes new passwords and older hashes are upgraded on login.
+PASSWORD_HASH_ALGORITHM = config('PASSWORD_HASH_ALGORITHM', default='pbkdf2_sha256')  # pbkdf2_sha256 | scrypt | argon2
+PASSWORD_HASH_BUDGET_MS = config('PASSWORD_HASH_BUDGET_MS', default=250, cast=int)
+PASSWORD_HASH_CALIBRATION_PATH = config('PASSWORD_HASH_CALIBRATION_PATH', default=str(BASE_DIR / 'var' / 'hashers.json'))
+CALIBRATED_HASHERS = {
+    'pbkdf2_sha256': 'accounts.hashers.CalibratedPBKDF2PasswordHasher',
+    'scrypt': 'accounts.hashers.CalibratedScryptPasswordHasher',
+    'argon2': 'accounts.hashers.CalibratedArgon2PasswordHasher',
+}
+PASSWORD_HASHERS = [CALIBRATED_HASHERS[PASSWORD_HASH_ALGORITHM]] + [
+    hasher for algorithm, hasher in CALIBRATED_HASHERS.items() if algorithm != PASSWORD_HASH_ALGORITHM
+] + [
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
@@ -0,0 +1,260 @@
+"""
+A cache shared by every worker on the host, kept in a SQLite file in WAL mode.
+
+LocMemCache gives each gunicorn worker its own cold copy and a delete in one
+worker is never seen by the others. This backend needs no cache server: every
+worker opens the same file (LOCATION), WAL lets readers run next to the one
+writer, and each operation is a single statement, so add() and incr() are
+atomic across processes.
+
+Integers are stored as SQLite integers, everything else is pickled. That is
+what lets incr()/decr() be one UPDATE ... RETURNING instead of a get and a set.
+
+Expired rows are never returned and are removed when the cache is culled.
+Culling runs every CULL_EVERY writes of a process. It drops expired rows, then
+the least recently read ones once there are more than MAX_ENTRIES (approximate
+LRU: a read refreshes the row's access time at most every ACCESS_RESOLUTION
+seconds, so hot keys don't turn every read into a write). With the option
+"EVICT": False only expired rows are ever dropped, for state that must not
+disappear early such as token revocations.
+
+    CACHES = {
+        "default": {
+            "BACKEND": "inventory_kooltech_be.sqlite_cache.SQLiteCache",
+            "LOCATION": "/var/run/app/cache.sqlite3",
+            "OPTIONS": {"MAX_ENTRIES": 50000, "CULL_FREQUENCY": 4},
+        },
+        "state": {
+            "BACKEND": "inventory_kooltech_be.sqlite_cache.SQLiteCache",
+            "LOCATION": "/var/run/app/state.sqlite3",
+            "OPTIONS": {"EVICT": False},
+        },
+    }
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+
+ACCESS_RESOLUTION = 10  # seconds
+CULL_EVERY = 64  # writes per process
+CHUNK_SIZE = 500  # keys per IN (...) query
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires) WHERE expires IS NOT NULL;
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+"""
+
+UPSERT = (
+    "INSERT INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires, accessed = excluded.accessed"
+)
+
+LIVE = "(expires IS NULL OR expires > ?)"
+
+
+def encode(value):
+    if type(value) is int and -2 ** 63 <= value < 2 ** 63:
+        return value
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def decode(stored):
+    return stored if isinstance(stored, int) else pickle.loads(stored)
+
+
+class SQLiteCache(BaseCache):
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self.path = str(location)
+        self.evict = params.get("OPTIONS", {}).get("EVICT", True)
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+    # Connections
+
+    def _connection(self):
+        # One connection per thread, and a forked worker must not reuse its parent's
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")  # a crash may lose the last writes, fine for a cache
+            connection.executescript(SCHEMA)
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    def _wrote(self, count=1):
+        with self._writes_lock:
+            self._writes += count
+            cull = self._writes >= CULL_EVERY
+            if cull:
+                self._writes = 0
+        if cull:
+            self._cull()
+
+    def _cull(self):
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+            count = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0] if self.evict else 0
+            if count > self._max_entries:
+                if self._cull_frequency == 0:
+                    connection.execute("DELETE FROM cache")
+                else:
+                    excess = count - self._max_entries + self._max_entries // self._cull_frequency
+                    connection.execute(
+                        "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)", (excess,)
+                    )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _expires(self, timeout):
+        return self.get_backend_timeout(timeout)
+
+    # Django cache API
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        now = time.time()
+        # Replaces only an expired row, so exactly one of several racing workers gets True
+        cursor = self._connection().execute(
+            "INSERT INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires, accessed = excluded.accessed "
+            "WHERE cache.expires IS NOT NULL AND cache.expires <= excluded.accessed",
+            (key, encode(value), self._expires(timeout), now),
+        )
+        added = cursor.rowcount > 0
+        if added:
+            self._wrote()
+        return added
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        now = time.time()
+        connection = self._connection()
+        row = connection.execute("SELECT value, expires, accessed FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        value, expires, accessed = row
+        if expires is not None and expires <= now:
+            return default
+        if now - accessed > ACCESS_RESOLUTION:
+            connection.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return decode(value)
+
+    def _touch_accessed(self, connection, keys, now):
+        # Same resolution as get(), rows read within it are not written again
+        for i in range(0, len(keys), CHUNK_SIZE):
+            chunk = keys[i:i + CHUNK_SIZE]
+            connection.execute(
+                f"UPDATE cache SET accessed = ? WHERE key IN ({', '.join('?' * len(chunk))}) AND accessed < ?",
+                (now, *chunk, now - ACCESS_RESOLUTION),
+            )
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self._connection().execute(UPSERT, (key, encode(value), self._expires(timeout), time.time()))
+        self._wrote()
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        now = time.time()
+        cursor = self._connection().execute(
+            f"UPDATE cache SET expires = ? WHERE key = ? AND {LIVE}", (self._expires(timeout), key, now)
+        )
+        return cursor.rowcount > 0
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+        return cursor.rowcount > 0
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = self._connection().execute(f"SELECT 1 FROM cache WHERE key = ? AND {LIVE}", (key, time.time())).fetchone()
+        return row is not None
+
+    def incr(self, key, delta=1, version=None):
+        cache_key = self.make_and_validate_key(key, version=version)
+        now = time.time()
+        row = self._connection().execute(
+            f"UPDATE cache SET value = value + ?, accessed = ? WHERE key = ? AND typeof(value) = 'integer' AND {LIVE} RETURNING value",
+            (delta, now, cache_key, now),
+        ).fetchone()
+        if row is None:
+            if self.has_key(key, version=version):
+                raise TypeError(f"Value of key '{key}' is not an integer.")
+            raise ValueError(f"Key '{key}' not found.")
+        return row[0]
+
+    def get_many(self, keys, version=None):
+        keys_by_cache_key = {self.make_and_validate_key(key, version=version): key for key in keys}
+        cache_keys = list(keys_by_cache_key)
+        now = time.time()
+        connection = self._connection()
+        found = {}
+        stale = []
+        for i in range(0, len(cache_keys), CHUNK_SIZE):
+            chunk = cache_keys[i:i + CHUNK_SIZE]
+            rows = connection.execute(
+                f"SELECT key, value, accessed FROM cache WHERE key IN ({', '.join('?' * len(chunk))}) AND {LIVE}",
+                (*chunk, now),
+            )
+            for cache_key, value, accessed in rows:
+                found[keys_by_cache_key[cache_key]] = decode(value)
+                if now - accessed > ACCESS_RESOLUTION:
+                    stale.append(cache_key)
+        if stale:
+            self._touch_accessed(connection, stale, now)
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self._expires(timeout)
+        now = time.time()
+        rows = [(self.make_and_validate_key(key, version=version), encode(value), expires, now) for key, value in data.items()]
+        connection = self._connection()
+        # One transaction, so the batch costs one WAL commit
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(UPSERT, rows)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self._wrote(len(rows))
+        return []
+
+    def delete_many(self, keys, version=None):
+        cache_keys = [self.make_and_validate_key(key, version=version) for key in keys]
+        connection = self._connection()
+        for i in range(0, len(cache_keys), CHUNK_SIZE):
+            chunk = cache_keys[i:i + CHUNK_SIZE]
+            connection.execute(f"DELETE FROM cache WHERE key IN ({', '.join('?' * len(chunk))})", chunk)
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache")
+
+    def close(self, **kwargs):
+        # Django calls this after every request, the connection is kept for the next one
+        pass
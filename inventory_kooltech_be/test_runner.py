@@ -0,0 +1,49 @@
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.db import connections
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+# Databases for the tests that turn accounts sharding on with override_settings
+TEST_SHARD_ALIASES = ["accounts_test_0", "accounts_test_1"]
+
+
+class IsolatedVarTestRunner(DiscoverRunner):
+    """
+    Runs the tests against a throwaway var/ directory, so the caches, shared
+    files and lock files of a dev server are neither read nor written.
+    Also declares TEST_SHARD_ALIASES, whose test databases are only created
+    for the tests that use them.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.var_dir = tempfile.mkdtemp(prefix="test-var-")
+        caches = {
+            alias: {**config, "LOCATION": f"{self.var_dir}/cache-{alias}.sqlite3"}
+            if config["BACKEND"].endswith("SQLiteCache") else config
+            for alias, config in settings.CACHES.items()
+        }
+        self.var_settings = override_settings(
+            CACHES=caches,
+            EMAIL_FILTER_PATH=f"{self.var_dir}/email_filter.bin",
+            RATE_LIMIT_PATH=f"{self.var_dir}/ratelimit.bin",
+            CONCURRENCY_LOCK_DIR=f"{self.var_dir}/concurrency",
+            PROFILING_SPOOL_DIR=f"{self.var_dir}/profiles",
+            MEMORY_SPOOL_DIR=f"{self.var_dir}/memory",
+            PASSWORD_HASH_CALIBRATION_PATH=f"{self.var_dir}/hashers.json",
+        )
+        self.var_settings.enable()
+        for alias in TEST_SHARD_ALIASES:
+            settings.DATABASES[alias] = {"ENGINE": "django.db.backends.sqlite3", "NAME": f"{self.var_dir}/{alias}.sqlite3"}
+        connections.settings = connections.configure_settings(settings.DATABASES)
+
+    def teardown_test_environment(self, **kwargs):
+        for alias in TEST_SHARD_ALIASES:
+            settings.DATABASES.pop(alias, None)
+        self.var_settings.disable()
+        shutil.rmtree(self.var_dir, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
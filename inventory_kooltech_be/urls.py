@@ -19,6 +19,8 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from .views import profile_captures, profile_capture_download, memory_workers
+
 admin.site.site_header = "Inventory Administration"
 admin.site.site_title = "Inventory Admin Portal"
 admin.site.index_title = "Welcome to Inventory Admin Portal"
@@ -26,6 +28,9 @@ admin.site.index_title = "Welcome to Inventory Admin Portal"
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("auth/", include("accounts.urls")),
+    path("ops/profiles/", profile_captures, name="profile_captures"),
+    path("ops/profiles/<str:name>/", profile_capture_download, name="profile_capture_download"),
+    path("ops/memory/", memory_workers, name="memory_workers"),
 ]
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
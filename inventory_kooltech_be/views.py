@@ -0,0 +1,46 @@
+from django.http import FileResponse
+
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes, authentication_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from accounts.authentication import AUTHENTICATION_CLASSES
+
+from .memory import get_tracker, list_workers
+from .profiling import list_captures, capture_path
+
+
+# LIST PROFILER CAPTURES
+@api_view(['GET'])
+@authentication_classes(AUTHENTICATION_CLASSES)
+@permission_classes([IsAdminUser])
+def profile_captures(request):
+    captures = list_captures()
+    route = request.query_params.get("route")
+    if route:
+        captures = [capture for capture in captures if capture["route"] == route]
+    return Response(captures, status=status.HTTP_200_OK)
+
+
+# DOWNLOAD ONE PROFILER CAPTURE
+@api_view(['GET'])
+@authentication_classes(AUTHENTICATION_CLASSES)
+@permission_classes([IsAdminUser])
+def profile_capture_download(request, name):
+    path = capture_path(name)
+    if path is None:
+        return Response({"detail": "Capture not found."}, status=status.HTTP_404_NOT_FOUND)
+    return FileResponse(open(path, "rb"), as_attachment=True, filename=name, content_type="text/plain")
+
+
+# MEMORY ACCOUNTING OF EVERY WORKER
+@api_view(['GET'])
+@authentication_classes(AUTHENTICATION_CLASSES)
+@permission_classes([IsAdminUser])
+def memory_workers(request):
+    """Latest numbers written by each worker. The one serving this request writes fresh ones first."""
+    tracker = get_tracker()
+    with tracker.lock:
+        tracker.write()
+    return Response(list_workers(), status=status.HTTP_200_OK)
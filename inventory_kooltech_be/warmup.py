@@ -0,0 +1,120 @@
+"""
+Warm-up helpers for inventory_kooltech_be.
+
+Gunicorn calls these from the hooks in ``gunicorn.conf.py`` so that the work a
+cold worker would otherwise do on its first request (lazy imports, URL
+resolver population, loading the password validators) happens once in the
+master before it forks.
+"""
+
+import importlib
+import logging
+
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+
+# Modules that are otherwise imported lazily on the first request
+WARM_UP_MODULES = [
+    "cloudinary.uploader",
+    "rest_framework.views",
+    "rest_framework.response",
+    "rest_framework.renderers",
+    "rest_framework.parsers",
+    "rest_framework.negotiation",
+    "rest_framework.authentication",
+    "rest_framework.authtoken.models",
+    "django.db.models.sql.compiler",
+    "django.contrib.sessions.serializers",
+    "django.contrib.messages.storage.fallback",
+    "accounts.views",
+    "accounts.serializers",
+]
+
+
+def import_modules():
+    for module in WARM_UP_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            logger.warning("Warm-up could not import %s", module)
+
+
+def prime_url_resolvers():
+    from django.urls import get_resolver, reverse, NoReverseMatch
+
+    resolver = get_resolver()
+    # Populating the resolver builds the reverse dict and imports every view
+    resolver.reverse_dict
+    for name in list(resolver.reverse_dict.keys()):
+        if not isinstance(name, str):
+            continue
+        try:
+            reverse(name)
+        except NoReverseMatch:
+            # Patterns that need arguments are still populated above
+            pass
+
+
+def prime_validators():
+    from django.contrib.auth.password_validation import get_default_password_validators
+    from django.core.validators import validate_email
+
+    # CommonPasswordValidator reads its gzipped word list when instantiated,
+    # get_default_password_validators() is cached after the first call.
+    get_default_password_validators()
+    # The email validator compiles its regular expressions lazily
+    validate_email("warm-up@example.com")
+
+
+def prime_orm():
+    from django.contrib.auth import get_user_model
+
+    # Compiling a query (without running it) sets up the SQL compiler
+    queryset = get_user_model().objects.filter(email="warm-up@example.com")
+    queryset.query.get_compiler(using=queryset.db).as_sql()
+
+
+def prime_rest_framework():
+    from rest_framework.settings import api_settings
+
+    # api_settings imports the configured classes on first attribute access
+    api_settings.DEFAULT_RENDERER_CLASSES
+    api_settings.DEFAULT_PARSER_CLASSES
+    api_settings.DEFAULT_AUTHENTICATION_CLASSES
+    api_settings.DEFAULT_PERMISSION_CLASSES
+    api_settings.DEFAULT_CONTENT_NEGOTIATION_CLASS
+
+
+def prime_caches():
+    from django.core.cache import caches
+
+    for alias in caches:
+        caches[alias].get("warm-up")
+
+
+def warm_up():
+    """Run every warm-up step. Safe to call more than once."""
+    import_modules()
+    prime_rest_framework()
+    prime_url_resolvers()
+    prime_validators()
+    prime_orm()
+    prime_caches()
+
+
+def rebuild_email_filter():
+    """Rebuild the shared email filter from the database (run once per deploy)."""
+    from django.conf import settings
+    from accounts.email_filter import rebuild_email_filter as rebuild
+
+    if settings.EMAIL_FILTER_ENABLED:
+        count = rebuild()
+        logger.info("Email filter rebuilt with %s emails", count)
+
+
+def close_connections():
+    """Close every database connection (call before fork)."""
+    connections.close_all()